@@ -0,0 +1,198 @@
+from typing import List
+
+import torch
+
+
+def get_kv_cache_len(src_len: int, early_stop_num: int = -1, max_steps: int = 1500, max_cache_len: int = -1) -> int:
+    """
+    Number of positions a static kv cache needs for one decode run.
+
+    Args:
+        src_len: length of the prompt (text + prompt semantic) written by ``process_prompt``.
+        early_stop_num: the decode loop stops after this many generated tokens, -1 means no limit.
+        max_steps: hard limit of the decode loop.
+        max_cache_len: optional user cap of the whole cache length, -1 means no cap.
+    """
+    steps = max_steps if early_stop_num == -1 else min(max_steps, early_stop_num + 1)
+    cache_len = src_len + steps
+    if max_cache_len > 0:
+        cache_len = min(cache_len, max(max_cache_len, src_len + 1))
+    return cache_len
+
+
+class T2SKVCache:
+    """
+    Preallocated key/value buffers of every T2S layer.
+
+    The buffers have shape [batch_size, max_len, hidden_dim]. ``length`` is the cursor of the
+    filled prefix, new keys and values are written in place at the cursor by
+    ``T2SBlock.decode_next_token_static`` so nothing is re-allocated while decoding.
+
+    ``k_cache``/``v_cache`` are views over the first ``batch_size`` rows of the buffers, finished
+    sequences are removed with ``compact`` which moves the kept rows to the front in place.
+    """
+
+    def __init__(self, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor], max_len: int):
+        batch_size, prompt_len, hidden_dim = k_cache[0].shape
+        self.max_len: int = max(max_len, prompt_len)
+        self.length: int = prompt_len
+        self.batch_size: int = batch_size
+
+        self.k_buffers: List[torch.Tensor] = []
+        self.v_buffers: List[torch.Tensor] = []
+        for k, v in zip(k_cache, v_cache):
+            k_buffer = k.new_zeros((batch_size, self.max_len, hidden_dim))
+            v_buffer = v.new_zeros((batch_size, self.max_len, hidden_dim))
+            k_buffer[:, :prompt_len].copy_(k)
+            v_buffer[:, :prompt_len].copy_(v)
+            self.k_buffers.append(k_buffer)
+            self.v_buffers.append(v_buffer)
+
+        self.k_cache: List[torch.Tensor] = []
+        self.v_cache: List[torch.Tensor] = []
+        self._update_views()
+
+    @classmethod
+    def from_packed(
+        cls,
+        k_cache: List[torch.Tensor],
+        v_cache: List[torch.Tensor],
+        rows: torch.Tensor,
+        columns: torch.Tensor,
+        batch_size: int,
+        prompt_len: int,
+        max_len: int,
+    ) -> "T2SKVCache":
+        """
+        Builds the cache from a packed prefill (``T2STransformer.process_prompt_packed``). ``k_cache``/``v_cache``
+        are [1, total_len, hidden_dim] per layer, packed token ``i`` is written at ``(rows[i], columns[i])`` of
+        the buffers. The positions left unwritten are the left padding of the shorter prompts and stay zero.
+        """
+        cache = cls.__new__(cls)
+        cache.max_len = max(max_len, prompt_len)
+        cache.length = prompt_len
+        cache.batch_size = batch_size
+        cache.k_buffers = []
+        cache.v_buffers = []
+        for k, v in zip(k_cache, v_cache):
+            k_buffer = k.new_zeros((batch_size, cache.max_len, k.shape[-1]))
+            v_buffer = v.new_zeros((batch_size, cache.max_len, v.shape[-1]))
+            k_buffer[rows, columns] = k[0]
+            v_buffer[rows, columns] = v[0]
+            cache.k_buffers.append(k_buffer)
+            cache.v_buffers.append(v_buffer)
+        cache.k_cache = []
+        cache.v_cache = []
+        cache._update_views()
+        return cache
+
+    def _update_views(self):
+        self.k_cache = [buffer[: self.batch_size] for buffer in self.k_buffers]
+        self.v_cache = [buffer[: self.batch_size] for buffer in self.v_buffers]
+
+    def is_full(self, num_tokens: int = 1) -> bool:
+        return self.length + num_tokens > self.max_len
+
+    def advance(self, num_tokens: int = 1):
+        self.length += num_tokens
+
+    def compact(self, keep: List[int]):
+        """
+        Keep only the rows listed in ``keep`` (ascending), moving them to the front of the buffers.
+        Only the filled prefix of each moved row is copied.
+        """
+        for dst, src in enumerate(keep):
+            if dst == src:
+                continue
+            for k_buffer, v_buffer in zip(self.k_buffers, self.v_buffers):
+                k_buffer[dst, : self.length].copy_(k_buffer[src, : self.length])
+                v_buffer[dst, : self.length].copy_(v_buffer[src, : self.length])
+        self.batch_size = len(keep)
+        self._update_views()
+
+
+class T2SRaggedKVCache:
+    """
+    Key/value buffers shared by sequences of different lengths, used by the continuous batching
+    scheduler.
+
+    Every active row is left aligned and has its own filled length in ``lengths``, rows can be
+    admitted (``admit``) and removed (``remove``) between decode steps. Removing a row moves the
+    last active row into its slot so the active rows always stay in ``[0, batch_size)``.
+    """
+
+    def __init__(
+        self,
+        num_layers: int,
+        max_batch_size: int,
+        max_len: int,
+        hidden_dim: int,
+        dtype: torch.dtype,
+        device: torch.device,
+    ):
+        self.max_batch_size: int = max_batch_size
+        self.max_len: int = max_len
+        self.dtype = dtype
+        self.device = device
+        self.batch_size: int = 0
+        self.lengths: List[int] = []
+
+        self.k_buffers: List[torch.Tensor] = [
+            torch.zeros((max_batch_size, max_len, hidden_dim), dtype=dtype, device=device) for _ in range(num_layers)
+        ]
+        self.v_buffers: List[torch.Tensor] = [
+            torch.zeros((max_batch_size, max_len, hidden_dim), dtype=dtype, device=device) for _ in range(num_layers)
+        ]
+
+        self.k_cache: List[torch.Tensor] = []
+        self.v_cache: List[torch.Tensor] = []
+        self._update_views()
+
+    def _update_views(self):
+        self.k_cache = [buffer[: self.batch_size] for buffer in self.k_buffers]
+        self.v_cache = [buffer[: self.batch_size] for buffer in self.v_buffers]
+
+    def can_admit(self, prompt_len: int) -> bool:
+        return self.batch_size < self.max_batch_size and prompt_len < self.max_len
+
+    def admit(self, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor]) -> int:
+        """
+        Copy the prompt caches of one sequence ([1, prompt_len, hidden_dim] per layer) into a free row.
+        Returns the row index.
+        """
+        prompt_len = k_cache[0].shape[1]
+        row = self.batch_size
+        for k_buffer, v_buffer, k, v in zip(self.k_buffers, self.v_buffers, k_cache, v_cache):
+            k_buffer[row, :prompt_len].copy_(k[0])
+            v_buffer[row, :prompt_len].copy_(v[0])
+        self.lengths.append(prompt_len)
+        self.batch_size += 1
+        self._update_views()
+        return row
+
+    def is_full(self, row: int) -> bool:
+        return self.lengths[row] + 1 > self.max_len
+
+    def advance(self):
+        self.lengths = [length + 1 for length in self.lengths]
+
+    def remove(self, rows: List[int]) -> List[int]:
+        """
+        Remove ``rows`` from the batch. Returns the new order of the kept rows, i.e. ``order[i]`` is
+        the old index of the row now stored at ``i``.
+        """
+        order = list(range(self.batch_size))
+        for row in sorted(rows, reverse=True):
+            last = len(order) - 1
+            if row != last:
+                length = self.lengths[last]
+                for k_buffer, v_buffer in zip(self.k_buffers, self.v_buffers):
+                    k_buffer[row, :length].copy_(k_buffer[last, :length])
+                    v_buffer[row, :length].copy_(v_buffer[last, :length])
+                self.lengths[row] = self.lengths[last]
+                order[row] = order[last]
+            order.pop()
+            self.lengths.pop()
+        self.batch_size = len(order)
+        self._update_views()
+        return order
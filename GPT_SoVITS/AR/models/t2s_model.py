@@ -1,6 +1,7 @@
 # modified from https://github.com/yangdongchao/SoundStorm/blob/master/soundstorm/s1/AR/models/t2s_model.py
 # reference: https://github.com/lifeiteng/vall-e
 import math
+import threading
 from typing import List, Optional
 
 import torch
@@ -9,18 +10,24 @@ from torch.nn import functional as F
 from torchmetrics.classification import MulticlassAccuracy
 from tqdm import tqdm
 
+from AR.models.kv_cache import T2SKVCache, get_kv_cache_len
 from AR.models.utils import (
+    T2SSampler,
     dpo_loss,
     get_batch_logps,
+    logits_to_probs,
     make_pad_mask,
     make_pad_mask_left,
     make_reject_y,
-    sample,
+    multinomial_sample_one_no_sync,
     topk_sampling,
 )
 from AR.modules.embedding import SinePositionalEmbedding, TokenEmbedding
 from AR.modules.transformer import LayerNorm, TransformerEncoder, TransformerEncoderLayer
 
+### 多个推理线程共用一个模型，投机解码统计的累加需要加锁。放在模块级，模型仍可以被deepcopy
+_speculative_stats_lock = threading.Lock()
+
 default_config = {
     "embedding_dim": 512,
     "hidden_dim": 512,
@@ -70,6 +77,16 @@ def scaled_dot_product_attention(
     return attn_weight @ value
 
 
+def make_decode_mask(key_padding_mask: Optional[torch.Tensor], max_len: int) -> Optional[torch.Tensor]:
+    """
+    Extends the left padding mask [B, 1, 1, src_len] of the prompt to the kv cache length once, each decode step
+    then passes a view of its filled prefix instead of growing the mask.
+    """
+    if key_padding_mask is None:
+        return None
+    return F.pad(key_padding_mask, (0, max_len - key_padding_mask.shape[-1]), value=False)
+
+
 @torch.jit.script
 class T2SMLP:
     def __init__(self, w1, b1, w2, b2):
@@ -173,6 +190,112 @@ class T2SBlock:
         )
         return x, k_cache, v_cache
 
+    def attention(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        attn_mask: Optional[torch.Tensor],
+        torch_sdpa: bool = True,
+    ):
+        if torch_sdpa:
+            if attn_mask is None:
+                return F.scaled_dot_product_attention(q, k, v)
+            return F.scaled_dot_product_attention(q, k, v, ~attn_mask)
+        return scaled_dot_product_attention(q, k, v, attn_mask)
+
+    def prefix_lm_attention(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        x_len: int,
+        x_attn_mask: Optional[torch.Tensor],
+        y_attn_mask: Optional[torch.Tensor],
+        torch_sdpa: bool = True,
+    ):
+        # 文本的query只看文本的key，语义的query看全部key，q/k/v为[B, H, src_len, D]
+        attn = self.attention(q[:, :, :x_len], k[:, :, :x_len], v[:, :, :x_len], x_attn_mask, torch_sdpa)
+        if x_len < q.shape[2]:
+            attn_y = self.attention(q[:, :, x_len:], k, v, y_attn_mask, torch_sdpa)
+            attn = torch.cat([attn, attn_y], dim=2)
+        return attn
+
+    def process_prompt_prefix_lm(
+        self,
+        x: torch.Tensor,
+        x_len: int,
+        key_padding_mask: Optional[torch.Tensor] = None,
+        y_attn_mask: Optional[torch.Tensor] = None,
+        torch_sdpa: bool = True,
+    ):
+        # 前x_len个位置(文本)之间双向attention，之后(语义)为因果attention，不构造[src_len, src_len]的mask
+        # key_padding_mask [B, 1, 1, src_len] 为左侧padding，y_attn_mask [1或B, 1, y_len, src_len] 为语义部分的mask
+        q, k_cache, v_cache = F.linear(x, self.qkv_w, self.qkv_b).chunk(3, dim=-1)
+
+        batch_size = q.shape[0]
+        src_len = q.shape[1]
+
+        q = q.view(batch_size, src_len, self.num_heads, -1).transpose(1, 2)
+        k = k_cache.view(batch_size, src_len, self.num_heads, -1).transpose(1, 2)
+        v = v_cache.view(batch_size, src_len, self.num_heads, -1).transpose(1, 2)
+
+        x_attn_mask: Optional[torch.Tensor] = None
+        if key_padding_mask is not None:
+            x_attn_mask = key_padding_mask[:, :, :, :x_len]
+        attn = self.prefix_lm_attention(q, k, v, x_len, x_attn_mask, y_attn_mask, torch_sdpa)
+
+        attn = attn.transpose(1, 2).reshape(batch_size, src_len, -1)
+        attn = F.linear(attn, self.out_w, self.out_b)
+
+        x = x + attn
+        x = F.layer_norm(x, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1)
+        x = x + self.mlp.forward(x)
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w2,
+            self.norm_b2,
+            self.norm_eps2,
+        )
+        return x, k_cache, v_cache
+
+    def process_prompt_packed(
+        self,
+        x: torch.Tensor,
+        x_lens: List[int],
+        cu_seqlens: List[int],
+        y_attn_masks: List[torch.Tensor],
+        torch_sdpa: bool = True,
+    ):
+        # x [1, total_len, D] 为首尾相接、没有padding的多条序列，第i条占[cu_seqlens[i], cu_seqlens[i+1])
+        # 线性层和MLP在打包后的序列上计算，attention按序列分块(块对角)，每块内与process_prompt_prefix_lm相同
+        q, k_cache, v_cache = F.linear(x, self.qkv_w, self.qkv_b).chunk(3, dim=-1)
+
+        attn_list: List[torch.Tensor] = []
+        for i in range(len(x_lens)):
+            start = cu_seqlens[i]
+            seq_len = cu_seqlens[i + 1] - start
+            q_i = q[:, start : start + seq_len].view(1, seq_len, self.num_heads, -1).transpose(1, 2)
+            k_i = k_cache[:, start : start + seq_len].view(1, seq_len, self.num_heads, -1).transpose(1, 2)
+            v_i = v_cache[:, start : start + seq_len].view(1, seq_len, self.num_heads, -1).transpose(1, 2)
+            attn_i = self.prefix_lm_attention(q_i, k_i, v_i, x_lens[i], None, y_attn_masks[i], torch_sdpa)
+            attn_list.append(attn_i.transpose(1, 2).reshape(1, seq_len, -1))
+        attn = torch.cat(attn_list, dim=1)
+        attn = F.linear(attn, self.out_w, self.out_b)
+
+        x = x + attn
+        x = F.layer_norm(x, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1)
+        x = x + self.mlp.forward(x)
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w2,
+            self.norm_b2,
+            self.norm_eps2,
+        )
+        return x, k_cache, v_cache
+
     def decode_next_token(
         self,
         x: torch.Tensor,
@@ -220,6 +343,105 @@ class T2SBlock:
         )
         return x, k_cache, v_cache
 
+    def decode_next_token_static(
+        self,
+        x: torch.Tensor,
+        k_cache: torch.Tensor,
+        v_cache: torch.Tensor,
+        cache_len: int,
+        attn_mask: Optional[torch.Tensor] = None,
+        torch_sdpa: bool = True,
+    ):
+        # k_cache/v_cache 为预分配的缓存 [B, max_len, D]，新的k,v原地写入cache_len处，只对已填充的前缀做attention
+        q, k, v = F.linear(x, self.qkv_w, self.qkv_b).chunk(3, dim=-1)
+
+        batch_size = q.shape[0]
+        q_len = q.shape[1]
+        kv_len = cache_len + q_len
+
+        k_cache.narrow(1, cache_len, q_len).copy_(k)
+        v_cache.narrow(1, cache_len, q_len).copy_(v)
+
+        q = q.view(batch_size, q_len, self.num_heads, -1).transpose(1, 2)
+        k = k_cache.narrow(1, 0, kv_len).view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+        v = v_cache.narrow(1, 0, kv_len).view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+
+        if torch_sdpa:
+            attn = F.scaled_dot_product_attention(q, k, v, (~attn_mask) if attn_mask is not None else None)
+        else:
+            attn = scaled_dot_product_attention(q, k, v, attn_mask)
+
+        attn = attn.transpose(1, 2).reshape(batch_size, q_len, -1)
+        attn = F.linear(attn, self.out_w, self.out_b)
+
+        x = x + attn
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w1,
+            self.norm_b1,
+            self.norm_eps1,
+        )
+        x = x + self.mlp.forward(x)
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w2,
+            self.norm_b2,
+            self.norm_eps2,
+        )
+        return x
+
+    def decode_next_token_ragged(
+        self,
+        x: torch.Tensor,
+        k_cache: torch.Tensor,
+        v_cache: torch.Tensor,
+        batch_index: torch.Tensor,
+        cache_lens: torch.Tensor,
+        kv_len: int,
+        attn_mask: Optional[torch.Tensor] = None,
+        torch_sdpa: bool = True,
+    ):
+        # 每条序列的缓存长度不同，新的k,v按行写入各自的cache_lens处，attention只看前kv_len个位置，其余由attn_mask屏蔽
+        q, k, v = F.linear(x, self.qkv_w, self.qkv_b).chunk(3, dim=-1)
+
+        batch_size = q.shape[0]
+        q_len = q.shape[1]
+
+        k_cache[batch_index, cache_lens] = k[:, 0]
+        v_cache[batch_index, cache_lens] = v[:, 0]
+
+        q = q.view(batch_size, q_len, self.num_heads, -1).transpose(1, 2)
+        k = k_cache.narrow(1, 0, kv_len).view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+        v = v_cache.narrow(1, 0, kv_len).view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+
+        if torch_sdpa:
+            attn = F.scaled_dot_product_attention(q, k, v, (~attn_mask) if attn_mask is not None else None)
+        else:
+            attn = scaled_dot_product_attention(q, k, v, attn_mask)
+
+        attn = attn.transpose(1, 2).reshape(batch_size, q_len, -1)
+        attn = F.linear(attn, self.out_w, self.out_b)
+
+        x = x + attn
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w1,
+            self.norm_b1,
+            self.norm_eps1,
+        )
+        x = x + self.mlp.forward(x)
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w2,
+            self.norm_b2,
+            self.norm_eps2,
+        )
+        return x
+
 
 @torch.jit.script
 class T2STransformer:
@@ -242,6 +464,58 @@ class T2STransformer:
             v_cache.append(v_cache_)
         return x, k_cache, v_cache
 
+    def process_prompt_prefix_lm(
+        self,
+        x: torch.Tensor,
+        x_len: int,
+        key_padding_mask: Optional[torch.Tensor] = None,
+        torch_sdpa: bool = True,
+    ):
+        src_len = x.shape[1]
+        y_len = src_len - x_len
+        ### 语义部分第i个token只看到x_len+i及之前的位置，所有层和头共用
+        positions = torch.arange(src_len, device=x.device)
+        y_attn_mask = (positions.view(1, src_len) > positions[x_len:].view(y_len, 1)).view(1, 1, y_len, src_len)
+        if key_padding_mask is not None:
+            y_attn_mask = y_attn_mask.logical_or(key_padding_mask)
+
+        k_cache: List[torch.Tensor] = []
+        v_cache: List[torch.Tensor] = []
+        for i in range(self.num_blocks):
+            x, k_cache_, v_cache_ = self.blocks[i].process_prompt_prefix_lm(
+                x, x_len, key_padding_mask, y_attn_mask, torch_sdpa
+            )
+            k_cache.append(k_cache_)
+            v_cache.append(v_cache_)
+        return x, k_cache, v_cache
+
+    def process_prompt_packed(
+        self,
+        x: torch.Tensor,
+        x_lens: List[int],
+        seq_lens: List[int],
+        torch_sdpa: bool = True,
+    ):
+        cu_seqlens: List[int] = [0]
+        y_attn_masks: List[torch.Tensor] = []
+        for i in range(len(seq_lens)):
+            cu_seqlens.append(cu_seqlens[i] + seq_lens[i])
+            positions = torch.arange(seq_lens[i], device=x.device)
+            y_len = seq_lens[i] - x_lens[i]
+            y_attn_masks.append(
+                (positions.view(1, seq_lens[i]) > positions[x_lens[i] :].view(y_len, 1)).view(1, 1, y_len, seq_lens[i])
+            )
+
+        k_cache: List[torch.Tensor] = []
+        v_cache: List[torch.Tensor] = []
+        for i in range(self.num_blocks):
+            x, k_cache_, v_cache_ = self.blocks[i].process_prompt_packed(
+                x, x_lens, cu_seqlens, y_attn_masks, torch_sdpa
+            )
+            k_cache.append(k_cache_)
+            v_cache.append(v_cache_)
+        return x, k_cache, v_cache
+
     def decode_next_token(
         self,
         x: torch.Tensor,
@@ -256,6 +530,52 @@ class T2STransformer:
             )
         return x, k_cache, v_cache
 
+    def decode_next_token_static(
+        self,
+        x: torch.Tensor,
+        k_cache: List[torch.Tensor],
+        v_cache: List[torch.Tensor],
+        cache_len: int,
+        attn_mask: Optional[torch.Tensor] = None,
+        torch_sdpa: bool = True,
+    ):
+        for i in range(self.num_blocks):
+            x = self.blocks[i].decode_next_token_static(x, k_cache[i], v_cache[i], cache_len, attn_mask, torch_sdpa)
+        return x
+
+    def decode_next_token_layers(
+        self,
+        x: torch.Tensor,
+        k_cache: List[torch.Tensor],
+        v_cache: List[torch.Tensor],
+        cache_len: int,
+        start: int,
+        end: int,
+        attn_mask: Optional[torch.Tensor] = None,
+        torch_sdpa: bool = True,
+    ):
+        # 只经过第start到end-1层，用于投机解码的草稿(前几层)和验证(其余层)
+        for i in range(start, end):
+            x = self.blocks[i].decode_next_token_static(x, k_cache[i], v_cache[i], cache_len, attn_mask, torch_sdpa)
+        return x
+
+    def decode_next_token_ragged(
+        self,
+        x: torch.Tensor,
+        k_cache: List[torch.Tensor],
+        v_cache: List[torch.Tensor],
+        batch_index: torch.Tensor,
+        cache_lens: torch.Tensor,
+        kv_len: int,
+        attn_mask: Optional[torch.Tensor] = None,
+        torch_sdpa: bool = True,
+    ):
+        for i in range(self.num_blocks):
+            x = self.blocks[i].decode_next_token_ragged(
+                x, k_cache[i], v_cache[i], batch_index, cache_lens, kv_len, attn_mask, torch_sdpa
+            )
+        return x
+
 
 class Text2SemanticDecoder(nn.Module):
     def __init__(self, config, norm_first=False, top_k=3):
@@ -351,6 +671,15 @@ class Text2SemanticDecoder(nn.Module):
             blocks.append(block)
 
         self.t2s_transformer = T2STransformer(self.num_layers, blocks)
+        ### 投机解码的累计统计，见_decode_stream_speculative
+        self.speculative_stats = {"rounds": 0, "proposed": 0, "accepted": 0, "tokens": 0}
+
+    def get_speculative_stats(self) -> dict:
+        """
+        A consistent copy of the cumulative speculative decoding stats.
+        """
+        with _speculative_stats_lock:
+            return dict(self.speculative_stats)
 
     def make_input_data(self, x, x_lens, y, y_lens, bert_feature):
         x = self.ar_text_embedding(x)
@@ -580,6 +909,37 @@ class Text2SemanticDecoder(nn.Module):
         # 错位
         return targets[:, :-1], targets[:, 1:]
 
+    def process_prompt_packed(
+        self,
+        xy_pos: torch.Tensor,
+        x_lens: torch.LongTensor,
+        x_len: int,
+        kv_cache_len: int,
+    ):
+        """
+        Prefill of the left padded batch ``xy_pos`` [B, x_len + y_len, D] without computing on the padding:
+        the rows are packed one after another and attended block-diagonally, the keys and values go straight
+        to their padded positions of the returned T2SKVCache. Returns the hidden state of the last position of
+        every row [B, 1, D] and the cache.
+        """
+        bsz, src_len, _ = xy_pos.shape
+        device = xy_pos.device
+        y_len = src_len - x_len
+        x_lens_list = [int(item) for item in x_lens.tolist()]
+        seq_lens = [item + y_len for item in x_lens_list]
+
+        ### 打包后每个token在padding布局中的位置，第i行从max_len-x_lens[i]开始
+        rows = torch.repeat_interleave(
+            torch.arange(bsz, device=device), torch.tensor(seq_lens, dtype=torch.long, device=device)
+        )
+        columns = torch.cat([torch.arange(src_len - seq_len, src_len, device=device) for seq_len in seq_lens])
+        xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt_packed(
+            xy_pos[rows, columns].unsqueeze(0), x_lens_list, seq_lens
+        )
+        last = torch.tensor(seq_lens, dtype=torch.long, device=device).cumsum(0) - 1
+        kv_cache = T2SKVCache.from_packed(k_cache, v_cache, rows, columns, bsz, src_len, kv_cache_len)
+        return xy_dec[0, last].unsqueeze(1), kv_cache
+
     def infer_panel_batch_infer(
         self,
         x: List[torch.LongTensor],  #####全部文本token
@@ -627,8 +987,10 @@ class Text2SemanticDecoder(nn.Module):
         x_len = x.shape[1]
         stop = False
 
-        k_cache = None
-        v_cache = None
+        kv_cache: T2SKVCache = None
+        max_kv_cache_len = kwargs.get("max_kv_cache_len", -1)
+        ### 每步调用一次，请求被取消或超时时抛出异常终止解码
+        cancel_check = kwargs.get("cancel_check", None)
         ###################  first step ##########################
         assert y is not None, "Error: Prompt free is not supported batch_infer!"
         ref_free = False
@@ -643,46 +1005,8 @@ class Text2SemanticDecoder(nn.Module):
         ##### create mask #####
         bsz = x.shape[0]
         src_len = x_len + y_len
-        y_paddind_mask = make_pad_mask_left(y_lens, y_len)
-        x_paddind_mask = make_pad_mask_left(x_lens, max_len)
-
-        # (bsz, x_len + y_len)
-        padding_mask = torch.concat([x_paddind_mask, y_paddind_mask], dim=1)
-
-        x_mask = F.pad(
-            torch.zeros(x_len, x_len, dtype=torch.bool, device=x.device),
-            (0, y_len),
-            value=True,
-        )
-
-        y_mask = F.pad(  ###yy的右上1扩展到左边xy的0,(y,x+y)
-            torch.triu(torch.ones(y_len, y_len, dtype=torch.bool, device=x.device), diagonal=1),
-            (x_len, 0),
-            value=False,
-        )
-
-        causal_mask = torch.concat([x_mask, y_mask], dim=0).view(1, src_len, src_len).repeat(bsz, 1, 1).to(x.device)
-        # padding_mask = padding_mask.unsqueeze(1) * padding_mask.unsqueeze(2) ### [b, x+y, x+y]
-        ### 上面是错误的，会导致padding的token被"看见"
-
-        # 正确的padding_mask应该是：
-        # |   pad_len   |  x_len  |  y_len  |
-        # [[PAD, PAD, PAD, 1, 2, 3, 4, 5, 6],
-        # [PAD, PAD, PAD, 1, 2, 3, 4, 5, 6],
-        # [PAD, PAD, PAD, 1, 2, 3, 4, 5, 6],  前3行按理说也应该被mask掉，但是为了防止计算attention时不出现nan，还是保留了，不影响结果
-        # [PAD, PAD, PAD, 1, 2, 3, 4, 5, 6],
-        # [PAD, PAD, PAD, 1, 2, 3, 4, 5, 6],
-        # [PAD, PAD, PAD, 1, 2, 3, 4, 5, 6],
-        # [PAD, PAD, PAD, 1, 2, 3, 4, 5, 6],
-        # [PAD, PAD, PAD, 1, 2, 3, 4, 5, 6],
-        # [PAD, PAD, PAD, 1, 2, 3, 4, 5, 6]]
-
-        padding_mask = padding_mask.view(bsz, 1, src_len).repeat(1, src_len, 1)
-
-        attn_mask: torch.Tensor = causal_mask.logical_or(padding_mask)
-        attn_mask = attn_mask.unsqueeze(1).expand(-1, self.num_head, -1, -1).bool()
-
-        # 正确的attn_mask应该是这样的：
+        ### 只构造每行左侧padding的mask [bsz, 1, 1, src_len]，文本之间双向、语义部分因果的结构由
+        ### process_prompt_prefix_lm根据x_len推出，等价于下面的attn_mask（True为被屏蔽）：
         # |   pad_len   |  x_len  |  y_len  |
         # [[PAD, PAD, PAD, 1, 2, 3, EOS, EOS, EOS],
         # [PAD, PAD, PAD, 1, 2, 3, EOS, EOS, EOS],
@@ -693,27 +1017,68 @@ class Text2SemanticDecoder(nn.Module):
         # [PAD, PAD, PAD, 1, 2, 3,   4, EOS, EOS],
         # [PAD, PAD, PAD, 1, 2, 3,   4,   5, EOS],
         # [PAD, PAD, PAD, 1, 2, 3,   4,   5,   6]]
+        # 解码时每步只需要padding的那一行
+        key_padding_mask = None
+        if int(x_lens.min()) < x_len:
+            key_padding_mask = F.pad(make_pad_mask_left(x_lens, x_len), (0, y_len), value=False)
+            key_padding_mask = key_padding_mask.view(bsz, 1, 1, src_len)
+        ### 长度不一时打包prefill，不在左侧padding上计算
+        packed_prefill = kwargs.get("packed_prefill", False) and key_padding_mask is not None
+
+        sync_interval = kwargs.get("sync_interval", 0)
+        if sync_interval > 0:
+            return self._decode_batch_deferred_eos(
+                xy_pos,
+                key_padding_mask,
+                x_len,
+                y,
+                src_len,
+                y_len,
+                x_lens=x_lens if packed_prefill else None,
+                top_k=top_k,
+                top_p=top_p,
+                early_stop_num=early_stop_num,
+                temperature=temperature,
+                repetition_penalty=repetition_penalty,
+                max_kv_cache_len=max_kv_cache_len,
+                sync_interval=sync_interval,
+                cancel_check=cancel_check,
+            )
 
         ###### decode #####
         y_list = [None] * y.shape[0]
         batch_idx_map = list(range(y.shape[0]))
         idx_list = [None] * y.shape[0]
+        decode_mask: Optional[torch.Tensor] = None
+        sampler = T2SSampler(y, y.shape[0], self.vocab_size, y.device, top_k, top_p, temperature, repetition_penalty)
         for idx in tqdm(range(1500)):
+            if cancel_check is not None:
+                cancel_check()
             if idx == 0:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, attn_mask, None)
+                kv_cache_len = get_kv_cache_len(src_len, early_stop_num, max_cache_len=max_kv_cache_len)
+                if packed_prefill:
+                    xy_dec, kv_cache = self.process_prompt_packed(xy_pos, x_lens, x_len, kv_cache_len)
+                else:
+                    xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt_prefix_lm(
+                        xy_pos, x_len, key_padding_mask
+                    )
+                    kv_cache = T2SKVCache(k_cache, v_cache, kv_cache_len)
+                decode_mask = make_decode_mask(key_padding_mask, kv_cache.max_len)
             else:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache, attn_mask)
+                xy_dec = self.t2s_transformer.decode_next_token_static(
+                    xy_pos,
+                    kv_cache.k_cache,
+                    kv_cache.v_cache,
+                    kv_cache.length,
+                    decode_mask[..., : kv_cache.length + 1] if decode_mask is not None else None,
+                )
+                kv_cache.advance()
             logits = self.ar_predict_layer(xy_dec[:, -1])
 
             if idx == 0:
-                attn_mask = F.pad(attn_mask[:, :, -1].unsqueeze(-2), (0, 1), value=False)
                 logits = logits[:, :-1]
-            else:
-                attn_mask = F.pad(attn_mask, (0, 1), value=False)
 
-            samples = sample(
-                logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
-            )[0]
+            samples, logits = sampler(logits)
 
             y = torch.concat([y, samples], dim=1)
 
@@ -732,19 +1097,24 @@ class Text2SemanticDecoder(nn.Module):
                     idx_list[batch_index] = idx
                     y_list[batch_index] = y[i, :-1]
 
-                batch_idx_map = [batch_idx_map[i] for i in reserved_idx_of_batch_for_y.tolist()]
+                reserved_idx_list = reserved_idx_of_batch_for_y.tolist()
+                batch_idx_map = [batch_idx_map[i] for i in reserved_idx_list]
 
             # 只保留batch中未生成完毕的序列
             if reserved_idx_of_batch_for_y is not None:
                 # index = torch.LongTensor(batch_idx_map).to(y.device)
                 y = torch.index_select(y, dim=0, index=reserved_idx_of_batch_for_y)
-                attn_mask = torch.index_select(attn_mask, dim=0, index=reserved_idx_of_batch_for_y)
-                if k_cache is not None:
-                    for i in range(len(k_cache)):
-                        k_cache[i] = torch.index_select(k_cache[i], dim=0, index=reserved_idx_of_batch_for_y)
-                        v_cache[i] = torch.index_select(v_cache[i], dim=0, index=reserved_idx_of_batch_for_y)
-
-            if (early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num) or idx == 1499:
+                if decode_mask is not None:
+                    decode_mask = torch.index_select(decode_mask, dim=0, index=reserved_idx_of_batch_for_y)
+                sampler.select(reserved_idx_of_batch_for_y)
+                ### 原地压缩kv cache，不重新分配缓存
+                kv_cache.compact(reserved_idx_list)
+
+            if (
+                (early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num)
+                or idx == 1499
+                or kv_cache.is_full()
+            ):
                 print("use early stop num:", early_stop_num)
                 stop = True
                 for i, batch_index in enumerate(batch_idx_map):
@@ -778,6 +1148,122 @@ class Text2SemanticDecoder(nn.Module):
         # print(idx_list)
         return y_list, idx_list
 
+    def _decode_batch_deferred_eos(
+        self,
+        xy_pos: torch.Tensor,
+        key_padding_mask: Optional[torch.Tensor],
+        x_len: int,
+        prompts: torch.LongTensor,
+        src_len: int,
+        y_len: int,
+        x_lens: Optional[torch.LongTensor] = None,
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        max_kv_cache_len: int = -1,
+        sync_interval: int = 8,
+        cancel_check=None,
+        max_steps: int = 1500,
+    ):
+        """
+        Decode loop of ``infer_panel_batch_infer`` without a device to host sync per step. EOS is tracked on the
+        device and read back every ``sync_interval`` steps, when the finished rows are removed from the batch and
+        the tokens they sampled after their EOS are trimmed. Returns the same ``y_list, idx_list``.
+        With ``x_lens`` the prompt is prefilled packed (see ``process_prompt_packed``).
+        """
+        bsz, prefix_len = prompts.shape
+        device = prompts.device
+        y_buffer = torch.zeros((bsz, prefix_len + max_steps), dtype=torch.long, device=device)
+        y_buffer[:, :prefix_len] = prompts
+        y_length = prefix_len
+        ### 每条序列第一次生成EOS的步数，-1为还未结束
+        eos_steps = torch.full((bsz,), -1, dtype=torch.long, device=device)
+        finished = torch.zeros((bsz,), dtype=torch.bool, device=device)
+
+        y_list = [None] * bsz
+        idx_list = [None] * bsz
+        batch_idx_map = list(range(bsz))
+        kv_cache: T2SKVCache = None
+        decode_mask: Optional[torch.Tensor] = None
+        sampler = T2SSampler(prompts, bsz, self.vocab_size, device, top_k, top_p, temperature, repetition_penalty)
+        for idx in range(max_steps):
+            if cancel_check is not None:
+                cancel_check()
+            if idx == 0:
+                kv_cache_len = get_kv_cache_len(src_len, early_stop_num, max_steps, max_kv_cache_len)
+                if x_lens is not None:
+                    xy_dec, kv_cache = self.process_prompt_packed(xy_pos, x_lens, x_len, kv_cache_len)
+                else:
+                    xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt_prefix_lm(
+                        xy_pos, x_len, key_padding_mask
+                    )
+                    kv_cache = T2SKVCache(k_cache, v_cache, kv_cache_len)
+                decode_mask = make_decode_mask(key_padding_mask, kv_cache.max_len)
+            else:
+                xy_dec = self.t2s_transformer.decode_next_token_static(
+                    xy_pos,
+                    kv_cache.k_cache,
+                    kv_cache.v_cache,
+                    kv_cache.length,
+                    decode_mask[..., : kv_cache.length + 1] if decode_mask is not None else None,
+                )
+                kv_cache.advance()
+            logits = self.ar_predict_layer(xy_dec[:, -1])
+
+            if idx == 0:
+                logits = logits[:, :-1]
+
+            samples, logits = sampler(logits)
+            y_buffer[:, y_length] = samples[:, 0]
+            y_length += 1
+
+            eos = (samples[:, 0] == self.EOS).logical_or(torch.argmax(logits, dim=-1) == self.EOS)
+            eos_steps.masked_fill_(eos.logical_and(finished.logical_not()), idx)
+            finished.logical_or_(eos)
+
+            force_stop = (
+                (early_stop_num != -1 and y_length - prefix_len > early_stop_num)
+                or idx == max_steps - 1
+                or kv_cache.is_full()
+            )
+            if force_stop or (idx + 1) % sync_interval == 0:
+                ### 只在这里同步，已结束的序列输出到EOS之前，之后多采样的token丢弃
+                finished_list = finished.tolist()
+                eos_list = eos_steps.tolist()
+                keep = []
+                for i, batch_index in enumerate(batch_idx_map):
+                    if finished_list[i]:
+                        y_list[batch_index] = y_buffer[i, : prefix_len + eos_list[i]]
+                        idx_list[batch_index] = eos_list[i]
+                    elif force_stop:
+                        y_list[batch_index] = y_buffer[i, : y_length - 1]
+                        idx_list[batch_index] = idx
+                    else:
+                        keep.append(i)
+                if len(keep) == 0:
+                    break
+                if len(keep) < len(batch_idx_map):
+                    index = torch.tensor(keep, dtype=torch.long, device=device)
+                    y_buffer = torch.index_select(y_buffer, dim=0, index=index)
+                    if decode_mask is not None:
+                        decode_mask = torch.index_select(decode_mask, dim=0, index=index)
+                    sampler.select(index)
+                    eos_steps = torch.index_select(eos_steps, dim=0, index=index)
+                    finished = torch.index_select(finished, dim=0, index=index)
+                    kv_cache.compact(keep)
+                    batch_idx_map = [batch_idx_map[i] for i in keep]
+
+            ####################### update next step ###################################
+            y_emb = self.ar_audio_embedding(y_buffer[:, y_length - 1 : y_length])
+            xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[
+                :, y_len + idx
+            ].to(dtype=y_emb.dtype, device=y_emb.device)
+
+        print(f"T2S Decoding EOS [{prefix_len} -> {prefix_len + max(idx_list)}] in {idx + 1} steps")
+        return y_list, idx_list
+
     def infer_panel_naive_batched(
         self,
         x: List[torch.LongTensor],  #####全部文本token
@@ -824,6 +1310,47 @@ class Text2SemanticDecoder(nn.Module):
         repetition_penalty: float = 1.35,
         **kwargs,
     ):
+        chunks = [
+            chunk
+            for chunk, _ in self.infer_panel_naive_stream(
+                x,
+                x_lens,
+                prompts,
+                bert_feature,
+                top_k,
+                top_p,
+                early_stop_num,
+                temperature,
+                repetition_penalty,
+                chunk_length=-1,
+                **kwargs,
+            )
+        ]
+        y = torch.concat(chunks, dim=1)
+        if prompts is None:
+            return y, 0
+        idx = y.shape[1]
+        return torch.concat([prompts, y], dim=1), idx
+
+    def infer_panel_naive_stream(
+        self,
+        x: torch.LongTensor,  #####全部文本token
+        x_lens: torch.LongTensor,
+        prompts: torch.LongTensor,  ####参考音频token
+        bert_feature: torch.LongTensor,
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        chunk_length: int = 25,
+        **kwargs,
+    ):
+        """
+        Generator version of ``infer_panel_naive``.
+        Yields ``(tokens, is_last)`` where ``tokens`` [bsz, n] are the newly generated semantic tokens
+        (without the prompt and EOS), every ``chunk_length`` tokens; ``chunk_length <= 0`` yields once at the end.
+        """
         x = self.ar_text_embedding(x)
         x = x + self.bert_proj(bert_feature.transpose(1, 2))
         x = self.ar_text_position(x)
@@ -832,12 +1359,13 @@ class Text2SemanticDecoder(nn.Module):
         y = prompts
 
         x_len = x.shape[1]
-        x_attn_mask = torch.zeros((x_len, x_len), dtype=torch.bool)
         stop = False
         # print(1111111,self.num_layers)
 
-        k_cache = None
-        v_cache = None
+        kv_cache: T2SKVCache = None
+        max_kv_cache_len = kwargs.get("max_kv_cache_len", -1)
+        ### 每步调用一次，请求被取消或超时时抛出异常终止解码
+        cancel_check = kwargs.get("cancel_check", None)
         ###################  first step ##########################
         if y is not None:
             y_emb = self.ar_audio_embedding(y)
@@ -845,7 +1373,6 @@ class Text2SemanticDecoder(nn.Module):
             prefix_len = y.shape[1]
             y_pos = self.ar_audio_position(y_emb)
             xy_pos = torch.concat([x, y_pos], dim=1)
-            ref_free = False
         else:
             y_emb = None
             y_len = 0
@@ -853,59 +1380,93 @@ class Text2SemanticDecoder(nn.Module):
             y_pos = None
             xy_pos = x
             y = torch.zeros(x.shape[0], 0, dtype=torch.int, device=x.device)
-            ref_free = True
 
-        bsz = x.shape[0]
+        ### 没有padding，文本双向、语义因果的attention由process_prompt_prefix_lm根据x_len处理，不需要mask
         src_len = x_len + y_len
-        x_attn_mask_pad = F.pad(
-            x_attn_mask,
-            (0, y_len),  ###xx的纯0扩展到xx纯0+xy纯1，(x,x+y)
-            value=True,
-        )
-        y_attn_mask = F.pad(  ###yy的右上1扩展到左边xy的0,(y,x+y)
-            torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1),
-            (x_len, 0),
-            value=False,
-        )
-        xy_attn_mask = (
-            torch.concat([x_attn_mask_pad, y_attn_mask], dim=0)
-            .unsqueeze(0)
-            .expand(bsz * self.num_head, -1, -1)
-            .view(bsz, self.num_head, src_len, src_len)
-            .to(device=x.device, dtype=torch.bool)
-        )
 
+        speculative_steps = kwargs.get("speculative_steps", 0)
+        if speculative_steps > 0 and x.shape[0] == 1:
+            yield from self._decode_stream_speculative(
+                xy_pos,
+                x_len,
+                y,
+                src_len,
+                y_len,
+                prefix_len,
+                top_k=top_k,
+                top_p=top_p,
+                early_stop_num=early_stop_num,
+                temperature=temperature,
+                repetition_penalty=repetition_penalty,
+                chunk_length=chunk_length,
+                max_kv_cache_len=max_kv_cache_len,
+                speculative_steps=speculative_steps,
+                draft_layers=kwargs.get("draft_layers", 8),
+                cancel_check=cancel_check,
+            )
+            return
+
+        sync_interval = kwargs.get("sync_interval", 0)
+        if sync_interval > 0:
+            yield from self._decode_stream_deferred_eos(
+                xy_pos,
+                x_len,
+                y,
+                src_len,
+                y_len,
+                prefix_len,
+                top_k=top_k,
+                top_p=top_p,
+                early_stop_num=early_stop_num,
+                temperature=temperature,
+                repetition_penalty=repetition_penalty,
+                chunk_length=chunk_length,
+                max_kv_cache_len=max_kv_cache_len,
+                sync_interval=sync_interval,
+                cancel_check=cancel_check,
+            )
+            return
+
+        ### 最后一步采样得到的token(EOS或提前停止时的token)不输出，与infer_panel_naive的y[:, :-1]一致
+        pending_start = y.shape[1]
+        sampler = T2SSampler(y, y.shape[0], self.vocab_size, y.device, top_k, top_p, temperature, repetition_penalty)
         for idx in tqdm(range(1500)):
-            if xy_attn_mask is not None:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None)
+            if cancel_check is not None:
+                cancel_check()
+            if idx == 0:
+                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt_prefix_lm(xy_pos, x_len)
+                kv_cache = T2SKVCache(
+                    k_cache, v_cache, get_kv_cache_len(src_len, early_stop_num, max_cache_len=max_kv_cache_len)
+                )
             else:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache)
+                xy_dec = self.t2s_transformer.decode_next_token_static(
+                    xy_pos, kv_cache.k_cache, kv_cache.v_cache, kv_cache.length
+                )
+                kv_cache.advance()
 
             logits = self.ar_predict_layer(xy_dec[:, -1])
 
-            if idx == 0:
-                xy_attn_mask = None
             if idx < 11:  ###至少预测出10个token不然不给停止（0.4s）
                 logits = logits[:, :-1]
 
-            samples = sample(
-                logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
-            )[0]
+            samples, logits = sampler(logits)
 
             y = torch.concat([y, samples], dim=1)
 
-            if early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num:
+            if (early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num) or kv_cache.is_full():
                 print("use early stop num:", early_stop_num)
                 stop = True
 
             if torch.argmax(logits, dim=-1)[0] == self.EOS or samples[0, 0] == self.EOS:
                 stop = True
-            if stop:
-                if y.shape[1] == 0:
-                    y = torch.concat([y, torch.zeros_like(samples)], dim=1)
-                    print("bad zero prediction")
+            if stop or idx == 1499:
                 print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
-                break
+                yield y[:, pending_start:-1], True
+                return
+
+            if chunk_length > 0 and y.shape[1] - pending_start >= chunk_length:
+                yield y[:, pending_start:], False
+                pending_start = y.shape[1]
 
             ####################### update next step ###################################
             y_emb = self.ar_audio_embedding(y[:, -1:])
@@ -913,9 +1474,243 @@ class Text2SemanticDecoder(nn.Module):
                 :, y_len + idx
             ].to(dtype=y_emb.dtype, device=y_emb.device)
 
-        if ref_free:
-            return y[:, :-1], 0
-        return y[:, :-1], idx
+    def _decode_stream_deferred_eos(
+        self,
+        xy_pos: torch.Tensor,
+        x_len: int,
+        y: torch.LongTensor,
+        src_len: int,
+        y_len: int,
+        prefix_len: int,
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        chunk_length: int = 25,
+        max_kv_cache_len: int = -1,
+        sync_interval: int = 8,
+        cancel_check=None,
+        max_steps: int = 1500,
+    ):
+        """
+        Decode loop of ``infer_panel_naive_stream`` reading EOS back only every ``sync_interval`` steps, chunks are
+        yielded at those checks. Stops on the EOS of the first row, like the per-step loop.
+        """
+        bsz = xy_pos.shape[0]
+        device = xy_pos.device
+        y_buffer = torch.zeros((bsz, y.shape[1] + max_steps), dtype=torch.long, device=device)
+        y_buffer[:, : y.shape[1]] = y
+        y_length = y.shape[1]
+        pending_start = y_length
+        ### 第一个EOS在y_buffer中的位置，-1为还未结束
+        eos_position = torch.full((bsz,), -1, dtype=torch.long, device=device)
+        finished = torch.zeros((bsz,), dtype=torch.bool, device=device)
+
+        kv_cache: T2SKVCache = None
+        sampler = T2SSampler(y, bsz, self.vocab_size, device, top_k, top_p, temperature, repetition_penalty)
+        for idx in range(max_steps):
+            if cancel_check is not None:
+                cancel_check()
+            if idx == 0:
+                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt_prefix_lm(xy_pos, x_len)
+                kv_cache = T2SKVCache(
+                    k_cache, v_cache, get_kv_cache_len(src_len, early_stop_num, max_steps, max_kv_cache_len)
+                )
+            else:
+                xy_dec = self.t2s_transformer.decode_next_token_static(
+                    xy_pos, kv_cache.k_cache, kv_cache.v_cache, kv_cache.length
+                )
+                kv_cache.advance()
+
+            logits = self.ar_predict_layer(xy_dec[:, -1])
+            if idx < 11:  ###至少预测出10个token不然不给停止（0.4s）
+                logits = logits[:, :-1]
+
+            samples, logits = sampler(logits)
+            y_buffer[:, y_length] = samples[:, 0]
+            y_length += 1
+
+            eos = (samples[:, 0] == self.EOS).logical_or(torch.argmax(logits, dim=-1) == self.EOS)
+            eos_position.masked_fill_(eos.logical_and(finished.logical_not()), y_length - 1)
+            finished.logical_or_(eos)
+
+            force_stop = (
+                (early_stop_num != -1 and y_length - prefix_len > early_stop_num)
+                or idx == max_steps - 1
+                or kv_cache.is_full()
+            )
+            if force_stop or (idx + 1) % sync_interval == 0:
+                end = eos_position[0].item()
+                if end != -1 or force_stop:
+                    end = end if end != -1 else y_length - 1
+                    print(f"T2S Decoding EOS [{prefix_len} -> {end + 1}] in {idx + 1} steps")
+                    yield y_buffer[:, pending_start:end], True
+                    return
+                if chunk_length > 0 and y_length - pending_start >= chunk_length:
+                    yield y_buffer[:, pending_start:y_length], False
+                    pending_start = y_length
+
+            ####################### update next step ###################################
+            y_emb = self.ar_audio_embedding(y_buffer[:, y_length - 1 : y_length])
+            xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[
+                :, y_len + idx
+            ].to(dtype=y_emb.dtype, device=y_emb.device)
+
+    def _decode_stream_speculative(
+        self,
+        xy_pos: torch.Tensor,
+        x_len: int,
+        y: torch.LongTensor,
+        src_len: int,
+        y_len: int,
+        prefix_len: int,
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        chunk_length: int = 25,
+        max_kv_cache_len: int = -1,
+        speculative_steps: int = 4,
+        draft_layers: int = 8,
+        cancel_check=None,
+        max_steps: int = 1500,
+    ):
+        """
+        Self-speculative decode loop of ``infer_panel_naive_stream`` for one sequence. The first ``draft_layers``
+        blocks plus ``ar_predict_layer`` draft up to ``speculative_steps`` tokens, the remaining blocks verify them
+        in one forward on the hidden states of the draft. The draft blocks are the first blocks of the model, so
+        their kv cache is the one of the full model and nothing is recomputed for them.
+
+        A draft token d is accepted with probability min(1, p(d) / q(d)), p and q being the sampling distributions
+        (``logits_to_probs``) of the full model and of the draft. The first rejected one is replaced by a sample
+        of max(0, p - q), and when all are accepted one more token is sampled from p, so the tokens follow the
+        distribution of the per-step loop. Stops and chunks like ``infer_panel_naive_stream``.
+        """
+        transformer = self.t2s_transformer
+        draft_layers = min(max(draft_layers, 1), transformer.num_blocks - 1)
+        sampling_kwargs = {
+            "top_k": top_k,
+            "top_p": top_p,
+            "temperature": temperature,
+            "repetition_penalty": repetition_penalty,
+        }
+
+        def embed(token: torch.Tensor, index: int) -> torch.Tensor:
+            ### 第index个生成的token作为下一步的输入
+            y_emb = self.ar_audio_embedding(token.view(1, 1))
+            return y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[
+                :, y_len + index
+            ].to(dtype=y_emb.dtype, device=y_emb.device)
+
+        def filter_eos(logits: torch.Tensor, index: int) -> torch.Tensor:
+            return logits[:, :-1] if index < 11 else logits  ###至少预测出10个token不然不给停止（0.4s）
+
+        rounds = proposed = accepted = 0
+        pending_start = y.shape[1]
+        xy_dec, k_cache, v_cache = transformer.process_prompt_prefix_lm(xy_pos, x_len)
+        kv_cache = T2SKVCache(k_cache, v_cache, get_kv_cache_len(src_len, early_stop_num, max_steps, max_kv_cache_len))
+        logits = filter_eos(self.ar_predict_layer(xy_dec[:, -1]), 0)
+        ### 待输出的(采样用的logits, token)，每轮为接受的草稿token加上最后重新采样的一个
+        pending = [(logits, multinomial_sample_one_no_sync(logits_to_probs(logits, y, **sampling_kwargs)))]
+        idx = -1
+        while True:
+            for logits, token in pending:
+                idx += 1
+                y = torch.concat([y, token], dim=1)
+                stop = (early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num) or (
+                    src_len + idx >= kv_cache.max_len
+                )
+                if torch.argmax(logits, dim=-1)[0] == self.EOS or token[0, 0] == self.EOS:
+                    stop = True
+                if stop or idx == max_steps - 1:
+                    print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
+                    print(
+                        f"speculative decoding: {accepted}/{proposed} draft tokens accepted, "
+                        f"{(idx + 1) / (rounds + 1):.2f} tokens per full forward"
+                    )
+                    with _speculative_stats_lock:
+                        self.speculative_stats["rounds"] += rounds + 1
+                        self.speculative_stats["proposed"] += proposed
+                        self.speculative_stats["accepted"] += accepted
+                        self.speculative_stats["tokens"] += idx + 1
+                    yield y[:, pending_start:-1], True
+                    return
+                if chunk_length > 0 and y.shape[1] - pending_start >= chunk_length:
+                    yield y[:, pending_start:], False
+                    pending_start = y.shape[1]
+
+            if cancel_check is not None:
+                cancel_check()
+            ####################### draft ###################################
+            ### 缓存中已写入第idx-1个及之前的token，第idx个token和草稿依次写在其后，不能超出缓存
+            cache_len = kv_cache.length
+            num_draft = min(speculative_steps, kv_cache.max_len - cache_len - 1)
+            xy_pos = embed(pending[-1][1], idx)
+            history = y
+            hidden_list: List[torch.Tensor] = []
+            draft_tokens: List[torch.Tensor] = []
+            draft_probs: List[torch.Tensor] = []
+            for i in range(num_draft + 1):
+                hidden = transformer.decode_next_token_layers(
+                    xy_pos, kv_cache.k_cache, kv_cache.v_cache, cache_len + i, 0, draft_layers
+                )
+                hidden_list.append(hidden)
+                if i == num_draft:
+                    break
+                logits = filter_eos(self.ar_predict_layer(hidden[:, -1]), idx + 1 + i)
+                q = logits_to_probs(logits, history, **sampling_kwargs)
+                draft = multinomial_sample_one_no_sync(q)
+                draft_tokens.append(draft)
+                draft_probs.append(q)
+                history = torch.concat([history, draft], dim=1)
+                xy_pos = embed(draft, idx + 1 + i)
+
+            ####################### verify ###################################
+            num_new = num_draft + 1
+            attn_mask = None
+            if num_new > 1:
+                ### 新写入的几个位置之间为因果attention
+                positions = torch.arange(cache_len + num_new, device=xy_pos.device)
+                attn_mask = (positions.view(1, -1) > (cache_len + positions[:num_new]).view(-1, 1)).view(
+                    1, 1, num_new, cache_len + num_new
+                )
+            hidden = transformer.decode_next_token_layers(
+                torch.concat(hidden_list, dim=1),
+                kv_cache.k_cache,
+                kv_cache.v_cache,
+                cache_len,
+                draft_layers,
+                transformer.num_blocks,
+                attn_mask,
+            )
+            verify_logits = self.ar_predict_layer(hidden[0])
+            rounds += 1
+            proposed += num_draft
+
+            pending = []
+            history = y
+            for i in range(num_new):
+                logits = filter_eos(verify_logits[i : i + 1], idx + 1 + i)
+                p = logits_to_probs(logits, history, **sampling_kwargs)
+                if i == num_draft:
+                    ### 草稿全部被接受，从最后一个位置再采样一个token
+                    pending.append((logits, multinomial_sample_one_no_sync(p)))
+                    break
+                draft = draft_tokens[i]
+                q = draft_probs[i]
+                draft_id = int(draft[0, 0])
+                if torch.rand((), device=p.device) * q[0, draft_id] <= p[0, draft_id]:
+                    pending.append((logits, draft))
+                    history = torch.concat([history, draft], dim=1)
+                    accepted += 1
+                    continue
+                residual = (p - q).clamp_min(0)
+                pending.append((logits, multinomial_sample_one_no_sync(residual if residual.sum() > 0 else p)))
+                break
+            ### 第idx个token和被接受的草稿已写入缓存，之后的位置下一轮覆盖
+            kv_cache.length = cache_len + len(pending)
 
     def infer_panel(
         self,
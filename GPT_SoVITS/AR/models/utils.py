@@ -199,6 +199,102 @@ def sample(
     return idx_next, probs
 
 
+def sample_groups(logits: torch.Tensor, previous_tokens: torch.LongTensor, groups: dict):
+    """
+    Samples the rows of each group with its own (top_k, top_p, temperature, repetition_penalty).
+    Returns the samples and the argmax of the penalized logits, on which the decode loops test for EOS.
+    """
+    samples = torch.zeros((logits.shape[0],), dtype=torch.long, device=logits.device)
+    tokens = torch.zeros_like(samples)
+    for (top_k, top_p, temperature, repetition_penalty), rows in groups.items():
+        index = torch.tensor(rows, dtype=torch.long, device=logits.device)
+        ### index_select返回副本，sample把repetition_penalty原地施加在副本上，EOS要在副本上判断
+        group_logits = logits.index_select(0, index)
+        group_samples = sample(
+            group_logits,
+            previous_tokens.index_select(0, index),
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            temperature=temperature,
+        )[0]
+        samples.index_copy_(0, index, group_samples[:, 0].long())
+        tokens.index_copy_(0, index, torch.argmax(group_logits, dim=-1))
+    return samples, tokens
+
+
+class T2SSampler:
+    """
+    Stateful ``sample`` for a decode loop, drawing from the same distribution as
+    ``sample(logits, previous_tokens, ...)`` with ``previous_tokens`` the prompt plus everything sampled so far.
+
+    - The repetition penalty reads a [B, vocab_size] presence buffer instead of gathering the whole history,
+      the buffer is updated with one scatter per step.
+    - top-k is taken first, top-p then only accumulates the k candidates: the kept set of ``logits_to_probs``
+      is always a prefix of the sorted logits, top-p being computed on the full vocabulary before the
+      temperature, so cutting that prefix at k or at the top-p boundary gives the same set.
+    - Temperature, softmax and the exponential sampling of ``multinomial_sample_one_no_sync`` are fused into one
+      argmax over the candidates: argmax(softmax(v / T) / q) == argmax(v / T - log(q)).
+
+    Tokens tied with the k-th largest logit are kept by ``logits_to_probs`` but not here, which only matters for
+    exactly equal logits. ``sample`` applies the repetition penalty to ``logits`` in place and the decode loops
+    test EOS on them, so the call returns the penalized logits for that test.
+    """
+
+    def __init__(
+        self,
+        prompts: Optional[torch.Tensor],
+        batch_size: int,
+        vocab_size: int,
+        device,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.0,
+    ):
+        self.top_k = top_k if top_k is not None and top_k > 0 else None
+        self.top_p = top_p if top_p is not None and top_p < 1.0 else None
+        self.temperature = max(temperature, 1e-5)
+        self.repetition_penalty = repetition_penalty
+        self.presence: Optional[torch.Tensor] = None
+        if repetition_penalty != 1.0:
+            self.presence = torch.zeros((batch_size, vocab_size), dtype=torch.bool, device=device)
+            if prompts is not None and prompts.shape[1] > 0:
+                self.presence.scatter_(1, prompts.long(), True)
+
+    def __call__(self, logits: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Samples one token per row of ``logits`` [B, V] (V may be smaller than the vocabulary, e.g. without EOS)
+        and records the tokens for the repetition penalty. Returns the tokens [B, 1] like ``sample(...)[0]`` and
+        the logits after the repetition penalty, i.e. ``logits`` as left by ``sample``.
+        """
+        if self.presence is not None:
+            penalized = torch.where(logits < 0, logits * self.repetition_penalty, logits / self.repetition_penalty)
+            logits = torch.where(self.presence[:, : logits.shape[1]], penalized, logits)
+
+        k = logits.shape[1] if self.top_k is None else min(self.top_k, logits.shape[1])
+        values, indices = torch.topk(logits, k)
+        if self.top_p is not None:
+            cum_probs = torch.cumsum(torch.exp(values - torch.logsumexp(logits, dim=-1, keepdim=True)), dim=-1)
+            to_remove = cum_probs > self.top_p
+            to_remove[:, 0] = False  # keep at least one option
+            values = values.masked_fill(to_remove, -float("Inf"))
+
+        q = torch.empty_like(values).exponential_(1)
+        choice = torch.argmax(values / self.temperature - torch.log(q), dim=-1, keepdim=True)
+        samples = torch.gather(indices, 1, choice)
+        if self.presence is not None:
+            self.presence.scatter_(1, samples, True)
+        return samples.to(dtype=torch.int), logits
+
+    def select(self, index: torch.Tensor):
+        """
+        Keeps the rows in ``index``, when finished sequences are removed from the batch.
+        """
+        if self.presence is not None:
+            self.presence = torch.index_select(self.presence, dim=0, index=index)
+
+
 def dpo_loss(
     policy_chosen_logps: torch.FloatTensor,
     policy_rejected_logps: torch.FloatTensor,
@@ -0,0 +1,330 @@
+import queue
+import threading
+import traceback
+from typing import Callable, List, Optional, Tuple
+
+import torch
+
+from AR.models.kv_cache import T2SRaggedKVCache
+from AR.models.t2s_model import Text2SemanticDecoder
+from AR.models.utils import sample, sample_groups
+
+
+class T2SSequence:
+    """
+    One sequence to be decoded by the scheduler, carrying its own prompt and sampling params.
+    """
+
+    def __init__(
+        self,
+        x: torch.LongTensor,
+        bert_feature: torch.Tensor,
+        prompt: torch.LongTensor,
+        top_k: int = 5,
+        top_p: float = 1.0,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        early_stop_num: int = -1,
+        cancel_check: Callable[[], None] = None,
+    ):
+        self.x = x  # [x_len]
+        self.bert_feature = bert_feature  # [1024, x_len]
+        self.prompt = prompt  # [prompt_len]
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.early_stop_num = early_stop_num
+        ### 抛出异常时该序列被移出batch，其余序列继续解码
+        self.cancel_check = cancel_check
+
+        self.prompt_len: int = prompt.shape[-1]
+        self.step: int = 0
+        self.y_len: int = 0
+
+        self.result: Optional[torch.LongTensor] = None
+        self.idx: Optional[int] = None
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+
+    @property
+    def sampling_key(self) -> Tuple:
+        return (self.top_k, self.top_p, self.temperature, self.repetition_penalty)
+
+    def check_cancelled(self) -> bool:
+        """
+        Finishes the sequence with the error of ``cancel_check`` if its request was cancelled.
+        """
+        if self.cancel_check is None:
+            return False
+        try:
+            self.cancel_check()
+        except Exception as e:
+            self.finish(error=e)
+            return True
+        return False
+
+    def finish(self, result: torch.LongTensor = None, idx: int = None, error: Exception = None):
+        self.result = result
+        self.idx = idx
+        self.error = error
+        self.done.set()
+
+    def wait(self) -> Tuple[torch.LongTensor, int]:
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result, self.idx
+
+
+class T2SScheduler:
+    """
+    Iteration-level (continuous) batching for the T2S decoder.
+
+    Sequences from any number of concurrent requests are submitted with ``submit``. A background
+    thread owns the running batch: at every token step boundary it admits waiting sequences (after
+    a single-sequence prefill) and evicts the finished ones, so the batch does not shrink towards
+    one while other requests are waiting.
+    """
+
+    def __init__(
+        self,
+        model: Text2SemanticDecoder,
+        max_batch_size: int = 8,
+        max_len: int = 2048,
+        max_steps: int = 1500,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_len = max_len
+        self.max_steps = max_steps
+
+        self.waiting: "queue.Queue[T2SSequence]" = queue.Queue()
+        self.running: List[T2SSequence] = []
+        self.kv_cache: T2SRaggedKVCache = None
+        self.y_buffer: torch.LongTensor = None
+        self.last_tokens: torch.LongTensor = None
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._loop, name="T2SScheduler", daemon=True)
+        self.thread.start()
+
+    def set_model(self, model: Text2SemanticDecoder):
+        with self.lock:
+            self.model = model
+            for seq in self.running:
+                seq.finish(error=RuntimeError("T2S model changed during decoding"))
+            self.running = []
+            self.kv_cache = None
+
+    def submit(self, seq: T2SSequence) -> T2SSequence:
+        self.waiting.put(seq)
+        return seq
+
+    def infer_panel(
+        self,
+        x: List[torch.LongTensor],  #####全部文本token
+        x_lens: torch.LongTensor,
+        prompts: torch.LongTensor,  ####参考音频token
+        bert_feature: List[torch.Tensor],
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        **kwargs,
+    ):
+        """
+        Same inputs and outputs as ``Text2SemanticDecoder.infer_panel_batch_infer``, but the rows are
+        decoded in the shared running batch.
+        """
+        seqs = [
+            self.submit(
+                T2SSequence(
+                    x[i],
+                    bert_feature[i],
+                    prompts[i],
+                    top_k=top_k,
+                    top_p=top_p,
+                    temperature=temperature,
+                    repetition_penalty=repetition_penalty,
+                    early_stop_num=early_stop_num,
+                    cancel_check=kwargs.get("cancel_check", None),
+                )
+            )
+            for i in range(len(x))
+        ]
+        y_list = []
+        idx_list = []
+        for seq in seqs:
+            y, idx = seq.wait()
+            y_list.append(y)
+            idx_list.append(idx)
+        return y_list, idx_list
+
+    def _loop(self):
+        while True:
+            first = None
+            if len(self.running) == 0:
+                ### 没有正在解码的序列时阻塞等待新的请求
+                first = self.waiting.get()
+            try:
+                with self.lock, torch.no_grad():
+                    self._drop_cancelled()
+                    self._admit(first)
+                    if len(self.running) > 0:
+                        self._step()
+            except Exception as e:
+                traceback.print_exc()
+                with self.lock:
+                    for seq in self.running:
+                        seq.finish(error=e)
+                    self.running = []
+                    self.kv_cache = None
+
+    def _allocate(self, dtype: torch.dtype, device: torch.device):
+        model = self.model
+        self.kv_cache = T2SRaggedKVCache(
+            model.num_layers, self.max_batch_size, self.max_len, model.model_dim, dtype, device
+        )
+        self.y_buffer = torch.zeros((self.max_batch_size, self.max_len), dtype=torch.long, device=device)
+        self.last_tokens = torch.zeros((self.max_batch_size,), dtype=torch.long, device=device)
+
+    def _admit(self, first: T2SSequence = None):
+        while len(self.running) < self.max_batch_size:
+            if first is not None:
+                seq, first = first, None
+            else:
+                try:
+                    seq = self.waiting.get_nowait()
+                except queue.Empty:
+                    return
+            if seq.check_cancelled():
+                continue
+            try:
+                self._prefill(seq)
+            except Exception as e:
+                traceback.print_exc()
+                seq.finish(error=e)
+
+    def _drop_cancelled(self):
+        ### 已取消的序列立即释放其kv cache行，不再占用batch
+        rows = [row for row, seq in enumerate(self.running) if seq.check_cancelled()]
+        if len(rows) > 0:
+            self._evict(rows)
+
+    def _prefill(self, seq: T2SSequence):
+        model = self.model
+        x = seq.x.unsqueeze(0)
+        device = x.device
+        x_emb = model.ar_text_embedding(x)
+        x_emb = x_emb + model.bert_proj(seq.bert_feature.transpose(0, 1).unsqueeze(0))
+        x_emb = model.ar_text_position(x_emb)
+
+        prompt = seq.prompt.unsqueeze(0).to(device)
+        y_emb = model.ar_audio_embedding(prompt)
+        y_pos = model.ar_audio_position(y_emb)
+        xy_pos = torch.concat([x_emb, y_pos], dim=1)
+
+        x_len = x_emb.shape[1]
+        y_len = prompt.shape[1]
+        src_len = x_len + y_len
+        if self.kv_cache is None or (self.kv_cache.batch_size == 0 and self.kv_cache.dtype != xy_pos.dtype):
+            self._allocate(xy_pos.dtype, device)
+        if not self.kv_cache.can_admit(src_len):
+            raise ValueError(f"T2S prompt length {src_len} exceeds the scheduler cache length {self.max_len}")
+
+        ### 单条序列没有padding，不需要构造[src_len, src_len]的mask
+        xy_dec, k_cache, v_cache = model.t2s_transformer.process_prompt_prefix_lm(xy_pos, x_len)
+        logits = model.ar_predict_layer(xy_dec[:, -1])
+        # 第一步不允许生成EOS
+        logits[:, model.EOS] = -float("inf")
+        samples = sample(
+            logits,
+            prompt,
+            top_k=seq.top_k,
+            top_p=seq.top_p,
+            repetition_penalty=seq.repetition_penalty,
+            temperature=seq.temperature,
+        )[0]
+
+        row = self.kv_cache.admit(k_cache, v_cache)
+        ### y_buffer中未使用的位置用该序列的第一个token填充，不影响repetition_penalty
+        self.y_buffer[row].fill_(seq.prompt[0].item())
+        self.y_buffer[row, :y_len].copy_(prompt[0])
+        self.y_buffer[row, y_len] = samples[0, 0]
+        self.last_tokens[row] = samples[0, 0]
+        seq.y_len = y_len + 1
+        seq.step = 0
+        self.running.append(seq)
+
+        if self._should_stop(seq, row):
+            self._evict([row])
+
+    def _should_stop(self, seq: T2SSequence, row: int) -> bool:
+        generated = seq.y_len - seq.prompt_len
+        if seq.early_stop_num != -1 and generated > seq.early_stop_num:
+            return True
+        return seq.step >= self.max_steps - 1 or self.kv_cache.is_full(row) or seq.y_len >= self.max_len
+
+    def _step(self):
+        model = self.model
+        kv_cache = self.kv_cache
+        batch_size = kv_cache.batch_size
+        device = self.y_buffer.device
+
+        cache_lens = torch.tensor(kv_cache.lengths, dtype=torch.long, device=device)
+        audio_pos = torch.tensor([seq.y_len - 1 for seq in self.running], dtype=torch.long, device=device)
+        kv_len = max(kv_cache.lengths) + 1
+        batch_index = torch.arange(batch_size, device=device)
+        attn_mask = (torch.arange(kv_len, device=device).unsqueeze(0) <= cache_lens.unsqueeze(1)).view(
+            batch_size, 1, 1, kv_len
+        )
+        # attn_mask 中 True 表示需要被屏蔽的位置
+        attn_mask = ~attn_mask
+
+        y_emb = model.ar_audio_embedding(self.last_tokens[:batch_size].unsqueeze(1))
+        pe = model.ar_audio_position.pe[0].to(dtype=y_emb.dtype, device=device)
+        xy_pos = y_emb * model.ar_audio_position.x_scale + model.ar_audio_position.alpha * pe[audio_pos].unsqueeze(1)
+
+        xy_dec = model.t2s_transformer.decode_next_token_ragged(
+            xy_pos, kv_cache.k_cache, kv_cache.v_cache, batch_index, cache_lens, kv_len, attn_mask
+        )
+        kv_cache.advance()
+        logits = model.ar_predict_layer(xy_dec[:, -1])
+
+        ###### 按采样参数分组采样 ######
+        groups = {}
+        for row, seq in enumerate(self.running):
+            groups.setdefault(seq.sampling_key, []).append(row)
+        y_max_len = max(seq.y_len for seq in self.running)
+        samples, tokens = sample_groups(logits, self.y_buffer[:, :y_max_len], groups)
+        eos = (samples == model.EOS).logical_or(tokens == model.EOS).tolist()
+
+        y_lens = torch.tensor([seq.y_len for seq in self.running], dtype=torch.long, device=device)
+        self.y_buffer[batch_index, y_lens] = samples
+        self.last_tokens[:batch_size] = samples
+
+        finished = []
+        for row, seq in enumerate(self.running):
+            seq.y_len += 1
+            seq.step += 1
+            if eos[row] or self._should_stop(seq, row):
+                finished.append(row)
+        if len(finished) > 0:
+            self._evict(finished)
+
+    def _evict(self, rows: List[int]):
+        for row in rows:
+            seq = self.running[row]
+            if seq.done.is_set():
+                ### 已取消
+                continue
+            ### 与infer_panel_batch_infer一致，返回去掉最后一个token的y以及最后一步的idx
+            seq.finish(self.y_buffer[row, : seq.y_len - 1].clone(), seq.step)
+        order = self.kv_cache.remove(rows)
+        for new_row, old_row in enumerate(order):
+            if new_row != old_row:
+                self.y_buffer[new_row].copy_(self.y_buffer[old_row])
+                self.last_tokens[new_row] = self.last_tokens[old_row]
+        self.running = [self.running[old_row] for old_row in order]
@@ -3,20 +3,19 @@ import math
 import os
 import random
 import sys
+import threading
 import time
 import traceback
 from copy import deepcopy
 
-import torchaudio
 from tqdm import tqdm
 
 now_dir = os.getcwd()
 sys.path.append(now_dir)
 import os
-from typing import List, Tuple, Union
+from typing import Generator, List, Tuple, Union
 
 import ffmpeg
-import librosa
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -30,11 +29,26 @@ from peft import LoraConfig, get_peft_model
 from process_ckpt import get_sovits_version_from_path_fast, load_sovits_new
 from transformers import AutoModelForMaskedLM, AutoTokenizer
 
+from tools import metrics
 from tools.audio_sr import AP_BWE
+from tools.cancellation import CancelToken, InferenceCancelled
 from tools.i18n.i18n import I18nAuto, scan_language_list
-from tools.my_utils import load_audio
+from tools.ref_audio import RefAudio, load_ref_audio
+from tools.ref_audio import resample as ref_audio_resample
+from TTS_infer_pack.T2SScheduler import T2SScheduler
 from TTS_infer_pack.text_segmentation_method import splits
 from TTS_infer_pack.TextPreprocessor import TextPreprocessor
+from TTS_infer_pack.text_feature_cache import TextFeatureCache
+from TTS_infer_pack.prompt_cache import PromptCacheLRU, get_file_hash, make_prompt_cache_entry
+from TTS_infer_pack.voice_pack import (
+    VOICE_PACK_FIELDS,
+    VOICE_PACK_FORMAT_VERSION,
+    check_voice_pack,
+    get_voice_pack_key,
+    get_voice_pack_path,
+    load_voice_pack,
+    save_voice_pack,
+)
 
 language = os.environ.get("language", "Auto")
 language = sys.argv[-1] if sys.argv[-1] in scan_language_list() else language
@@ -89,14 +103,8 @@ def speed_change(input_audio: np.ndarray, speed: float, sr: int):
     return processed_audio
 
 
-resample_transform_dict = {}
-
-
 def resample(audio_tensor, sr0, device):
-    global resample_transform_dict
-    if sr0 not in resample_transform_dict:
-        resample_transform_dict[sr0] = torchaudio.transforms.Resample(sr0, 24000).to(device)
-    return resample_transform_dict[sr0](audio_tensor)
+    return ref_audio_resample(audio_tensor.to(device), sr0, 24000)
 
 
 class DictToAttrRecursive(dict):
@@ -295,6 +303,21 @@ class TTS_Config:
         self.vits_weights_path = self.configs.get("vits_weights_path", None)
         self.bert_base_path = self.configs.get("bert_base_path", None)
         self.cnhuhbert_base_path = self.configs.get("cnhuhbert_base_path", None)
+        self.continuous_batching: bool = self.configs.get("continuous_batching", False)
+        self.continuous_batching_max_batch_size: int = self.configs.get("continuous_batching_max_batch_size", 8)
+        self.continuous_batching_max_len: int = self.configs.get("continuous_batching_max_len", 2048)
+        self.voice_pack_dir: str = self.configs.get("voice_pack_dir", "voice_packs")
+        self.prompt_cache_size: int = self.configs.get("prompt_cache_size", 8)
+        self.prompt_cache_max_mb: int = self.configs.get("prompt_cache_max_mb", 512)
+        self.text_cache_max_mb: int = self.configs.get("text_cache_max_mb", 256)
+        self.text_cache_dir: str = self.configs.get("text_cache_dir", None)
+        ### 大于0时T2S解码每隔这么多步才读回一次EOS状态，避免每步的设备同步，0为每步检查
+        self.t2s_sync_interval: int = self.configs.get("t2s_sync_interval", 0)
+        ### 批量推理时把长度不一的文本打包做prefill，不在左侧padding上计算，batch_threshold可以设得更低
+        self.t2s_packed_prefill: bool = self.configs.get("t2s_packed_prefill", False)
+        ### 大于0时逐条(非并行)推理使用投机解码：前t2s_draft_layers层起草这么多个token，其余层一次验证
+        self.t2s_speculative_steps: int = self.configs.get("t2s_speculative_steps", 0)
+        self.t2s_draft_layers: int = self.configs.get("t2s_draft_layers", 8)
         self.languages = self.v1_languages if self.version == "v1" else self.v2_languages
 
         self.is_v3_synthesizer: bool = False
@@ -353,6 +376,18 @@ class TTS_Config:
             "vits_weights_path": self.vits_weights_path,
             "bert_base_path": self.bert_base_path,
             "cnhuhbert_base_path": self.cnhuhbert_base_path,
+            "continuous_batching": self.continuous_batching,
+            "continuous_batching_max_batch_size": self.continuous_batching_max_batch_size,
+            "continuous_batching_max_len": self.continuous_batching_max_len,
+            "voice_pack_dir": self.voice_pack_dir,
+            "prompt_cache_size": self.prompt_cache_size,
+            "prompt_cache_max_mb": self.prompt_cache_max_mb,
+            "text_cache_max_mb": self.text_cache_max_mb,
+            "text_cache_dir": self.text_cache_dir,
+            "t2s_sync_interval": self.t2s_sync_interval,
+            "t2s_packed_prefill": self.t2s_packed_prefill,
+            "t2s_speculative_steps": self.t2s_speculative_steps,
+            "t2s_draft_layers": self.t2s_draft_layers,
         }
         return self.config
 
@@ -393,17 +428,16 @@ class TTS:
         self.bigvgan_model: BigVGAN = None
         self.sr_model: AP_BWE = None
         self.sr_model_not_exist: bool = False
-
-        self._init_models()
-
-        self.text_preprocessor: TextPreprocessor = TextPreprocessor(
-            self.bert_model, self.bert_tokenizer, self.configs.device
-        )
+        self.t2s_scheduler: T2SScheduler = None
 
         self.prompt_cache: dict = {
             "ref_audio_path": None,
             "prompt_semantic": None,
             "refer_spec": [],
+            "refer_ge": None,
+            "fea_ref": None,
+            "mel2": None,
+            "voice_id": None,
             "prompt_text": None,
             "prompt_lang": None,
             "phones": None,
@@ -411,6 +445,28 @@ class TTS:
             "norm_text": None,
             "aux_ref_audio_paths": [],
         }
+        self.prompt_lock = threading.RLock()
+        ### 多音色的prompt缓存，当前使用的音色保存在prompt_cache中
+        self.prompt_cache_lru = PromptCacheLRU(
+            self.configs.prompt_cache_size,
+            self.configs.prompt_cache_max_mb * 1024 * 1024 if self.configs.prompt_cache_max_mb > 0 else -1,
+        )
+
+        self._init_models()
+
+        if self.configs.continuous_batching:
+            self.t2s_scheduler = T2SScheduler(
+                self.t2s_model.model,
+                max_batch_size=self.configs.continuous_batching_max_batch_size,
+                max_len=self.configs.continuous_batching_max_len,
+            )
+
+        self.text_preprocessor: TextPreprocessor = TextPreprocessor(
+            self.bert_model,
+            self.bert_tokenizer,
+            self.configs.device,
+            text_cache=TextFeatureCache(self.configs.text_cache_max_mb, self.configs.text_cache_dir),
+        )
 
         self.stop_flag: bool = False
         self.precision: torch.dtype = torch.float16 if self.configs.is_half else torch.float32
@@ -531,6 +587,13 @@ class TTS:
         self.vits_model = vits_model
         if self.configs.is_half and str(self.configs.device) != "cpu":
             self.vits_model = self.vits_model.half()
+        ### 参考音频的embedding依赖于VITS模型，更换模型后需要重新计算
+        with self.prompt_lock:
+            self.prompt_cache["refer_ge"] = None
+            self.prompt_cache["fea_ref"] = None
+            self.prompt_cache["mel2"] = None
+            self.prompt_cache["voice_id"] = None
+            self.prompt_cache_lru.clear()
 
     def init_t2s_weights(self, weights_path: str):
         print(f"Loading Text2Semantic weights from {weights_path}")
@@ -547,6 +610,8 @@ class TTS:
         self.t2s_model = t2s_model
         if self.configs.is_half and str(self.configs.device) != "cpu":
             self.t2s_model = self.t2s_model.half()
+        if self.t2s_scheduler is not None:
+            self.t2s_scheduler.set_model(self.t2s_model.model)
 
     def init_bigvgan(self):
         if self.bigvgan_model is not None:
@@ -573,6 +638,18 @@ class TTS:
             print(i18n("你没有下载超分模型的参数，因此不进行超分。如想超分请先参照教程把文件下载好"))
             self.sr_model_not_exist = True
 
+    def reset_after_fork(self):
+        """
+        Threads do not survive ``os.fork``, restart the ones owned by the pipeline in the forked process.
+        """
+        self.prompt_lock = threading.RLock()
+        if self.t2s_scheduler is not None:
+            self.t2s_scheduler = T2SScheduler(
+                self.t2s_model.model,
+                max_batch_size=self.configs.continuous_batching_max_batch_size,
+                max_len=self.configs.continuous_batching_max_len,
+            )
+
     def enable_half_precision(self, enable: bool = True, save: bool = True):
         """
         To enable half precision for the TTS model.
@@ -640,28 +717,224 @@ class TTS:
         Args:
             ref_audio_path: str, the path of the reference audio.
         """
-        self._set_prompt_semantic(ref_audio_path)
-        self._set_ref_spec(ref_audio_path)
+        ### 参考音频只解码一次，16k/模型采样率等版本由缓存的重采样核得到
+        ref_audio = load_ref_audio(ref_audio_path)
+        self._set_prompt_semantic(ref_audio)
+        self._set_ref_spec(ref_audio)
         self._set_ref_audio_path(ref_audio_path)
+        self.prompt_cache["voice_id"] = None
 
     def _set_ref_audio_path(self, ref_audio_path):
         self.prompt_cache["ref_audio_path"] = ref_audio_path
 
-    def _set_ref_spec(self, ref_audio_path):
-        spec = self._get_ref_spec(ref_audio_path)
+    def _set_ref_spec(self, ref_audio: Union[str, RefAudio]):
+        if isinstance(ref_audio, str):
+            ref_audio = load_ref_audio(ref_audio)
+        spec = self._get_ref_spec(ref_audio)
         if self.prompt_cache["refer_spec"] in [[], None]:
             self.prompt_cache["refer_spec"] = [spec]
         else:
             self.prompt_cache["refer_spec"][0] = spec
+        self.prompt_cache["raw_audio"] = ref_audio.waveform.to(self.configs.device)
+        self.prompt_cache["raw_sr"] = ref_audio.sr
+        self.prompt_cache["refer_ge"] = None
+        self.prompt_cache["fea_ref"] = None
+        self.prompt_cache["mel2"] = None
+
+    def _set_ref_ge(self):
+        """
+        Compute the reference embedding (ge) once for the current reference spectrograms.
+        v1/v2 models average the embeddings of the main and the auxiliary references, v3 only uses the main one.
+        """
+        refer_spec = [
+            item.to(dtype=self.precision, device=self.configs.device) for item in self.prompt_cache["refer_spec"]
+        ]
+        if self.configs.is_v3_synthesizer:
+            ge = self.vits_model.get_ge(refer_spec[0])
+        else:
+            ge = self.vits_model.get_ge(refer_spec)
+        self.prompt_cache["refer_ge"] = ge
+
+    def _set_aux_ref_audio(self, aux_ref_audio_paths: List[str]):
+        aux_ref_audio_paths = aux_ref_audio_paths if aux_ref_audio_paths is not None else []
+        paths = set(aux_ref_audio_paths) & set(self.prompt_cache["aux_ref_audio_paths"])
+        if len(list(paths)) == len(aux_ref_audio_paths) == len(self.prompt_cache["aux_ref_audio_paths"]):
+            return
+        self.prompt_cache["aux_ref_audio_paths"] = aux_ref_audio_paths
+        self.prompt_cache["refer_spec"] = [self.prompt_cache["refer_spec"][0]]
+        self.prompt_cache["refer_ge"] = None
+        self.prompt_cache["voice_id"] = None
+        for path in aux_ref_audio_paths:
+            if path in [None, ""]:
+                continue
+            if not os.path.exists(path):
+                print(i18n("音频文件不存在，跳过："), path)
+                continue
+            self.prompt_cache["refer_spec"].append(self._get_ref_spec(path))
+
+    def _normalize_prompt_text(self, prompt_text: str, prompt_lang: str) -> str:
+        prompt_text = prompt_text.strip("\n")
+        if prompt_text[-1] not in splits:
+            prompt_text += "。" if prompt_lang != "en" else "."
+        return prompt_text
+
+    def _set_prompt_text(self, prompt_text: str, prompt_lang: str):
+        prompt_text = self._normalize_prompt_text(prompt_text, prompt_lang)
+        if self.prompt_cache["prompt_text"] != prompt_text:
+            phones, bert_features, norm_text = self.text_preprocessor.segment_and_extract_feature_for_text(
+                prompt_text, prompt_lang, self.configs.version
+            )
+            self.prompt_cache["prompt_text"] = prompt_text
+            self.prompt_cache["prompt_lang"] = prompt_lang
+            self.prompt_cache["phones"] = phones
+            self.prompt_cache["bert_features"] = bert_features
+            self.prompt_cache["norm_text"] = norm_text
+            self.prompt_cache["fea_ref"] = None
+            self.prompt_cache["mel2"] = None
+            self.prompt_cache["voice_id"] = None
+
+    def _set_v3_prompt_features(self):
+        """
+        Compute the prompt features of the v3 CFM (fea_ref and mel2) once for the current reference audio and prompt text.
+        """
+        prompt_semantic_tokens = self.prompt_cache["prompt_semantic"].unsqueeze(0).unsqueeze(0).to(self.configs.device)
+        prompt_phones = torch.LongTensor(self.prompt_cache["phones"]).unsqueeze(0).to(self.configs.device)
+        refer_audio_spec = self.prompt_cache["refer_spec"][0].to(dtype=self.precision, device=self.configs.device)
+        refer_ge = self.prompt_cache["refer_ge"].to(dtype=self.precision, device=self.configs.device)
 
-    def _get_ref_spec(self, ref_audio_path):
-        raw_audio, raw_sr = torchaudio.load(ref_audio_path)
-        raw_audio = raw_audio.to(self.configs.device).float()
-        self.prompt_cache["raw_audio"] = raw_audio
-        self.prompt_cache["raw_sr"] = raw_sr
+        fea_ref, _ = self.vits_model.decode_encp(prompt_semantic_tokens, prompt_phones, refer_audio_spec, refer_ge)
+        ref_audio: torch.Tensor = self.prompt_cache["raw_audio"]
+        ref_sr = self.prompt_cache["raw_sr"]
+        if ref_audio is None:
+            raise ValueError("the reference audio of the voice pack is not available, please set ref_audio_path")
+        ref_audio = ref_audio.to(self.configs.device).float()
+        if ref_audio.shape[0] == 2:
+            ref_audio = ref_audio.mean(0).unsqueeze(0)
+        if ref_sr != 24000:
+            ref_audio = resample(ref_audio, ref_sr, self.configs.device)
 
-        audio = load_audio(ref_audio_path, int(self.configs.sampling_rate))
-        audio = torch.FloatTensor(audio)
+        mel2 = mel_fn(ref_audio)
+        mel2 = norm_spec(mel2)
+        T_min = min(mel2.shape[2], fea_ref.shape[2])
+        mel2 = mel2[:, :, :T_min]
+        fea_ref = fea_ref[:, :, :T_min]
+        if T_min > 468:
+            mel2 = mel2[:, :, -468:]
+            fea_ref = fea_ref[:, :, -468:]
+        self.prompt_cache["fea_ref"] = fea_ref
+        self.prompt_cache["mel2"] = mel2.to(self.precision)
+
+    def _set_prompt_features(self):
+        if self.prompt_cache["refer_ge"] is None:
+            self._set_ref_ge()
+        if (
+            self.configs.is_v3_synthesizer
+            and self.prompt_cache["prompt_text"] is not None
+            and self.prompt_cache["fea_ref"] is None
+        ):
+            self._set_v3_prompt_features()
+
+    def _get_prompt_cache_key(
+        self, ref_audio_path: str, aux_ref_audio_paths: List[str], prompt_text: str, prompt_lang: str
+    ) -> tuple:
+        aux_hashes = tuple(
+            sorted(
+                get_file_hash(path)
+                for path in (aux_ref_audio_paths or [])
+                if path not in [None, ""] and os.path.exists(path)
+            )
+        )
+        return (get_file_hash(ref_audio_path), aux_hashes, prompt_text, prompt_lang, self.configs.version)
+
+    def _load_prompt_cache_entry(self, entry: dict, ref_audio_path: str):
+        self.prompt_cache.update(make_prompt_cache_entry(entry))
+        self.prompt_cache["ref_audio_path"] = ref_audio_path
+        self.prompt_cache["voice_id"] = None
+
+    def build_voice_pack(
+        self,
+        ref_audio_path: str,
+        prompt_text: str,
+        prompt_lang: str,
+        aux_ref_audio_paths: List[str] = None,
+        voice_id: str = None,
+    ) -> dict:
+        """
+        Precompute the prompt features of a reference voice, see voice_pack.py.
+        Args:
+            ref_audio_path: str, the path of the reference audio.
+            prompt_text: str, the prompt text of the reference audio, can be empty (not for v3 models).
+            prompt_lang: str, the language of the prompt text.
+            aux_ref_audio_paths: List[str], auxiliary reference audios for multi-speaker tone fusion.
+            voice_id: str, the id of the voice, defaults to the content hash.
+        Returns:
+            dict: the voice pack, to be saved with save_voice_pack.
+        """
+        if not os.path.exists(ref_audio_path):
+            raise ValueError(f"{ref_audio_path} not exists")
+        no_prompt_text = prompt_text in [None, ""]
+        if no_prompt_text and self.configs.is_v3_synthesizer:
+            raise NO_PROMPT_ERROR("prompt_text cannot be empty when using SoVITS_V3")
+        with self.prompt_lock, torch.no_grad():
+            self.set_ref_audio(ref_audio_path)
+            self._set_aux_ref_audio(aux_ref_audio_paths)
+            if no_prompt_text:
+                for field in ["prompt_text", "prompt_lang", "phones", "bert_features", "norm_text"]:
+                    self.prompt_cache[field] = None
+            else:
+                self._set_prompt_text(prompt_text, prompt_lang)
+            self._set_prompt_features()
+            pack = {field: self.prompt_cache[field] for field in VOICE_PACK_FIELDS}
+            pack["refer_spec"] = list(pack["refer_spec"])
+            pack["aux_ref_audio_paths"] = list(pack["aux_ref_audio_paths"])
+
+        ### key基于保存的(归一化后的)提示文本计算，加载时才能重新计算校验
+        key = get_voice_pack_key(
+            pack["ref_audio_path"],
+            pack["aux_ref_audio_paths"],
+            pack["prompt_text"],
+            pack["prompt_lang"],
+            self.configs.version,
+            self.configs.vits_weights_path,
+        )
+        pack["format_version"] = VOICE_PACK_FORMAT_VERSION
+        pack["key"] = key
+        pack["voice_id"] = voice_id if voice_id not in [None, ""] else key
+        pack["model_version"] = self.configs.version
+        pack["vits_weights"] = os.path.basename(self.configs.vits_weights_path)
+        return pack
+
+    def save_voice_pack(self, pack: dict, path: str = None) -> str:
+        path = path if path is not None else get_voice_pack_path(self.configs.voice_pack_dir, pack["voice_id"])
+        save_voice_pack(pack, path)
+        return path
+
+    def set_voice(self, voice_id: str):
+        """
+        To set the reference voice from a voice pack in configs.voice_pack_dir, built with build_voice_pack.
+        Args:
+            voice_id: str, the id of the voice.
+        """
+        pack = load_voice_pack(get_voice_pack_path(self.configs.voice_pack_dir, voice_id))
+        check_voice_pack(pack, self.configs.version, self.configs.vits_weights_path)
+        with self.prompt_lock:
+            for field in VOICE_PACK_FIELDS:
+                value = pack[field]
+                if isinstance(value, torch.Tensor):
+                    value = value.to(self.configs.device)
+                elif field == "refer_spec":
+                    value = [item.to(self.configs.device) for item in value]
+                self.prompt_cache[field] = value
+            ### 音色包中的参考音频路径只作记录，之后的请求传入参考音频时总是重新加载
+            self.prompt_cache["ref_audio_path"] = None
+            self.prompt_cache["raw_audio"] = None
+            self.prompt_cache["raw_sr"] = None
+            self.prompt_cache["voice_id"] = voice_id
+
+    def _get_ref_spec(self, ref_audio: Union[str, RefAudio]):
+        if isinstance(ref_audio, str):
+            ref_audio = load_ref_audio(ref_audio)
+        audio = ref_audio.get(int(self.configs.sampling_rate)).clone()
         maxx = audio.abs().max()
         if maxx > 1:
             audio /= min(2, maxx)
@@ -680,16 +953,17 @@ class TTS:
             spec = spec.half()
         return spec
 
-    def _set_prompt_semantic(self, ref_wav_path: str):
+    def _set_prompt_semantic(self, ref_audio: Union[str, RefAudio]):
+        if isinstance(ref_audio, str):
+            ref_audio = load_ref_audio(ref_audio)
         zero_wav = np.zeros(
             int(self.configs.sampling_rate * 0.3),
             dtype=np.float16 if self.configs.is_half else np.float32,
         )
         with torch.no_grad():
-            wav16k, sr = librosa.load(ref_wav_path, sr=16000)
+            wav16k = ref_audio.get(16000)
             if wav16k.shape[0] > 160000 or wav16k.shape[0] < 48000:
                 raise OSError(i18n("参考音频在3~10秒范围外，请更换！"))
-            wav16k = torch.from_numpy(wav16k)
             zero_wav_torch = torch.from_numpy(zero_wav)
             wav16k = wav16k.to(self.configs.device)
             zero_wav_torch = zero_wav_torch.to(self.configs.device)
@@ -870,6 +1144,209 @@ class TTS:
         """
         self.stop_flag = True
 
+    def _get_prompt_snapshot(
+        self,
+        ref_audio_path: str,
+        aux_ref_audio_paths: List[str],
+        prompt_text: str,
+        prompt_lang: str,
+        voice_id: str,
+        no_prompt_text: bool,
+    ) -> Tuple[dict, bool]:
+        """
+        Set the reference voice of a request and return a snapshot of the prompt cache, with no_prompt_text.
+        """
+        ### 参考音频与参考文本的设置需要加锁，之后使用本次请求的快照，避免并发请求互相覆盖
+        with self.prompt_lock:
+            if voice_id not in [None, ""]:
+                ### 使用预先构建的音色包，忽略参考音频与参考文本
+                if voice_id != self.prompt_cache["voice_id"]:
+                    self.set_voice(voice_id)
+                no_prompt_text = self.prompt_cache["prompt_text"] is None
+            else:
+                if not no_prompt_text:
+                    prompt_text = self._normalize_prompt_text(prompt_text, prompt_lang)
+                    print(i18n("实际输入的参考文本:"), prompt_text)
+
+                ### 多音色缓存命中时直接切换到缓存的音色
+                prompt_cache_key = None
+                prompt_cache_entry = None
+                if ref_audio_path not in [None, ""] and self.prompt_cache_lru.enabled:
+                    if not os.path.exists(ref_audio_path):
+                        raise ValueError(f"{ref_audio_path} not exists")
+                    prompt_cache_key = self._get_prompt_cache_key(
+                        ref_audio_path,
+                        aux_ref_audio_paths,
+                        None if no_prompt_text else prompt_text,
+                        None if no_prompt_text else prompt_lang,
+                    )
+                    prompt_cache_entry = self.prompt_cache_lru.get(prompt_cache_key)
+
+                if prompt_cache_entry is not None:
+                    self._load_prompt_cache_entry(prompt_cache_entry, ref_audio_path)
+                else:
+                    if (ref_audio_path is not None) and (ref_audio_path != self.prompt_cache["ref_audio_path"]):
+                        if not os.path.exists(ref_audio_path):
+                            raise ValueError(f"{ref_audio_path} not exists")
+                        self.set_ref_audio(ref_audio_path)
+
+                    self._set_aux_ref_audio(aux_ref_audio_paths)
+
+                    if not no_prompt_text:
+                        self._set_prompt_text(prompt_text, prompt_lang)
+
+                    self._set_prompt_features()
+                    if prompt_cache_key is not None:
+                        self.prompt_cache_lru.put(prompt_cache_key, make_prompt_cache_entry(self.prompt_cache))
+
+            self._set_prompt_features()
+
+            prompt_cache: dict = self.prompt_cache.copy()
+            prompt_cache["refer_spec"] = list(self.prompt_cache["refer_spec"])
+        return prompt_cache, no_prompt_text
+
+    def _get_infer_panel(self, parallel_infer: bool):
+        if parallel_infer:
+            print(i18n("并行推理模式已开启"))
+            if self.t2s_scheduler is not None:
+                infer_panel = self.t2s_scheduler.infer_panel
+            else:
+                infer_panel = self.t2s_model.model.infer_panel_batch_infer
+        else:
+            print(i18n("并行推理模式已关闭"))
+            infer_panel = self.t2s_model.model.infer_panel_naive_batched
+        return infer_panel
+
+    def _synthesize_batch(
+        self,
+        item: dict,
+        prompt: torch.LongTensor,
+        prompt_cache: dict,
+        infer_panel,
+        top_k: int = 5,
+        top_p: float = 1,
+        temperature: float = 1,
+        repetition_penalty: float = 1.35,
+        speed_factor: float = 1.0,
+        parallel_infer: bool = True,
+        sample_steps: int = 32,
+        cancel_check=None,
+    ) -> Tuple[List[torch.Tensor], float]:
+        """
+        Predict the semantic tokens of a batch from to_batch and synthesize them.
+        Returns the audio fragments of the batch and the time the semantic tokens were ready.
+        ``cancel_check`` is called at every T2S decode step and CFM step, it raises InferenceCancelled to abort.
+        """
+        batch_phones: List[torch.LongTensor] = item["phones"]
+        all_phoneme_ids: torch.LongTensor = item["all_phones"]
+        all_phoneme_lens: torch.LongTensor = item["all_phones_len"]
+        all_bert_features: torch.LongTensor = item["all_bert_features"]
+        max_len = item["max_len"]
+
+        print(f"############ {i18n('预测语义Token')} ############")
+        pred_semantic_list, idx_list = infer_panel(
+            all_phoneme_ids,
+            all_phoneme_lens,
+            prompt,
+            all_bert_features,
+            # prompt_phone_len=ph_offset,
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            early_stop_num=self.configs.hz * self.configs.max_sec,
+            max_len=max_len,
+            repetition_penalty=repetition_penalty,
+            cancel_check=cancel_check,
+            sync_interval=self.configs.t2s_sync_interval,
+            packed_prefill=self.configs.t2s_packed_prefill,
+            speculative_steps=self.configs.t2s_speculative_steps,
+            draft_layers=self.configs.t2s_draft_layers,
+        )
+        t4 = time.perf_counter()
+        metrics.SEMANTIC_TOKENS.inc(sum(int(idx) for idx in idx_list), version=self.configs.version)
+
+        refer_audio_spec: torch.Tensor = [
+            item.to(dtype=self.precision, device=self.configs.device) for item in prompt_cache["refer_spec"]
+        ]
+        refer_ge = prompt_cache["refer_ge"].to(dtype=self.precision, device=self.configs.device)
+
+        batch_audio_fragment = []
+
+        # ## vits并行推理 method 1
+        # pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
+        # pred_semantic_len = torch.LongTensor([item.shape[0] for item in pred_semantic_list]).to(self.configs.device)
+        # pred_semantic = self.batch_sequences(pred_semantic_list, axis=0, pad_value=0).unsqueeze(0)
+        # max_len = 0
+        # for i in range(0, len(batch_phones)):
+        #     max_len = max(max_len, batch_phones[i].shape[-1])
+        # batch_phones = self.batch_sequences(batch_phones, axis=0, pad_value=0, max_length=max_len)
+        # batch_phones = batch_phones.to(self.configs.device)
+        # batch_audio_fragment = (self.vits_model.batched_decode(
+        #         pred_semantic, pred_semantic_len, batch_phones, batch_phones_len,refer_audio_spec
+        #     ))
+        print(f"############ {i18n('合成音频')} ############")
+        if not self.configs.is_v3_synthesizer:
+            if speed_factor == 1.0:
+                print(f"{i18n('并行合成中')}...")
+                # ## vits并行推理 method 2
+                pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
+                upsample_rate = math.prod(self.vits_model.upsample_rates)
+                audio_frag_idx = [
+                    pred_semantic_list[i].shape[0] * 2 * upsample_rate for i in range(0, len(pred_semantic_list))
+                ]
+                audio_frag_end_idx = [sum(audio_frag_idx[: i + 1]) for i in range(0, len(audio_frag_idx))]
+                all_pred_semantic = torch.cat(pred_semantic_list).unsqueeze(0).unsqueeze(0).to(self.configs.device)
+                _batch_phones = torch.cat(batch_phones).unsqueeze(0).to(self.configs.device)
+                _batch_audio_fragment = self.vits_model.decode(
+                    all_pred_semantic, _batch_phones, refer_audio_spec, speed=speed_factor, ge=refer_ge
+                ).detach()[0, 0, :]
+                audio_frag_end_idx.insert(0, 0)
+                batch_audio_fragment = [
+                    _batch_audio_fragment[audio_frag_end_idx[i - 1] : audio_frag_end_idx[i]]
+                    for i in range(1, len(audio_frag_end_idx))
+                ]
+            else:
+                # ## vits串行推理
+                for i, idx in enumerate(tqdm(idx_list)):
+                    phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
+                    _pred_semantic = (
+                        pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0)
+                    )  # .unsqueeze(0)#mq要多unsqueeze一次
+                    audio_fragment = self.vits_model.decode(
+                        _pred_semantic, phones, refer_audio_spec, speed=speed_factor, ge=refer_ge
+                    ).detach()[0, 0, :]
+                    batch_audio_fragment.append(audio_fragment)  ###试试重建不带上prompt部分
+        else:
+            if parallel_infer:
+                print(f"{i18n('并行合成中')}...")
+                audio_fragments = self.v3_synthesis_batched_infer(
+                    idx_list,
+                    pred_semantic_list,
+                    batch_phones,
+                    speed=speed_factor,
+                    sample_steps=sample_steps,
+                    prompt_cache=prompt_cache,
+                    cancel_check=cancel_check,
+                )
+                batch_audio_fragment.extend(audio_fragments)
+            else:
+                for i, idx in enumerate(tqdm(idx_list)):
+                    phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
+                    _pred_semantic = (
+                        pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0)
+                    )  # .unsqueeze(0)#mq要多unsqueeze一次
+                    audio_fragment = self.v3_synthesis(
+                        _pred_semantic,
+                        phones,
+                        speed=speed_factor,
+                        sample_steps=sample_steps,
+                        prompt_cache=prompt_cache,
+                        cancel_check=cancel_check,
+                    )
+                    batch_audio_fragment.append(audio_fragment)
+
+        return batch_audio_fragment, t4
+
     @torch.no_grad()
     def run(self, inputs: dict):
         """
@@ -884,6 +1361,7 @@ class TTS:
                     "aux_ref_audio_paths": [],    # list.(optional) auxiliary reference audio paths for multi-speaker tone fusion
                     "prompt_text": "",            # str.(optional) prompt text for the reference audio
                     "prompt_lang": "",            # str.(required) language of the prompt text for the reference audio
+                    "voice_id": None,             # str.(optional) id of a voice pack built with build_voice_pack, replaces the reference audio and prompt text
                     "top_k": 5,                   # int. top k sampling
                     "top_p": 1,                   # float. top p sampling
                     "temperature": 1,             # float. temperature for sampling
@@ -899,6 +1377,9 @@ class TTS:
                     "repetition_penalty": 1.35    # float. repetition penalty for T2S model.
                     "sample_steps": 32,           # int. number of sampling steps for VITS model V3.
                     "super_sampling": False,       # bool. whether to use super-sampling for audio when using VITS model V3.
+                    "streaming_chunk_size": 0,    # int. in return_fragment mode, decode audio every n semantic tokens instead of every sentence, 0 to disable.
+                    "cancel_token": None,         # CancelToken.(optional) stops the synthesis when cancelled or past its deadline, raising InferenceCancelled.
+                    "timeout": None,              # float.(optional) seconds before the synthesis is abandoned, used when no cancel_token is given.
                 }
         returns:
             Tuple[int, np.ndarray]: sampling rate and audio data.
@@ -911,6 +1392,7 @@ class TTS:
         aux_ref_audio_paths: list = inputs.get("aux_ref_audio_paths", [])
         prompt_text: str = inputs.get("prompt_text", "")
         prompt_lang: str = inputs.get("prompt_lang", "")
+        voice_id: str = inputs.get("voice_id", None)
         top_k: int = inputs.get("top_k", 5)
         top_p: float = inputs.get("top_p", 1)
         temperature: float = inputs.get("temperature", 1)
@@ -928,13 +1410,12 @@ class TTS:
         repetition_penalty = inputs.get("repetition_penalty", 1.35)
         sample_steps = inputs.get("sample_steps", 32)
         super_sampling = inputs.get("super_sampling", False)
+        streaming_chunk_size = inputs.get("streaming_chunk_size", 0)
+        cancel_token: CancelToken = inputs.get("cancel_token", None)
+        if cancel_token is None:
+            cancel_token = CancelToken.from_timeout(inputs.get("timeout", None))
 
-        if parallel_infer:
-            print(i18n("并行推理模式已开启"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_batch_infer
-        else:
-            print(i18n("并行推理模式已关闭"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_naive_batched
+        infer_panel = self._get_infer_panel(parallel_infer)
 
         if return_fragment:
             print(i18n("分段返回模式已开启"))
@@ -953,6 +1434,12 @@ class TTS:
         else:
             print(i18n("分桶处理模式已关闭"))
 
+        if streaming_chunk_size > 0 and not return_fragment:
+            streaming_chunk_size = 0
+        elif streaming_chunk_size > 0 and self.configs.is_v3_synthesizer:
+            print(i18n("SoVITS V3模型不支持按语义Token分块流式合成，已自动关闭"))
+            streaming_chunk_size = 0
+
         if fragment_interval < 0.01:
             fragment_interval = 0.01
             print(i18n("分段间隔过小，已自动设置为0.01"))
@@ -962,13 +1449,13 @@ class TTS:
             no_prompt_text = True
 
         assert text_lang in self.configs.languages
-        if not no_prompt_text:
+        if not no_prompt_text and voice_id in [None, ""]:
             assert prompt_lang in self.configs.languages
 
-        if no_prompt_text and self.configs.is_v3_synthesizer:
+        if no_prompt_text and self.configs.is_v3_synthesizer and voice_id in [None, ""]:
             raise NO_PROMPT_ERROR("prompt_text cannot be empty when using SoVITS_V3")
 
-        if ref_audio_path in [None, ""] and (
+        if ref_audio_path in [None, ""] and voice_id in [None, ""] and (
             (self.prompt_cache["prompt_semantic"] is None) or (self.prompt_cache["refer_spec"] in [None, []])
         ):
             raise ValueError(
@@ -977,38 +1464,9 @@ class TTS:
 
         ###### setting reference audio and prompt text preprocessing ########
         t0 = time.perf_counter()
-        if (ref_audio_path is not None) and (ref_audio_path != self.prompt_cache["ref_audio_path"]):
-            if not os.path.exists(ref_audio_path):
-                raise ValueError(f"{ref_audio_path} not exists")
-            self.set_ref_audio(ref_audio_path)
-
-        aux_ref_audio_paths = aux_ref_audio_paths if aux_ref_audio_paths is not None else []
-        paths = set(aux_ref_audio_paths) & set(self.prompt_cache["aux_ref_audio_paths"])
-        if not (len(list(paths)) == len(aux_ref_audio_paths) == len(self.prompt_cache["aux_ref_audio_paths"])):
-            self.prompt_cache["aux_ref_audio_paths"] = aux_ref_audio_paths
-            self.prompt_cache["refer_spec"] = [self.prompt_cache["refer_spec"][0]]
-            for path in aux_ref_audio_paths:
-                if path in [None, ""]:
-                    continue
-                if not os.path.exists(path):
-                    print(i18n("音频文件不存在，跳过："), path)
-                    continue
-                self.prompt_cache["refer_spec"].append(self._get_ref_spec(path))
-
-        if not no_prompt_text:
-            prompt_text = prompt_text.strip("\n")
-            if prompt_text[-1] not in splits:
-                prompt_text += "。" if prompt_lang != "en" else "."
-            print(i18n("实际输入的参考文本:"), prompt_text)
-            if self.prompt_cache["prompt_text"] != prompt_text:
-                phones, bert_features, norm_text = self.text_preprocessor.segment_and_extract_feature_for_text(
-                    prompt_text, prompt_lang, self.configs.version
-                )
-                self.prompt_cache["prompt_text"] = prompt_text
-                self.prompt_cache["prompt_lang"] = prompt_lang
-                self.prompt_cache["phones"] = phones
-                self.prompt_cache["bert_features"] = bert_features
-                self.prompt_cache["norm_text"] = norm_text
+        prompt_cache, no_prompt_text = self._get_prompt_snapshot(
+            ref_audio_path, aux_ref_audio_paths, prompt_text, prompt_lang, voice_id, no_prompt_text
+        )
 
         ###### text preprocessing ########
         t1 = time.perf_counter()
@@ -1022,7 +1480,7 @@ class TTS:
             batch_index_list: list = None
             data, batch_index_list = self.to_batch(
                 data,
-                prompt_data=self.prompt_cache if not no_prompt_text else None,
+                prompt_data=prompt_cache if not no_prompt_text else None,
                 batch_size=batch_size,
                 threshold=batch_threshold,
                 split_bucket=split_bucket,
@@ -1057,7 +1515,7 @@ class TTS:
                     return None
                 batch, _ = self.to_batch(
                     batch_data,
-                    prompt_data=self.prompt_cache if not no_prompt_text else None,
+                    prompt_data=prompt_cache if not no_prompt_text else None,
                     batch_size=batch_size,
                     threshold=batch_threshold,
                     split_bucket=False,
@@ -1067,6 +1525,9 @@ class TTS:
                 return batch[0]
 
         t2 = time.perf_counter()
+        metric_labels = metrics.mode_labels(self.configs.version, parallel_infer, return_fragment, batch_size)
+        stage_times = {"ref_setup": t1 - t0, "text_preprocess": t2 - t1}
+        audio_seconds = 0.0
         try:
             print("############ 推理 ############")
             ###### inference ######
@@ -1075,11 +1536,16 @@ class TTS:
             audio = []
             output_sr = self.configs.sampling_rate if not self.configs.is_v3_synthesizer else 24000
             for item in data:
+                cancel_token.check()
                 t3 = time.perf_counter()
+                t_text = t3
                 if return_fragment:
                     item = make_batch(item)
                     if item is None:
                         continue
+                    ### 逐段返回时文本在这里才处理
+                    t_text = time.perf_counter()
+                    stage_times["text_preprocess"] += t_text - t3
 
                 batch_phones: List[torch.LongTensor] = item["phones"]
                 # batch_phones:torch.LongTensor = item["phones"]
@@ -1088,110 +1554,90 @@ class TTS:
                 all_phoneme_lens: torch.LongTensor = item["all_phones_len"]
                 all_bert_features: torch.LongTensor = item["all_bert_features"]
                 norm_text: str = item["norm_text"]
-                max_len = item["max_len"]
 
                 print(i18n("前端处理后的文本(每句):"), norm_text)
                 if no_prompt_text:
                     prompt = None
                 else:
                     prompt = (
-                        self.prompt_cache["prompt_semantic"].expand(len(all_phoneme_ids), -1).to(self.configs.device)
+                        prompt_cache["prompt_semantic"].expand(len(all_phoneme_ids), -1).to(self.configs.device)
                     )
 
-                print(f"############ {i18n('预测语义Token')} ############")
-                pred_semantic_list, idx_list = self.t2s_model.model.infer_panel(
-                    all_phoneme_ids,
-                    all_phoneme_lens,
+                if streaming_chunk_size > 0:
+                    ###### 逐句按语义Token分块生成，并增量合成音频 ######
+                    refer_audio_spec: List[torch.Tensor] = [
+                        item.to(dtype=self.precision, device=self.configs.device)
+                        for item in prompt_cache["refer_spec"]
+                    ]
+                    refer_ge = prompt_cache["refer_ge"].to(dtype=self.precision, device=self.configs.device)
+                    for i in range(len(all_phoneme_ids)):
+                        semantic_chunks = self.t2s_model.model.infer_panel_naive_stream(
+                            all_phoneme_ids[i].unsqueeze(0),
+                            all_phoneme_lens[i],
+                            prompt[i].unsqueeze(0) if prompt is not None else None,
+                            all_bert_features[i].unsqueeze(0),
+                            top_k=top_k,
+                            top_p=top_p,
+                            temperature=temperature,
+                            early_stop_num=self.configs.hz * self.configs.max_sec,
+                            repetition_penalty=repetition_penalty,
+                            chunk_length=streaming_chunk_size,
+                            cancel_check=cancel_token.check,
+                            sync_interval=self.configs.t2s_sync_interval,
+                            speculative_steps=self.configs.t2s_speculative_steps,
+                            draft_layers=self.configs.t2s_draft_layers,
+                        )
+                        phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
+                        for audio_fragment, is_last in self.vits_decode_stream(
+                            semantic_chunks, phones, refer_audio_spec, speed=speed_factor, ge=refer_ge
+                        ):
+                            sr, audio_data = self.audio_postprocess(
+                                [[audio_fragment]],
+                                output_sr,
+                                None,
+                                speed_factor,
+                                False,
+                                fragment_interval if is_last else 0,
+                            )
+                            audio_seconds += len(audio_data) / sr
+                            yield sr, audio_data
+                            if self.stop_flag:
+                                break
+                        if self.stop_flag:
+                            break
+                    t5 = time.perf_counter()
+                    print("%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t5 - t3))
+                    ### T2S与VITS交替进行，只记录总时间
+                    stage_times["t2s_vits"] = stage_times.get("t2s_vits", 0.0) + t5 - t_text
+
+                    if self.stop_flag:
+                        yield 16000, np.zeros(int(16000), dtype=np.int16)
+                        return
+                    continue
+
+                batch_audio_fragment, t4 = self._synthesize_batch(
+                    item,
                     prompt,
-                    all_bert_features,
-                    # prompt_phone_len=ph_offset,
+                    prompt_cache,
+                    infer_panel,
                     top_k=top_k,
                     top_p=top_p,
                     temperature=temperature,
-                    early_stop_num=self.configs.hz * self.configs.max_sec,
-                    max_len=max_len,
                     repetition_penalty=repetition_penalty,
+                    speed_factor=speed_factor,
+                    parallel_infer=parallel_infer,
+                    sample_steps=sample_steps,
+                    cancel_check=cancel_token.check,
                 )
-                t4 = time.perf_counter()
                 t_34 += t4 - t3
 
-                refer_audio_spec: torch.Tensor = [
-                    item.to(dtype=self.precision, device=self.configs.device)
-                    for item in self.prompt_cache["refer_spec"]
-                ]
-
-                batch_audio_fragment = []
-
-                # ## vits并行推理 method 1
-                # pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                # pred_semantic_len = torch.LongTensor([item.shape[0] for item in pred_semantic_list]).to(self.configs.device)
-                # pred_semantic = self.batch_sequences(pred_semantic_list, axis=0, pad_value=0).unsqueeze(0)
-                # max_len = 0
-                # for i in range(0, len(batch_phones)):
-                #     max_len = max(max_len, batch_phones[i].shape[-1])
-                # batch_phones = self.batch_sequences(batch_phones, axis=0, pad_value=0, max_length=max_len)
-                # batch_phones = batch_phones.to(self.configs.device)
-                # batch_audio_fragment = (self.vits_model.batched_decode(
-                #         pred_semantic, pred_semantic_len, batch_phones, batch_phones_len,refer_audio_spec
-                #     ))
-                print(f"############ {i18n('合成音频')} ############")
-                if not self.configs.is_v3_synthesizer:
-                    if speed_factor == 1.0:
-                        print(f"{i18n('并行合成中')}...")
-                        # ## vits并行推理 method 2
-                        pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                        upsample_rate = math.prod(self.vits_model.upsample_rates)
-                        audio_frag_idx = [
-                            pred_semantic_list[i].shape[0] * 2 * upsample_rate
-                            for i in range(0, len(pred_semantic_list))
-                        ]
-                        audio_frag_end_idx = [sum(audio_frag_idx[: i + 1]) for i in range(0, len(audio_frag_idx))]
-                        all_pred_semantic = (
-                            torch.cat(pred_semantic_list).unsqueeze(0).unsqueeze(0).to(self.configs.device)
-                        )
-                        _batch_phones = torch.cat(batch_phones).unsqueeze(0).to(self.configs.device)
-                        _batch_audio_fragment = self.vits_model.decode(
-                            all_pred_semantic, _batch_phones, refer_audio_spec, speed=speed_factor
-                        ).detach()[0, 0, :]
-                        audio_frag_end_idx.insert(0, 0)
-                        batch_audio_fragment = [
-                            _batch_audio_fragment[audio_frag_end_idx[i - 1] : audio_frag_end_idx[i]]
-                            for i in range(1, len(audio_frag_end_idx))
-                        ]
-                    else:
-                        # ## vits串行推理
-                        for i, idx in enumerate(tqdm(idx_list)):
-                            phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
-                            _pred_semantic = (
-                                pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0)
-                            )  # .unsqueeze(0)#mq要多unsqueeze一次
-                            audio_fragment = self.vits_model.decode(
-                                _pred_semantic, phones, refer_audio_spec, speed=speed_factor
-                            ).detach()[0, 0, :]
-                            batch_audio_fragment.append(audio_fragment)  ###试试重建不带上prompt部分
-                else:
-                    if parallel_infer:
-                        print(f"{i18n('并行合成中')}...")
-                        audio_fragments = self.v3_synthesis_batched_infer(
-                            idx_list, pred_semantic_list, batch_phones, speed=speed_factor, sample_steps=sample_steps
-                        )
-                        batch_audio_fragment.extend(audio_fragments)
-                    else:
-                        for i, idx in enumerate(tqdm(idx_list)):
-                            phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
-                            _pred_semantic = (
-                                pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0)
-                            )  # .unsqueeze(0)#mq要多unsqueeze一次
-                            audio_fragment = self.v3_synthesis(
-                                _pred_semantic, phones, speed=speed_factor, sample_steps=sample_steps
-                            )
-                            batch_audio_fragment.append(audio_fragment)
-
                 t5 = time.perf_counter()
                 t_45 += t5 - t4
+                stage_times["t2s"] = stage_times.get("t2s", 0.0) + t4 - t_text
+                stage_times["vits"] = stage_times.get("vits", 0.0) + t5 - t4
                 if return_fragment:
                     print("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t4 - t3, t5 - t4))
-                    yield self.audio_postprocess(
+                    sr, audio_data = self.audio_postprocess(
                         [batch_audio_fragment],
                         output_sr,
                         None,
@@ -1200,6 +1646,8 @@ class TTS:
                         fragment_interval,
                         super_sampling if self.configs.is_v3_synthesizer else False,
                     )
+                    audio_seconds += len(audio_data) / sr
+                    yield sr, audio_data
                 else:
                     audio.append(batch_audio_fragment)
 
@@ -1212,7 +1660,7 @@ class TTS:
                 if len(audio) == 0:
                     yield 16000, np.zeros(int(16000), dtype=np.int16)
                     return
-                yield self.audio_postprocess(
+                sr, audio_data = self.audio_postprocess(
                     audio,
                     output_sr,
                     batch_index_list,
@@ -1221,22 +1669,189 @@ class TTS:
                     fragment_interval,
                     super_sampling if self.configs.is_v3_synthesizer else False,
                 )
+                audio_seconds += len(audio_data) / sr
+                metrics.observe_synthesis(metric_labels, stage_times, time.perf_counter() - t0, audio_seconds)
+                yield sr, audio_data
+            else:
+                metrics.observe_synthesis(metric_labels, stage_times, time.perf_counter() - t0, audio_seconds)
 
+        except InferenceCancelled as e:
+            ### 取消不是模型出错，无需重新加载模型，中间结果随异常释放，显存在finally中回收
+            print(f"{e}, stopped after {time.perf_counter() - t0:.3f}s")
+            metrics.REQUESTS.inc(version=self.configs.version, status=e.reason)
+            raise
         except Exception as e:
             traceback.print_exc()
-            # 必须返回一个空音频, 否则会导致显存不释放。
-            yield 16000, np.zeros(int(16000), dtype=np.int16)
-            # 重置模型, 否则会导致显存释放不完全。
-            del self.t2s_model
-            del self.vits_model
-            self.t2s_model = None
-            self.vits_model = None
-            self.init_t2s_weights(self.configs.t2s_weights_path)
-            self.init_vits_weights(self.configs.vits_weights_path)
+            metrics.REQUESTS.inc(version=self.configs.version, status="error")
+            ### 不在这里重新加载模型：多个推理线程共用同一个TTS，重载会让其他正在解码的请求失败，
+            ### T2SScheduler也会指向已删除的模型。中间结果随异常释放，显存在finally中回收。
+            ### 也不再返回空音频，流式请求会把它当作真实音频发给客户端
             raise e
         finally:
             self.empty_cache()
 
+    @torch.no_grad()
+    def run_batch(self, inputs_list: List[dict], batch_size: int = None) -> List[Tuple[int, np.ndarray]]:
+        """
+        Synthesize several non-streaming requests together, packing the segments of all of them into shared batches.
+
+        The requests must use the same reference voice and synthesis params, only "text", "text_lang",
+        "text_split_method" and "batch_size" may differ (see request_batcher.get_batch_key).
+        Args:
+            inputs_list (List[dict]): the inputs of each request, see run.
+            batch_size (int): batch size of the shared batches, defaults to the sum of the requests' batch_size.
+        returns:
+            List[Tuple[int, np.ndarray]]: sampling rate and audio data of each request.
+        """
+        self.stop_flag: bool = False
+        inputs = inputs_list[0]
+        ref_audio_path: str = inputs.get("ref_audio_path", "")
+        aux_ref_audio_paths: list = inputs.get("aux_ref_audio_paths", [])
+        prompt_text: str = inputs.get("prompt_text", "")
+        prompt_lang: str = inputs.get("prompt_lang", "")
+        voice_id: str = inputs.get("voice_id", None)
+        top_k: int = inputs.get("top_k", 5)
+        top_p: float = inputs.get("top_p", 1)
+        temperature: float = inputs.get("temperature", 1)
+        batch_threshold = inputs.get("batch_threshold", 0.75)
+        speed_factor = inputs.get("speed_factor", 1.0)
+        split_bucket = inputs.get("split_bucket", True)
+        fragment_interval = max(inputs.get("fragment_interval", 0.3), 0.01)
+        seed = inputs.get("seed", -1)
+        set_seed(-1 if seed in ["", None] else seed)
+        parallel_infer = inputs.get("parallel_infer", True)
+        repetition_penalty = inputs.get("repetition_penalty", 1.35)
+        sample_steps = inputs.get("sample_steps", 32)
+        super_sampling = inputs.get("super_sampling", False) and self.configs.is_v3_synthesizer
+        if batch_size is None:
+            batch_size = sum(item.get("batch_size", 1) for item in inputs_list)
+        if speed_factor != 1.0 or (self.configs.is_v3_synthesizer and parallel_infer):
+            split_bucket = False
+        cancel_check = self._get_batch_cancel_check(inputs_list)
+
+        no_prompt_text = prompt_text in [None, ""]
+        for item in inputs_list:
+            assert item.get("text_lang", "") in self.configs.languages
+        if not no_prompt_text and voice_id in [None, ""]:
+            assert prompt_lang in self.configs.languages
+        if no_prompt_text and self.configs.is_v3_synthesizer and voice_id in [None, ""]:
+            raise NO_PROMPT_ERROR("prompt_text cannot be empty when using SoVITS_V3")
+        if ref_audio_path in [None, ""] and voice_id in [None, ""] and (
+            (self.prompt_cache["prompt_semantic"] is None) or (self.prompt_cache["refer_spec"] in [None, []])
+        ):
+            raise ValueError(
+                "ref_audio_path cannot be empty, when the reference audio is not set using set_ref_audio()"
+            )
+
+        t0 = time.perf_counter()
+        prompt_cache, no_prompt_text = self._get_prompt_snapshot(
+            ref_audio_path, aux_ref_audio_paths, prompt_text, prompt_lang, voice_id, no_prompt_text
+        )
+
+        t1 = time.perf_counter()
+        ### 所有请求的分句放在一起组batch，owners记录每句属于哪个请求
+        data = []
+        owners = []
+        for i, item in enumerate(inputs_list):
+            item_data = self.text_preprocessor.preprocess(
+                item.get("text", ""),
+                item.get("text_lang", ""),
+                item.get("text_split_method", "cut0"),
+                self.configs.version,
+            )
+            data.extend(item_data)
+            owners.extend([i] * len(item_data))
+        results = [(16000, np.zeros(int(16000), dtype=np.int16)) for _ in inputs_list]
+        if len(data) == 0:
+            return results
+
+        data, batch_index_list = self.to_batch(
+            data,
+            prompt_data=prompt_cache if not no_prompt_text else None,
+            batch_size=batch_size,
+            threshold=batch_threshold,
+            split_bucket=split_bucket,
+            device=self.configs.device,
+            precision=self.precision,
+        )
+
+        t2 = time.perf_counter()
+        infer_panel = self._get_infer_panel(parallel_infer)
+        output_sr = self.configs.sampling_rate if not self.configs.is_v3_synthesizer else 24000
+        audio = []
+        try:
+            for item in data:
+                if cancel_check is not None:
+                    cancel_check()
+                print(i18n("前端处理后的文本(每句):"), item["norm_text"])
+                if no_prompt_text:
+                    prompt = None
+                else:
+                    prompt = (
+                        prompt_cache["prompt_semantic"].expand(len(item["all_phones"]), -1).to(self.configs.device)
+                    )
+                batch_audio_fragment, _ = self._synthesize_batch(
+                    item,
+                    prompt,
+                    prompt_cache,
+                    infer_panel,
+                    top_k=top_k,
+                    top_p=top_p,
+                    temperature=temperature,
+                    repetition_penalty=repetition_penalty,
+                    speed_factor=speed_factor,
+                    parallel_infer=parallel_infer,
+                    sample_steps=sample_steps,
+                    cancel_check=cancel_check,
+                )
+                audio.append(batch_audio_fragment)
+                if self.stop_flag:
+                    return results
+        finally:
+            self.empty_cache()
+
+        t3 = time.perf_counter()
+        print("%.3f\t%.3f\t%.3f\t%d requests" % (t1 - t0, t2 - t1, t3 - t2, len(inputs_list)))
+        request_audio = [[] for _ in inputs_list]
+        for owner, audio_fragment in zip(owners, self.recovery_order(audio, batch_index_list)):
+            request_audio[owner].append(audio_fragment)
+        audio_seconds = 0.0
+        for i, fragments in enumerate(request_audio):
+            if len(fragments) > 0:
+                results[i] = self.audio_postprocess(
+                    [fragments], output_sr, None, speed_factor, False, fragment_interval, super_sampling
+                )
+                audio_seconds += len(results[i][1]) / results[i][0]
+        ### 合并推理的各个请求共享同一次计时
+        metrics.observe_synthesis(
+            metrics.mode_labels(self.configs.version, parallel_infer, False, batch_size),
+            {"ref_setup": t1 - t0, "text_preprocess": t2 - t1, "t2s_vits": t3 - t2},
+            time.perf_counter() - t0,
+            audio_seconds,
+            requests=len(inputs_list),
+        )
+        return results
+
+    def _get_batch_cancel_check(self, inputs_list: List[dict]):
+        """
+        The cancel check of a batch of requests, which only aborts once all of them are cancelled or past
+        their deadline: the others still need their audio. None when some request cannot be cancelled.
+        """
+        cancel_tokens = []
+        for inputs in inputs_list:
+            cancel_token: CancelToken = inputs.get("cancel_token", None)
+            if cancel_token is None:
+                if inputs.get("timeout", None) in [None, 0]:
+                    return None
+                cancel_token = CancelToken.from_timeout(inputs["timeout"])
+            cancel_tokens.append(cancel_token)
+
+        def cancel_check():
+            if all(cancel_token.cancelled for cancel_token in cancel_tokens):
+                cancel_tokens[0].check()
+
+        return cancel_check
+
     def empty_cache(self):
         try:
             gc.collect()  # 触发gc的垃圾回收。避免内存一直增长。
@@ -1302,33 +1917,23 @@ class TTS:
         return sr, audio
 
     def v3_synthesis(
-        self, semantic_tokens: torch.Tensor, phones: torch.Tensor, speed: float = 1.0, sample_steps: int = 32
+        self,
+        semantic_tokens: torch.Tensor,
+        phones: torch.Tensor,
+        speed: float = 1.0,
+        sample_steps: int = 32,
+        prompt_cache: dict = None,
+        cancel_check=None,
     ):
-        prompt_semantic_tokens = self.prompt_cache["prompt_semantic"].unsqueeze(0).unsqueeze(0).to(self.configs.device)
-        prompt_phones = torch.LongTensor(self.prompt_cache["phones"]).unsqueeze(0).to(self.configs.device)
-        refer_audio_spec = self.prompt_cache["refer_spec"][0].to(dtype=self.precision, device=self.configs.device)
-
-        fea_ref, ge = self.vits_model.decode_encp(prompt_semantic_tokens, prompt_phones, refer_audio_spec)
-        ref_audio: torch.Tensor = self.prompt_cache["raw_audio"]
-        ref_sr = self.prompt_cache["raw_sr"]
-        ref_audio = ref_audio.to(self.configs.device).float()
-        if ref_audio.shape[0] == 2:
-            ref_audio = ref_audio.mean(0).unsqueeze(0)
-        if ref_sr != 24000:
-            ref_audio = resample(ref_audio, ref_sr, self.configs.device)
-
-        mel2 = mel_fn(ref_audio)
-        mel2 = norm_spec(mel2)
-        T_min = min(mel2.shape[2], fea_ref.shape[2])
-        mel2 = mel2[:, :, :T_min]
-        fea_ref = fea_ref[:, :, :T_min]
-        if T_min > 468:
-            mel2 = mel2[:, :, -468:]
-            fea_ref = fea_ref[:, :, -468:]
-            T_min = 468
+        prompt_cache = self.prompt_cache if prompt_cache is None else prompt_cache
+        refer_audio_spec = prompt_cache["refer_spec"][0].to(dtype=self.precision, device=self.configs.device)
+        ge = prompt_cache["refer_ge"].to(dtype=self.precision, device=self.configs.device)
+
+        ### 参考音频的fea_ref与mel2在设置参考音频时已计算好(见_set_v3_prompt_features)
+        fea_ref = prompt_cache["fea_ref"].to(dtype=self.precision, device=self.configs.device)
+        mel2 = prompt_cache["mel2"].to(dtype=self.precision, device=self.configs.device)
+        T_min = mel2.shape[2]
         chunk_len = 934 - T_min
-
-        mel2 = mel2.to(self.precision)
         fea_todo, ge = self.vits_model.decode_encp(semantic_tokens, phones, refer_audio_spec, ge, speed)
 
         cfm_resss = []
@@ -1341,7 +1946,12 @@ class TTS:
             fea = torch.cat([fea_ref, fea_todo_chunk], 2).transpose(2, 1)
 
             cfm_res = self.vits_model.cfm.inference(
-                fea, torch.LongTensor([fea.size(1)]).to(fea.device), mel2, sample_steps, inference_cfg_rate=0
+                fea,
+                torch.LongTensor([fea.size(1)]).to(fea.device),
+                mel2,
+                sample_steps,
+                inference_cfg_rate=0,
+                cancel_check=cancel_check,
             )
             cfm_res = cfm_res[:, :, mel2.shape[2] :]
 
@@ -1365,33 +1975,19 @@ class TTS:
         batch_phones: List[torch.Tensor],
         speed: float = 1.0,
         sample_steps: int = 32,
+        prompt_cache: dict = None,
+        cancel_check=None,
     ) -> List[torch.Tensor]:
-        prompt_semantic_tokens = self.prompt_cache["prompt_semantic"].unsqueeze(0).unsqueeze(0).to(self.configs.device)
-        prompt_phones = torch.LongTensor(self.prompt_cache["phones"]).unsqueeze(0).to(self.configs.device)
-        refer_audio_spec = self.prompt_cache["refer_spec"][0].to(dtype=self.precision, device=self.configs.device)
-
-        fea_ref, ge = self.vits_model.decode_encp(prompt_semantic_tokens, prompt_phones, refer_audio_spec)
-        ref_audio: torch.Tensor = self.prompt_cache["raw_audio"]
-        ref_sr = self.prompt_cache["raw_sr"]
-        ref_audio = ref_audio.to(self.configs.device).float()
-        if ref_audio.shape[0] == 2:
-            ref_audio = ref_audio.mean(0).unsqueeze(0)
-        if ref_sr != 24000:
-            ref_audio = resample(ref_audio, ref_sr, self.configs.device)
-
-        mel2 = mel_fn(ref_audio)
-        mel2 = norm_spec(mel2)
-        T_min = min(mel2.shape[2], fea_ref.shape[2])
-        mel2 = mel2[:, :, :T_min]
-        fea_ref = fea_ref[:, :, :T_min]
-        if T_min > 468:
-            mel2 = mel2[:, :, -468:]
-            fea_ref = fea_ref[:, :, -468:]
-            T_min = 468
+        prompt_cache = self.prompt_cache if prompt_cache is None else prompt_cache
+        refer_audio_spec = prompt_cache["refer_spec"][0].to(dtype=self.precision, device=self.configs.device)
+        ge = prompt_cache["refer_ge"].to(dtype=self.precision, device=self.configs.device)
+
+        ### 参考音频的fea_ref与mel2在设置参考音频时已计算好(见_set_v3_prompt_features)
+        fea_ref = prompt_cache["fea_ref"].to(dtype=self.precision, device=self.configs.device)
+        mel2 = prompt_cache["mel2"].to(dtype=self.precision, device=self.configs.device)
+        T_min = mel2.shape[2]
         chunk_len = 934 - T_min
 
-        mel2 = mel2.to(self.precision)
-
         # #### batched inference
         overlapped_len = 12
         feat_chunks = []
@@ -1432,7 +2028,12 @@ class TTS:
         fea_ref = fea_ref.repeat(bs, 1, 1)
         fea = torch.cat([fea_ref, feat_chunks], 2).transpose(2, 1)
         pred_spec = self.vits_model.cfm.inference(
-            fea, torch.LongTensor([fea.size(1)]).to(fea.device), mel2, sample_steps, inference_cfg_rate=0
+            fea,
+            torch.LongTensor([fea.size(1)]).to(fea.device),
+            mel2,
+            sample_steps,
+            inference_cfg_rate=0,
+            cancel_check=cancel_check,
         )
         pred_spec = pred_spec[:, :, -chunk_len:]
         dd = pred_spec.shape[1]
@@ -1465,6 +2066,68 @@ class TTS:
 
         return audio_fragments
 
+    def vits_decode_stream(
+        self,
+        semantic_chunks: Generator[Tuple[torch.Tensor, bool], None, None],
+        phones: torch.Tensor,
+        refer_audio_spec: List[torch.Tensor],
+        speed: float = 1.0,
+        context_len: int = 12,
+        overlap_len: int = 2,
+        ge: torch.Tensor = None,
+    ) -> Generator[Tuple[torch.Tensor, bool], None, None]:
+        """
+        Incremental VITS decoding of a stream of semantic token chunks of one sentence.
+
+        Args:
+            semantic_chunks: generator of (tokens [1, n], is_last), see Text2SemanticDecoder.infer_panel_naive_stream.
+            phones: phones of the whole sentence, [1, phones_len].
+            refer_audio_spec: reference spectrograms.
+            speed: speed factor.
+            context_len: number of tokens decoded as left context before a chunk, and held back as right
+                context after it until more tokens arrive.
+            overlap_len: number of tokens overlapping between two audio fragments, stitched with sola_algorithm.
+            ge: precomputed reference embedding, see _set_ref_ge.
+
+        Yields:
+            Tuple[torch.Tensor, bool]: audio fragment and whether it is the last one of the sentence.
+        """
+        semantic_tokens: torch.Tensor = None
+        done = 0  ### 已合成(含尚未输出的重叠部分)的token数
+        tail: torch.Tensor = None  ### 上一段末尾尚未输出、用于与下一段拼接的音频
+        for chunk, is_last in semantic_chunks:
+            metrics.SEMANTIC_TOKENS.inc(chunk.shape[-1], version=self.configs.version)
+            chunk = chunk.to(self.configs.device)
+            semantic_tokens = chunk if semantic_tokens is None else torch.cat([semantic_tokens, chunk], dim=1)
+            total = semantic_tokens.shape[1]
+            end = total if is_last else total - context_len
+            if is_last and end <= done:
+                if tail is not None:
+                    yield tail, True
+                return
+            if not is_last and end - done <= overlap_len:
+                continue
+
+            seg_start = done - overlap_len if tail is not None else 0
+            win_start = max(0, seg_start - context_len)
+            audio = self.vits_model.decode(
+                semantic_tokens[:, win_start:].unsqueeze(0), phones, refer_audio_spec, speed=speed, ge=ge
+            ).detach()[0, 0, :]
+            samples_per_token = audio.shape[0] / (total - win_start)
+            segment = audio[
+                int(round((seg_start - win_start) * samples_per_token)) : int(round((end - win_start) * samples_per_token))
+            ]
+            if tail is not None:
+                segment = self.sola_algorithm([tail, segment], tail.shape[0])
+
+            if is_last:
+                yield segment, True
+                return
+            overlap_samples = int(round(overlap_len * samples_per_token))
+            tail = segment[-overlap_samples:]
+            done = end
+            yield segment[:-overlap_samples], False
+
     def sola_algorithm(
         self,
         audio_fragments: List[torch.Tensor],
@@ -16,6 +16,7 @@ from text.cleaner import clean_text
 from text import cleaned_text_to_sequence
 from transformers import AutoModelForMaskedLM, AutoTokenizer
 from TTS_infer_pack.text_segmentation_method import split_big_text, splits, get_method as get_seg_method
+from TTS_infer_pack.text_feature_cache import TextFeatureCache
 
 from tools.i18n.i18n import I18nAuto, scan_language_list
 
@@ -50,10 +51,19 @@ def merge_short_text_in_array(texts: str, threshold: int) -> list:
 
 
 class TextPreprocessor:
-    def __init__(self, bert_model: AutoModelForMaskedLM, tokenizer: AutoTokenizer, device: torch.device):
+    def __init__(
+        self,
+        bert_model: AutoModelForMaskedLM,
+        tokenizer: AutoTokenizer,
+        device: torch.device,
+        bert_batch_size: int = 16,
+        text_cache: TextFeatureCache = None,
+    ):
         self.bert_model = bert_model
         self.tokenizer = tokenizer
         self.device = device
+        self.bert_batch_size = bert_batch_size
+        self.text_cache = text_cache
         self.bert_lock = threading.RLock()
 
     def preprocess(self, text: str, lang: str, text_split_method: str, version: str = "v2") -> List[Dict]:
@@ -62,10 +72,25 @@ class TextPreprocessor:
         texts = self.pre_seg_text(text, lang, text_split_method)
         result = []
         print(f"############ {i18n('提取文本Bert特征')} ############")
+        ### 先对所有句子做文本清洗(命中缓存的句子跳过)，再把所有需要Bert的片段一起按长度分桶批量推理
+        plans = []
         for text in tqdm(texts):
-            phones, bert_features, norm_text = self.segment_and_extract_feature_for_text(text, lang, version)
+            cached = self.get_cached_phones_and_bert(text, lang, version)
+            if cached is not None:
+                phones, bert_features, norm_text = cached
+                bert_parts = None
+            else:
+                phones, bert_parts, norm_text = self.get_phones_and_bert_parts(text, lang, version)
+                bert_features = None
             if phones is None or norm_text == "":
                 continue
+            plans.append([text, phones, bert_parts, bert_features, norm_text])
+        todo = [plan for plan in plans if plan[3] is None]
+        for plan, bert_features in zip(todo, self.extract_bert_features([plan[2] for plan in todo])):
+            plan[3] = bert_features
+            if self.text_cache is not None:
+                self.text_cache.put(plan[0], lang, version, plan[1], bert_features, plan[4])
+        for _, phones, _, bert_features, norm_text in plans:
             res = {
                 "phones": phones,
                 "bert_features": bert_features,
@@ -120,6 +145,30 @@ class TextPreprocessor:
         return self.get_phones_and_bert(text, language, version)
 
     def get_phones_and_bert(self, text: str, language: str, version: str, final: bool = False):
+        cached = self.get_cached_phones_and_bert(text, language, version)
+        if cached is not None and not final:
+            return cached
+        phones, bert_parts, norm_text = self.get_phones_and_bert_parts(text, language, version, final)
+        bert = self.extract_bert_features([bert_parts])[0]
+        if self.text_cache is not None and not final:
+            self.text_cache.put(text, language, version, phones, bert, norm_text)
+        return phones, bert, norm_text
+
+    def get_cached_phones_and_bert(self, text: str, language: str, version: str):
+        if self.text_cache is None:
+            return None
+        cached = self.text_cache.get(text, language, version)
+        if cached is None:
+            return None
+        phones, bert_features, norm_text, dtype = cached
+        return list(phones), bert_features.to(device=self.device, dtype=dtype), norm_text
+
+    def get_phones_and_bert_parts(self, text: str, language: str, version: str, final: bool = False):
+        """
+        Same as get_phones_and_bert, but the bert features are returned as a list of parts to be computed by
+        extract_bert_features: (norm_text, word2ph) for a chinese segment, or the number of phones of a
+        segment whose features are zeros.
+        """
         with self.bert_lock:
             if language in {"en", "all_zh", "all_ja", "all_ko", "all_yue"}:
                 # language = language.replace("all_","")
@@ -130,20 +179,17 @@ class TextPreprocessor:
                     if re.search(r"[A-Za-z]", formattext):
                         formattext = re.sub(r"[a-z]", lambda x: x.group(0).upper(), formattext)
                         formattext = chinese.mix_text_normalize(formattext)
-                        return self.get_phones_and_bert(formattext, "zh", version)
+                        return self.get_phones_and_bert_parts(formattext, "zh", version)
                     else:
                         phones, word2ph, norm_text = self.clean_text_inf(formattext, language, version)
-                        bert = self.get_bert_feature(norm_text, word2ph).to(self.device)
+                        bert_parts = [(norm_text, word2ph)]
                 elif language == "all_yue" and re.search(r"[A-Za-z]", formattext):
                     formattext = re.sub(r"[a-z]", lambda x: x.group(0).upper(), formattext)
                     formattext = chinese.mix_text_normalize(formattext)
-                    return self.get_phones_and_bert(formattext, "yue", version)
+                    return self.get_phones_and_bert_parts(formattext, "yue", version)
                 else:
                     phones, word2ph, norm_text = self.clean_text_inf(formattext, language, version)
-                    bert = torch.zeros(
-                        (1024, len(phones)),
-                        dtype=torch.float32,
-                    ).to(self.device)
+                    bert_parts = [len(phones)]
             elif language in {"zh", "ja", "ko", "yue", "auto", "auto_yue"}:
                 textlist = []
                 langlist = []
@@ -168,23 +214,69 @@ class TextPreprocessor:
                 # print(textlist)
                 # print(langlist)
                 phones_list = []
-                bert_list = []
+                bert_parts = []
                 norm_text_list = []
                 for i in range(len(textlist)):
                     lang = langlist[i]
                     phones, word2ph, norm_text = self.clean_text_inf(textlist[i], lang, version)
-                    bert = self.get_bert_inf(phones, word2ph, norm_text, lang)
+                    if lang.replace("all_", "") == "zh":
+                        bert_parts.append((norm_text, word2ph))
+                    else:
+                        bert_parts.append(len(phones))
                     phones_list.append(phones)
                     norm_text_list.append(norm_text)
-                    bert_list.append(bert)
-                bert = torch.cat(bert_list, dim=1)
                 phones = sum(phones_list, [])
                 norm_text = "".join(norm_text_list)
 
             if not final and len(phones) < 6:
-                return self.get_phones_and_bert("." + text, language, version, final=True)
+                return self.get_phones_and_bert_parts("." + text, language, version, final=True)
 
-            return phones, bert, norm_text
+            return phones, bert_parts, norm_text
+
+    def extract_bert_features(self, bert_parts_list: List[list]) -> List[torch.Tensor]:
+        """
+        Compute the phone level bert features [1024, phones_len] of several texts, see get_phones_and_bert_parts.
+        All chinese segments are run through bert together, in batches of similar lengths.
+        """
+        segments = [part for bert_parts in bert_parts_list for part in bert_parts if isinstance(part, tuple)]
+        features = iter(self.get_bert_features_batch(segments))
+        result = []
+        for bert_parts in bert_parts_list:
+            bert_list = []
+            for part in bert_parts:
+                if isinstance(part, tuple):
+                    bert_list.append(next(features).to(self.device))
+                else:
+                    bert_list.append(torch.zeros((1024, part), dtype=torch.float32).to(self.device))
+            result.append(torch.cat(bert_list, dim=1))
+        return result
+
+    def get_bert_features_batch(self, segments: List[Tuple[str, list]]) -> List[torch.Tensor]:
+        """
+        Batched get_bert_feature over (text, word2ph) segments. The segments are sorted by length so
+        that each batch needs little padding, padded tokens are excluded by the attention mask.
+        GPT_SoVITS/benchmark_bert.py checks the result against get_bert_feature.
+        """
+        result: List[torch.Tensor] = [None] * len(segments)
+        order = sorted(range(len(segments)), key=lambda i: len(segments[i][0]))
+        with self.bert_lock, torch.no_grad():
+            for start in range(0, len(order), self.bert_batch_size):
+                batch = order[start : start + self.bert_batch_size]
+                inputs = self.tokenizer([segments[i][0] for i in batch], return_tensors="pt", padding=True)
+                for key in inputs:
+                    inputs[key] = inputs[key].to(self.device)
+                res = self.bert_model(**inputs, output_hidden_states=True)
+                hidden_states = torch.cat(res["hidden_states"][-3:-2], -1).cpu()
+                token_lens = inputs["attention_mask"].sum(-1).tolist()
+                for j, i in enumerate(batch):
+                    result[i] = self._expand_to_phones(hidden_states[j, 1 : token_lens[j] - 1], *segments[i])
+        return result
+
+    def _expand_to_phones(self, res: torch.Tensor, text: str, word2ph: list) -> torch.Tensor:
+        assert len(word2ph) == len(text)
+        repeats = torch.tensor(word2ph, dtype=torch.long)
+        phone_level_feature = torch.repeat_interleave(res, repeats, dim=0)
+        return phone_level_feature.T
 
     def get_bert_feature(self, text: str, word2ph: list) -> torch.Tensor:
         with torch.no_grad():
@@ -193,13 +285,7 @@ class TextPreprocessor:
                 inputs[i] = inputs[i].to(self.device)
             res = self.bert_model(**inputs, output_hidden_states=True)
             res = torch.cat(res["hidden_states"][-3:-2], -1)[0].cpu()[1:-1]
-        assert len(word2ph) == len(text)
-        phone_level_feature = []
-        for i in range(len(word2ph)):
-            repeat_feature = res[i].repeat(word2ph[i], 1)
-            phone_level_feature.append(repeat_feature)
-        phone_level_feature = torch.cat(phone_level_feature, dim=0)
-        return phone_level_feature.T
+        return self._expand_to_phones(res, text, word2ph)
 
     def clean_text_inf(self, text: str, language: str, version: str = "v2"):
         language = language.replace("all_", "")
@@ -0,0 +1,233 @@
+"""
+Offline batch synthesis of a JSONL manifest, used by GPT_SoVITS/batch_synthesize.py and the /batch_jobs API.
+
+Each manifest line is one item: {"id": "0001", "text": "...", "text_lang": "zh", "ref_audio_path": "...",
+"prompt_text": "...", "prompt_lang": "zh"} (or "voice_id" instead of the reference audio), plus any other
+param of TTS.run. The items are grouped by voice and synthesis params (request_batcher.get_batch_key),
+sorted by text length inside a group and synthesized ``requests_per_batch`` at a time with TTS.run_batch,
+so the T2S and VITS batches stay full. Items whose output file already exists are skipped, a crashed job
+resumes where it stopped. The result of every item is appended to <output_dir>/status.jsonl.
+"""
+
+import json
+import os
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+from .request_batcher import get_batch_key
+
+AUDIO_FORMATS = ["wav", "flac", "ogg"]
+STATUS_FILE = "status.jsonl"
+
+
+def load_manifest(path: str, defaults: dict = None) -> List[dict]:
+    """
+    Reads the items of a JSONL manifest, ``defaults`` fills the params missing in an item.
+    Items without "id" are named after their line number.
+    """
+    items = []
+    ids = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if line.strip() == "":
+                continue
+            item = dict(defaults or {}, **json.loads(line))
+            item["id"] = str(item.get("id", "%06d" % line_no))
+            if item["id"] in ids:
+                raise ValueError(f"duplicate id {item['id']} at line {line_no} of {path}")
+            if os.path.basename(item["id"]) != item["id"] or item["id"] in [".", ".."]:
+                raise ValueError(f"invalid id {item['id']} at line {line_no} of {path}")
+            if item.get("text", "") in [None, ""]:
+                raise ValueError(f"text is required, line {line_no} of {path}")
+            ids.add(item["id"])
+            items.append(item)
+    return items
+
+
+def plan_batches(items: List[dict], requests_per_batch: int) -> List[List[dict]]:
+    """
+    Groups the items that can share a batch and cuts each group, sorted by text length, into chunks.
+    """
+    groups: Dict[tuple, List[dict]] = {}
+    single = []
+    for item in items:
+        key = get_batch_key(dict(item, streaming_mode=False, return_fragment=False))
+        if key is None:
+            ### 固定seed的请求单独推理
+            single.append([item])
+        else:
+            groups.setdefault(key, []).append(item)
+    chunks = []
+    for group in groups.values():
+        group.sort(key=lambda item: len(item["text"]))
+        for i in range(0, len(group), requests_per_batch):
+            chunks.append(group[i : i + requests_per_batch])
+    return chunks + single
+
+
+class BatchJob:
+    """
+    Args:
+        manifest_path: JSONL manifest, see load_manifest.
+        output_dir: directory of the audio files and status.jsonl.
+        requests_per_batch: number of items synthesized by one TTS.run_batch call.
+        batch_size: batch size of the T2S/VITS batches, defaults to the number of segments of a chunk.
+        audio_format: "wav", "flac" or "ogg".
+        defaults: params used by the items that do not set them, e.g. the voice.
+    """
+
+    def __init__(
+        self,
+        manifest_path: str,
+        output_dir: str,
+        requests_per_batch: int = 16,
+        batch_size: int = None,
+        audio_format: str = "wav",
+        defaults: dict = None,
+    ):
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"audio_format {audio_format} is not supported, use one of {AUDIO_FORMATS}")
+        self.manifest_path = manifest_path
+        self.output_dir = output_dir
+        self.requests_per_batch = max(1, requests_per_batch)
+        self.batch_size = batch_size
+        self.audio_format = audio_format
+        self.items = load_manifest(manifest_path, defaults)
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.audio_seconds = 0.0
+        self.synthesis_time = 0.0
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        self.errors: Dict[str, str] = {}
+
+    def output_path(self, item: dict) -> str:
+        return os.path.join(self.output_dir, f"{item['id']}.{self.audio_format}")
+
+    def chunks(self) -> List[List[dict]]:
+        """
+        The chunks of the items not rendered yet.
+        """
+        pending = []
+        for item in self.items:
+            if os.path.exists(self.output_path(item)):
+                with self.lock:
+                    self.skipped += 1
+            else:
+                pending.append(item)
+        return plan_batches(pending, self.requests_per_batch)
+
+    def _record(self, item: dict, status: str, duration: float = 0.0, error: str = None):
+        record = {"id": item["id"], "status": status, "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        if status == "ok":
+            record["path"] = self.output_path(item)
+            record["duration"] = round(duration, 3)
+        else:
+            record["error"] = error
+        with self.lock:
+            if status == "ok":
+                self.completed += 1
+                self.audio_seconds += duration
+            else:
+                self.failed += 1
+                self.errors[item["id"]] = error
+            with open(os.path.join(self.output_dir, STATUS_FILE), "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _save(self, item: dict, sr: int, audio: np.ndarray) -> float:
+        path = self.output_path(item)
+        ### 先写临时文件再改名，中断时不会留下不完整的音频被当成已完成
+        tmp_path = f"{path}.tmp"
+        sf.write(tmp_path, audio, sr, format=self.audio_format)
+        os.replace(tmp_path, path)
+        return len(audio) / sr
+
+    def run_chunk(self, run_batch_fn: Callable[[List[dict], int], List[Tuple[int, np.ndarray]]], chunk: List[dict]):
+        """
+        Synthesizes one chunk with ``run_batch_fn`` (TTS.run_batch) and writes the results. When the batch fails,
+        the items are retried one by one so that one bad item does not fail the others.
+        """
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        t0 = time.perf_counter()
+        try:
+            results = run_batch_fn(chunk, self.batch_size)
+        except Exception as e:
+            if len(chunk) == 1:
+                traceback.print_exc()
+                self._record(chunk[0], "failed", error=str(e))
+                return
+            print(f"batch of {len(chunk)} items failed ({e}), retrying them one by one")
+            for item in chunk:
+                self.run_chunk(run_batch_fn, [item])
+            return
+        for item, (sr, audio) in zip(chunk, results):
+            try:
+                duration = self._save(item, sr, audio)
+            except Exception as e:
+                traceback.print_exc()
+                self._record(item, "failed", error=str(e))
+                continue
+            self._record(item, "ok", duration)
+        with self.lock:
+            self.synthesis_time += time.perf_counter() - t0
+
+    def run(self, run_batch_fn: Callable[[List[dict], int], List[Tuple[int, np.ndarray]]]):
+        chunks = self.chunks()
+        print(f"{len(self.items)} items, {self.skipped} already rendered, {len(chunks)} batches to run")
+        for i, chunk in enumerate(chunks):
+            if self.cancelled.is_set():
+                break
+            self.run_chunk(run_batch_fn, chunk)
+            stats = self.stats()
+            print(
+                f"batch {i + 1}/{len(chunks)}: {stats['completed']} ok, {stats['failed']} failed, "
+                f"{stats['items_per_second']:.2f} items/s, rtf {stats['rtf']:.3f}"
+            )
+        self.finish()
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    def cancel(self):
+        """
+        Stops the job after the running batch.
+        """
+        self.cancelled.set()
+
+    def stats(self) -> dict:
+        with self.lock:
+            if self.start_time is None:
+                elapsed = 0.0
+            else:
+                elapsed = (self.end_time or time.perf_counter()) - self.start_time
+            done = self.completed + self.failed + self.skipped
+            if self.end_time is not None:
+                state = "cancelled" if self.cancelled.is_set() and done < len(self.items) else "finished"
+            else:
+                state = "running" if self.start_time is not None else "pending"
+            return {
+                "state": state,
+                "manifest_path": self.manifest_path,
+                "output_dir": self.output_dir,
+                "total": len(self.items),
+                "completed": self.completed,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "pending": len(self.items) - done,
+                "audio_seconds": self.audio_seconds,
+                "elapsed": elapsed,
+                "items_per_second": self.completed / elapsed if elapsed > 0 else 0.0,
+                "rtf": self.synthesis_time / self.audio_seconds if self.audio_seconds > 0 else 0.0,
+                "errors": dict(list(self.errors.items())[-20:]),
+            }
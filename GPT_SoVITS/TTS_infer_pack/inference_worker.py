@@ -0,0 +1,196 @@
+import asyncio
+import math
+import queue
+import threading
+import time
+import traceback
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from tools.cancellation import CancelToken, InferenceCancelled
+
+_END = object()
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class InferenceJob:
+    """
+    One submitted request. The worker thread pushes the items of the generator into an asyncio queue
+    of the event loop that submitted it, the handler consumes them with ``async for`` or ``result()``.
+    """
+
+    def __init__(self, inputs: Any, loop: asyncio.AbstractEventLoop, run_fn: Callable[[Any], Iterator] = None):
+        self.inputs = inputs
+        self.loop = loop
+        self.run_fn = run_fn
+        self.channel: asyncio.Queue = asyncio.Queue()
+        self.cancel_token: Optional[CancelToken] = inputs.get("cancel_token", None) if isinstance(inputs, dict) else None
+        ### 与请求的CancelToken共用同一个Event，cancel()时TTS.run的解码循环也会立即停止
+        self.cancelled = self.cancel_token.event if self.cancel_token is not None else threading.Event()
+        self.submit_time = time.perf_counter()
+        self.start_time: Optional[float] = None
+
+    def _put(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self.channel.put_nowait, item)
+        except RuntimeError:
+            ### 事件循环已关闭
+            self.cancelled.set()
+
+    def finish(self, items: list = (), error: Exception = None):
+        """
+        Completes a job that is not run by the worker itself, e.g. a request served by a shared batch.
+        """
+        for item in items:
+            self._put(item)
+        if error is not None:
+            self._put(error)
+        self._put(_END)
+
+    def cancel(self):
+        """
+        Stops the job at the next item, e.g. when the client disconnected.
+        """
+        self.cancelled.set()
+
+    async def __aiter__(self) -> AsyncIterator:
+        while True:
+            item = await self.channel.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    async def result(self):
+        """
+        The first item of the job, the job is cancelled afterwards.
+        """
+        try:
+            async for item in self:
+                return item
+            raise RuntimeError("inference returned nothing")
+        finally:
+            self.cancel()
+
+
+class InferenceWorker:
+    """
+    Runs the blocking TTS generator off the event loop.
+
+    Jobs go through a bounded queue into ``num_workers`` threads sharing the ``TTS`` object, more than one
+    worker only helps when the T2S continuous batching scheduler is enabled. When the queue is full
+    ``submit`` raises QueueFullError instead of waiting, with a retry delay estimated from the recent
+    service times.
+    """
+
+    def __init__(self, run_fn: Callable[[Any], Iterator], num_workers: int = 1, max_queue_size: int = 16):
+        self.run_fn = run_fn
+        self.num_workers = max(1, num_workers)
+        self.max_queue_size = max_queue_size
+        self.queue: "queue.Queue[InferenceJob]" = queue.Queue(maxsize=max(0, max_queue_size))
+        self.lock = threading.Lock()
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        ### 指数滑动平均，单位秒
+        self.avg_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.avg_service_time = 0.0
+        self.threads = []
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._worker, name=f"tts_worker_{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def retry_after(self) -> int:
+        pending = self.queue.qsize() + self.running
+        return max(1, math.ceil(self.avg_service_time * pending / self.num_workers))
+
+    def is_full(self) -> bool:
+        return self.max_queue_size > 0 and self.queue.qsize() >= self.max_queue_size
+
+    def submit(self, inputs: Any, run_fn: Callable[[Any], Iterator] = None) -> InferenceJob:
+        """
+        Queue a job, ``run_fn`` replaces the worker's run function for this job.
+        """
+        job = InferenceJob(inputs, asyncio.get_running_loop(), run_fn)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise QueueFullError(self.retry_after())
+        with self.lock:
+            self.submitted += 1
+        return job
+
+    def _update_time(self, avg: float, value: float, alpha: float = 0.1) -> float:
+        return value if avg == 0 else avg + alpha * (value - avg)
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            job.start_time = time.perf_counter()
+            wait_time = job.start_time - job.submit_time
+            with self.lock:
+                self.running += 1
+                self.avg_wait_time = self._update_time(self.avg_wait_time, wait_time)
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+            status = "completed"
+            try:
+                if job.cancelled.is_set():
+                    status = "cancelled"
+                elif job.cancel_token is not None and job.cancel_token.expired:
+                    ### 排队期间已超时
+                    status = "cancelled"
+                    job._put(InferenceCancelled("deadline"))
+                else:
+                    generator = (job.run_fn or self.run_fn)(job.inputs)
+                    try:
+                        for item in generator:
+                            if job.cancelled.is_set():
+                                status = "cancelled"
+                                break
+                            job._put(item)
+                    finally:
+                        generator.close()
+            except InferenceCancelled as e:
+                status = "cancelled"
+                job._put(e)
+            except Exception as e:
+                traceback.print_exc()
+                status = "failed"
+                job._put(e)
+            finally:
+                job._put(_END)
+                service_time = time.perf_counter() - job.start_time
+                with self.lock:
+                    self.running -= 1
+                    setattr(self, status, getattr(self, status) + 1)
+                    if status == "completed":
+                        self.avg_service_time = self._update_time(self.avg_service_time, service_time)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "max_queue_size": self.max_queue_size,
+                "running": self.running,
+                "workers": self.num_workers,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "avg_wait_ms": self.avg_wait_time * 1000,
+                "max_wait_ms": self.max_wait_time * 1000,
+                "avg_service_ms": self.avg_service_time * 1000,
+            }
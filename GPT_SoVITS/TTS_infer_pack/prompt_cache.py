@@ -0,0 +1,136 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Hashable, List
+
+import torch
+
+### 构成一个音色的prompt_cache字段，LRU中每个条目保存这些字段
+PROMPT_CACHE_FIELDS = [
+    "ref_audio_path",
+    "aux_ref_audio_paths",
+    "prompt_semantic",
+    "refer_spec",
+    "refer_ge",
+    "raw_audio",
+    "raw_sr",
+    "prompt_text",
+    "prompt_lang",
+    "phones",
+    "bert_features",
+    "norm_text",
+    "fea_ref",
+    "mel2",
+]
+
+_file_hash_cache = {}
+_file_hash_lock = threading.Lock()
+
+
+def get_file_hash(path: str) -> str:
+    """
+    sha256 of a file's content, memoized by (path, size, mtime) so unchanged files are only read once.
+    """
+    stat = os.stat(path)
+    stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hash_lock:
+        if stamp in _file_hash_cache:
+            return _file_hash_cache[stamp]
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    digest = sha256.hexdigest()
+    with _file_hash_lock:
+        _file_hash_cache[stamp] = digest
+    return digest
+
+
+def get_entry_nbytes(item) -> int:
+    if isinstance(item, torch.Tensor):
+        return item.numel() * item.element_size()
+    if isinstance(item, (list, tuple)):
+        return sum(get_entry_nbytes(i) for i in item)
+    if isinstance(item, dict):
+        return sum(get_entry_nbytes(i) for i in item.values())
+    return 0
+
+
+class PromptCacheLRU:
+    """
+    Thread-safe LRU of per-voice prompt entries (see PROMPT_CACHE_FIELDS), bounded by the number
+    of entries and by the total size of their tensors.
+    """
+
+    def __init__(self, capacity: int = 8, max_bytes: int = -1):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Hashable, dict]" = OrderedDict()
+        self.entry_nbytes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def get(self, key: Hashable) -> dict:
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, entry: dict):
+        if not self.enabled:
+            return
+        nbytes = get_entry_nbytes(entry)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if self.max_bytes > 0 and nbytes > self.max_bytes:
+                return
+            self.entries[key] = entry
+            self.entry_nbytes[key] = nbytes
+            self.nbytes += nbytes
+            while len(self.entries) > self.capacity or (self.max_bytes > 0 and self.nbytes > self.max_bytes):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        self.entries.pop(key)
+        self.nbytes -= self.entry_nbytes.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.entry_nbytes.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "capacity": self.capacity,
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def make_prompt_cache_entry(prompt_cache: dict, fields: List[str] = PROMPT_CACHE_FIELDS) -> dict:
+    entry = {}
+    for field in fields:
+        value = prompt_cache.get(field, None)
+        ### 列表需要复制，prompt_cache中的refer_spec等会被原地修改
+        entry[field] = list(value) if isinstance(value, list) else value
+    return entry
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+from typing import Callable, Dict, List, Optional
+
+from .inference_worker import InferenceJob, InferenceWorker, QueueFullError
+
+### 这些参数一致的请求才能合并推理，默认值与TTS.run一致
+BATCH_KEY_FIELDS = [
+    ("ref_audio_path", ""),
+    ("aux_ref_audio_paths", []),
+    ("prompt_text", ""),
+    ("prompt_lang", ""),
+    ("voice_id", None),
+    ("top_k", 5),
+    ("top_p", 1),
+    ("temperature", 1),
+    ("batch_threshold", 0.75),
+    ("split_bucket", True),
+    ("speed_factor", 1.0),
+    ("fragment_interval", 0.3),
+    ("parallel_infer", True),
+    ("repetition_penalty", 1.35),
+    ("sample_steps", 32),
+    ("super_sampling", False),
+]
+
+
+def get_batch_key(inputs: dict) -> Optional[tuple]:
+    """
+    The params a request must share with the others of a batch, None if the request cannot be batched:
+    streaming requests, and requests with a fixed seed since batching changes their result.
+    """
+    if inputs.get("streaming_mode", False) or inputs.get("return_fragment", False):
+        return None
+    if inputs.get("seed", -1) not in [-1, "", None]:
+        return None
+    key = []
+    for field, default in BATCH_KEY_FIELDS:
+        value = inputs.get(field, default)
+        if value is None:
+            value = default
+        key.append(tuple(value) if isinstance(value, list) else value)
+    return tuple(key)
+
+
+class RequestBatcher:
+    """
+    Cross-request micro-batching in front of an InferenceWorker.
+
+    Non-streaming requests with the same batch key (see get_batch_key) arriving within ``max_wait_ms`` of
+    each other are collected, up to ``max_batch_requests``, and synthesized by a single ``run_batch_fn`` call
+    (TTS.run_batch) which packs the segments of all of them into shared batches. Other requests, or all of
+    them when ``max_wait_ms`` is 0, go to the worker unchanged. Must be used from the event loop.
+    """
+
+    def __init__(
+        self,
+        worker: InferenceWorker,
+        run_batch_fn: Callable[[List[dict]], List[tuple]],
+        max_wait_ms: float = 0,
+        max_batch_requests: int = 8,
+    ):
+        self.worker = worker
+        self.run_batch_fn = run_batch_fn
+        self.max_wait_ms = max_wait_ms
+        self.max_batch_requests = max(1, max_batch_requests)
+        self.pending: Dict[tuple, List[InferenceJob]] = {}
+        self.timers: Dict[tuple, asyncio.TimerHandle] = {}
+        self.lock = threading.Lock()
+        self.groups = 0
+        self.batched_requests = 0
+        self.max_group_size = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_wait_ms > 0 and self.max_batch_requests > 1
+
+    def submit(self, inputs: dict) -> InferenceJob:
+        key = get_batch_key(inputs) if self.enabled else None
+        if key is None or self.worker.is_full():
+            ### 队列已满时由worker直接拒绝
+            return self.worker.submit(inputs)
+        loop = asyncio.get_running_loop()
+        job = InferenceJob(inputs, loop)
+        group = self.pending.setdefault(key, [])
+        group.append(job)
+        if len(group) >= self.max_batch_requests:
+            self._flush(key)
+        elif len(group) == 1:
+            self.timers[key] = loop.call_later(self.max_wait_ms / 1000, self._flush, key)
+        return job
+
+    def _flush(self, key: tuple):
+        group = self.pending.pop(key, None)
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if not group:
+            return
+        with self.lock:
+            self.groups += 1
+            self.batched_requests += len(group)
+            self.max_group_size = max(self.max_group_size, len(group))
+        try:
+            group_job = self.worker.submit([job.inputs for job in group], run_fn=self._run_group)
+        except QueueFullError as e:
+            for job in group:
+                job.finish(error=e)
+            return
+        asyncio.ensure_future(self._dispatch(group_job, group))
+
+    def _run_group(self, inputs_list: List[dict]):
+        yield self.run_batch_fn(inputs_list)
+
+    async def _dispatch(self, group_job: InferenceJob, group: List[InferenceJob]):
+        try:
+            results = await group_job.result()
+        except Exception as e:
+            for job in group:
+                job.finish(error=e)
+            return
+        for job, result in zip(group, results):
+            job.finish([result])
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "max_wait_ms": self.max_wait_ms,
+                "max_batch_requests": self.max_batch_requests,
+                "pending": sum(len(group) for group in self.pending.values()),
+                "groups": self.groups,
+                "batched_requests": self.batched_requests,
+                "avg_group_size": self.batched_requests / self.groups if self.groups > 0 else 0.0,
+                "max_group_size": self.max_group_size,
+            }
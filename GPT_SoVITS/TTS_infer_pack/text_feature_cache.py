@@ -0,0 +1,114 @@
+import hashlib
+import os
+import threading
+import traceback
+from typing import List, Optional, Tuple
+
+import torch
+
+from TTS_infer_pack.prompt_cache import PromptCacheLRU
+
+
+class TextFeatureCache:
+    """
+    Cache of the text frontend output (phones, norm_text and bert features) keyed by
+    (segment text, language, version). The key is the raw segment text rather than the normalized
+    text on purpose: the normalized text is only known after text normalization and g2p, which a hit
+    is meant to skip.
+
+    The memory tier is an LRU bounded by the size of the stored bert features, which are kept
+    in half precision on the cpu. With ``disk_dir`` set, entries are also written to disk and
+    loaded back on a memory miss, so the cache stays warm across restarts. Disk entries are loaded
+with ``weights_only``, a file that does not load that way counts as a miss.
+    """
+
+    def __init__(self, max_mb: int = 256, disk_dir: str = None, capacity: int = 100000):
+        self.memory = PromptCacheLRU(capacity if max_mb > 0 else 0, max_mb * 1024 * 1024)
+        self.disk_dir = disk_dir
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self.lock = threading.Lock()
+        if self.disk_dir not in [None, ""]:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory.enabled
+
+    def _disk_path(self, key: tuple) -> str:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_dir, digest[:2], digest + ".pth")
+
+    def get(self, text: str, language: str, version: str) -> Optional[Tuple[list, torch.Tensor, str, torch.dtype]]:
+        """
+        Returns (phones, bert_features [1024, phones_len] half on cpu, norm_text, original dtype), or None.
+        """
+        if not self.enabled:
+            return None
+        key = (text, language, version)
+        entry = self.memory.get(key)
+        if entry is None and self.disk_dir not in [None, ""]:
+            entry = self._load_from_disk(key)
+            if entry is not None:
+                self.memory.put(key, entry)
+        if entry is None:
+            return None
+        return entry["phones"], entry["bert_features"], entry["norm_text"], getattr(torch, entry["dtype"])
+
+    def put(
+        self,
+        text: str,
+        language: str,
+        version: str,
+        phones: List[int],
+        bert_features: torch.Tensor,
+        norm_text: str,
+    ):
+        if not self.enabled:
+            return
+        key = (text, language, version)
+        entry = {
+            "phones": list(phones),
+            "bert_features": bert_features.detach().to("cpu", dtype=torch.float16),
+            "norm_text": norm_text,
+            "dtype": str(bert_features.dtype).replace("torch.", ""),
+        }
+        self.memory.put(key, entry)
+        if self.disk_dir not in [None, ""]:
+            self._save_to_disk(key, entry)
+
+    def _load_from_disk(self, key: tuple) -> Optional[dict]:
+        path = self._disk_path(key)
+        entry = None
+        if os.path.exists(path):
+            try:
+                ### 只反序列化张量与基本类型，缓存目录中的文件不能执行代码
+                entry = torch.load(path, map_location="cpu", weights_only=True)
+            except Exception:
+                traceback.print_exc()
+        if not isinstance(entry, dict) or entry.get("key", None) != key:
+            with self.lock:
+                self.disk_misses += 1
+            return None
+        with self.lock:
+            self.disk_hits += 1
+        return entry
+
+    def _save_to_disk(self, key: tuple, entry: dict):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+            torch.save(dict(entry, key=key), tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            traceback.print_exc()
+
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        with self.lock:
+            stats["disk_hits"] = self.disk_hits
+            stats["disk_misses"] = self.disk_misses
+        return stats
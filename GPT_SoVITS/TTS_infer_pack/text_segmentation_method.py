@@ -184,6 +184,52 @@ def cut5(inp):
     return "\n".join(opt)
 
 
+### 增量切分时，遇到这些句末标点才认为前面的文本已经完整
+sentence_end_splits = {"。", "？", "！", ".", "?", "!", "…", "~", ";", "；", "\n"}
+
+
+class IncrementalTextSplitter:
+    """
+    Splits a text arriving in pieces (e.g. the token stream of a LLM) with a registered method.
+    ``push`` returns the segments that became complete, ``flush`` the rest at the end of the text.
+    """
+
+    def __init__(self, method: str = "cut5", min_len: int = 0):
+        self.method = get_method(method)
+        self.min_len = min_len
+        self.buffer = ""
+
+    def _find_boundary(self) -> int:
+        text = self.buffer
+        for i in range(len(text) - 1, -1, -1):
+            char = text[i]
+            if char not in sentence_end_splits:
+                continue
+            if char == "." and i > 0 and text[i - 1].isdigit():
+                ### 小数点后面的数字可能还没到
+                if i == len(text) - 1 or text[i + 1].isdigit():
+                    continue
+            return i + 1
+        return 0
+
+    def _split(self, text: str) -> list:
+        if text.strip() == "" or set(text).issubset(punctuation | splits | {"\n"}):
+            return []
+        return [item for item in self.method(text).split("\n") if item.strip() != "" and item != "/n"]
+
+    def push(self, text: str) -> list:
+        self.buffer += text
+        boundary = self._find_boundary()
+        if boundary == 0 or len(self.buffer[:boundary].strip()) < self.min_len:
+            return []
+        text, self.buffer = self.buffer[:boundary], self.buffer[boundary:]
+        return self._split(text)
+
+    def flush(self) -> list:
+        text, self.buffer = self.buffer, ""
+        return self._split(text)
+
+
 if __name__ == "__main__":
     method = get_method("cut5")
     print(method("你好，我是小明。你好，我是小红。你好，我是小刚。你好，我是小张。"))
@@ -0,0 +1,124 @@
+"""
+Voice packs: the prompt features of a reference voice (prompt semantic tokens, reference spectrograms and
+embedding, prompt phones and BERT features, and the v3 CFM prompt features) precomputed with
+``TTS.build_voice_pack`` and saved to disk, so that switching voices only loads tensors.
+"""
+
+import hashlib
+import os
+from typing import List
+
+import torch
+
+from TTS_infer_pack.prompt_cache import get_file_hash
+
+VOICE_PACK_FORMAT_VERSION = 2
+VOICE_PACK_SUFFIX = ".pth"
+
+### 保存到音色包中的prompt_cache字段
+VOICE_PACK_FIELDS = [
+    "ref_audio_path",
+    "aux_ref_audio_paths",
+    "prompt_semantic",
+    "refer_spec",
+    "refer_ge",
+    "prompt_text",
+    "prompt_lang",
+    "phones",
+    "bert_features",
+    "norm_text",
+    "fea_ref",
+    "mel2",
+]
+### 构建时写入的元数据，加载时校验
+VOICE_PACK_META_FIELDS = ["format_version", "key", "voice_id", "model_version", "vits_weights"]
+
+
+def get_voice_pack_key(
+    ref_audio_path: str,
+    aux_ref_audio_paths: List[str],
+    prompt_text: str,
+    prompt_lang: str,
+    model_version: str,
+    vits_weights_path: str,
+) -> str:
+    """
+    Content hash of the reference audios and prompt text, together with the models the features depend on.
+    Computed from the fields stored in the pack, so that check_voice_pack can recompute it.
+    """
+    sha256 = hashlib.sha256()
+    for path in [ref_audio_path] + list(aux_ref_audio_paths or []):
+        if path in [None, ""] or not os.path.exists(path):
+            continue
+        sha256.update(get_file_hash(path).encode("utf-8"))
+        sha256.update(b"\0")
+    for item in [prompt_text, prompt_lang, model_version, os.path.basename(vits_weights_path)]:
+        sha256.update(str(item).encode("utf-8"))
+        sha256.update(b"\0")
+    return sha256.hexdigest()
+
+
+def get_voice_pack_path(voice_pack_dir: str, voice_id: str) -> str:
+    if voice_id in [None, ""] or os.path.basename(voice_id) != voice_id:
+        raise ValueError(f"invalid voice id: {voice_id}")
+    return os.path.join(voice_pack_dir, voice_id + VOICE_PACK_SUFFIX)
+
+
+def _to_cpu(item):
+    if isinstance(item, torch.Tensor):
+        return item.detach().cpu().contiguous()
+    if isinstance(item, list):
+        return [_to_cpu(i) for i in item]
+    return item
+
+
+def save_voice_pack(pack: dict, path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    pack = {key: _to_cpu(value) for key, value in pack.items()}
+    ### 先写临时文件再替换，避免服务读到写了一半的音色包
+    tmp_path = path + ".tmp"
+    torch.save(pack, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_voice_pack(path: str, mmap: bool = True) -> dict:
+    """
+    Load a voice pack onto the cpu, memory-mapped when the installed torch supports it.
+    Only tensors and plain containers are unpickled (weights_only), a pack can not run code.
+    """
+    if not os.path.exists(path):
+        raise ValueError(f"voice pack {path} not exists")
+    try:
+        pack = torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+    except TypeError:
+        ### 旧版本torch不支持mmap参数
+        pack = torch.load(path, map_location="cpu", weights_only=True)
+    if not isinstance(pack, dict) or pack.get("format_version", None) != VOICE_PACK_FORMAT_VERSION:
+        raise ValueError(f"unsupported voice pack format: {path}")
+    missing = [field for field in VOICE_PACK_FIELDS + VOICE_PACK_META_FIELDS if field not in pack]
+    if len(missing) > 0:
+        raise ValueError(f"voice pack {path} is missing {missing}")
+    return pack
+
+
+def check_voice_pack(pack: dict, model_version: str, vits_weights_path: str):
+    if pack["model_version"] != model_version or pack["vits_weights"] != os.path.basename(vits_weights_path):
+        raise ValueError(
+            f"voice pack {pack['voice_id']} was built with {pack['vits_weights']} ({pack['model_version']}), "
+            f"but the current SoVITS model is {os.path.basename(vits_weights_path)} ({model_version}), please rebuild it"
+        )
+    ### 参考音频还在时重新计算key，音频或提示文本与构建时不一致说明音色包已过期
+    paths = [pack["ref_audio_path"]] + list(pack["aux_ref_audio_paths"] or [])
+    if all(path not in [None, ""] and os.path.exists(path) for path in paths):
+        key = get_voice_pack_key(
+            pack["ref_audio_path"],
+            pack["aux_ref_audio_paths"],
+            pack["prompt_text"],
+            pack["prompt_lang"],
+            model_version,
+            vits_weights_path,
+        )
+        if key != pack["key"]:
+            raise ValueError(
+                f"voice pack {pack['voice_id']} does not match its reference audio and prompt text, please rebuild it"
+            )
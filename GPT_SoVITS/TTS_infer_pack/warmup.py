@@ -0,0 +1,118 @@
+"""
+Warmup requests run once after the models are loaded, so that the first real request does not pay the lazy costs:
+kernel selection of cudnn/oneDNN for the first shapes, the text frontends (jieba dictionary, g2pw, pyopenjtalk,
+the korean and cantonese g2p), and the models loaded on first use (e.g. the v3 super-sampling model).
+
+A warmup script is a JSON list, or a JSONL file, of TTS.run inputs with an optional "name". Requests without
+"ref_audio_path" and "voice_id" use a synthetic reference audio, so the script only has to list texts and modes.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from typing import List
+
+import numpy as np
+import soundfile as sf
+
+WARMUP_PROMPT_TEXT = "这是一段用于预热的参考音频。"
+WARMUP_PROMPT_LANG = "zh"
+
+### 覆盖各语言的文本前端
+WARMUP_TEXTS = {
+    "zh": "你好，这是一条预热请求。它会提前加载模型和词典，第一位用户就不用等待了。",
+    "en": "This is a warmup request, it loads the models before the first user arrives.",
+    "ja": "これはウォームアップのリクエストです。",
+    "ko": "이것은 워밍업 요청입니다.",
+    "yue": "呢個係預熱請求，第一個用戶就唔使等。",
+    "auto": "中文和English混合的预热请求。",
+}
+
+
+def default_warmup_requests(languages: List[str], is_v3: bool = False) -> List[dict]:
+    """
+    One request per supported language, and the inference modes of the api on the chinese text.
+    """
+    requests = []
+    for lang, text in WARMUP_TEXTS.items():
+        if lang in languages:
+            requests.append({"name": lang, "text": text, "text_lang": lang, "text_split_method": "cut5"})
+    zh = {"text": WARMUP_TEXTS["zh"], "text_lang": "zh", "text_split_method": "cut5"}
+    requests.extend(
+        [
+            dict(zh, name="batch", batch_size=4),
+            dict(zh, name="fragment", return_fragment=True),
+            dict(zh, name="serial", parallel_infer=False),
+        ]
+    )
+    if is_v3:
+        requests.append(dict(zh, name="super_sampling", super_sampling=True))
+    else:
+        requests.append(dict(zh, name="chunked", return_fragment=True, streaming_chunk_size=24))
+    return requests
+
+
+def load_warmup_script(path: str) -> List[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    if content.lstrip().startswith("["):
+        requests = json.loads(content)
+    else:
+        requests = [json.loads(line) for line in content.splitlines() if line.strip() != ""]
+    for i, request in enumerate(requests):
+        if not isinstance(request, dict) or request.get("text", "") in [None, ""]:
+            raise ValueError(f"warmup request {i} of {path} should be an object with a text")
+    return requests
+
+
+def write_reference_audio(path: str, sr: int = 32000, seconds: float = 5.0):
+    """
+    A voiced-like synthetic reference: a few harmonics with a varying pitch and syllable envelope, plus noise.
+    """
+    t = np.arange(int(sr * seconds)) / sr
+    rng = np.random.default_rng(0)
+    f0 = 160 + 30 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    audio = sum(np.sin(k * phase) / k for k in range(1, 6))
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t) ** 2
+    audio = 0.2 * audio * envelope + 0.01 * rng.standard_normal(len(t))
+    sf.write(path, audio.astype(np.float32), sr)
+
+
+def run_warmup(tts, requests: List[dict]) -> List[dict]:
+    """
+    Runs the warmup requests on ``tts`` (a TTS object) and returns the time or the error of each of them.
+    A failed warmup request is reported, it does not stop the others.
+    """
+    ref_dir = None
+    results = []
+    try:
+        for i, request in enumerate(requests):
+            inputs = dict(request)
+            name = str(inputs.pop("name", i))
+            if inputs.get("ref_audio_path", None) in [None, ""] and inputs.get("voice_id", None) in [None, ""]:
+                if ref_dir is None:
+                    ref_dir = tempfile.mkdtemp(prefix="gpt_sovits_warmup_")
+                    write_reference_audio(os.path.join(ref_dir, "warmup_ref.wav"))
+                inputs.update(
+                    ref_audio_path=os.path.join(ref_dir, "warmup_ref.wav"),
+                    prompt_text=WARMUP_PROMPT_TEXT,
+                    prompt_lang=WARMUP_PROMPT_LANG,
+                )
+            t0 = time.perf_counter()
+            try:
+                for _ in tts.run(inputs):
+                    pass
+            except Exception as e:
+                traceback.print_exc()
+                results.append({"name": name, "seconds": time.perf_counter() - t0, "error": str(e)})
+                continue
+            results.append({"name": name, "seconds": time.perf_counter() - t0, "error": None})
+            print(f"warmup {name}: {results[-1]['seconds']:.3f}s")
+    finally:
+        if ref_dir is not None:
+            shutil.rmtree(ref_dir, ignore_errors=True)
+    return results
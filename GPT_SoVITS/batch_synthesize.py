@@ -0,0 +1,69 @@
+"""
+Render a JSONL manifest of texts offline, see TTS_infer_pack/batch_job.py for the manifest format.
+
+python GPT_SoVITS/batch_synthesize.py -c GPT_SoVITS/configs/tts_infer.yaml --manifest jobs.jsonl --output_dir out \
+    --ref_audio archive_jingyuan_1.wav --prompt_lang zh --prompt_text "我是「罗浮」云骑将军景元。"
+
+--ref_audio / --prompt_text / --prompt_lang / --voice_id are the voice of the items that do not set their own.
+Rerunning the same command after a crash skips the items already rendered in --output_dir.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+from GPT_SoVITS.TTS_infer_pack.TTS import TTS, TTS_Config
+from GPT_SoVITS.TTS_infer_pack.batch_job import AUDIO_FORMATS, BatchJob
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPT-SoVITS offline batch synthesis")
+    parser.add_argument("-c", "--tts_config", type=str, default="GPT_SoVITS/configs/tts_infer.yaml", help="tts_infer路径")
+    parser.add_argument("--manifest", required=True, help="JSONL manifest, one item per line")
+    parser.add_argument("--output_dir", required=True, help="Directory of the rendered audio and status.jsonl")
+    parser.add_argument("--ref_audio", type=str, default=None, help="Default reference audio")
+    parser.add_argument("--prompt_text", type=str, default=None, help="Default prompt text")
+    parser.add_argument("--prompt_lang", type=str, default=None, help="Default prompt language")
+    parser.add_argument("--voice_id", type=str, default=None, help="Default voice pack id")
+    parser.add_argument("--text_lang", type=str, default=None, help="Default language of the texts")
+    parser.add_argument("--params", type=str, default=None, help="Other default params of TTS.run, as a json object")
+    parser.add_argument("--requests_per_batch", type=int, default=16, help="Items synthesized together")
+    parser.add_argument("--batch_size", type=int, default=None, help="T2S/VITS batch size, default: all segments")
+    parser.add_argument("--format", type=str, default="wav", choices=AUDIO_FORMATS, help="Output audio format")
+    args = parser.parse_args()
+
+    defaults = json.loads(args.params) if args.params is not None else {}
+    for key, value in [
+        ("ref_audio_path", args.ref_audio),
+        ("prompt_text", args.prompt_text),
+        ("prompt_lang", args.prompt_lang),
+        ("voice_id", args.voice_id),
+        ("text_lang", args.text_lang),
+    ]:
+        if value is not None:
+            defaults[key] = value
+
+    job = BatchJob(
+        args.manifest,
+        args.output_dir,
+        requests_per_batch=args.requests_per_batch,
+        batch_size=args.batch_size,
+        audio_format=args.format,
+        defaults=defaults,
+    )
+    tts_pipeline = TTS(TTS_Config(args.tts_config))
+    job.run(tts_pipeline.run_batch)
+    stats = job.stats()
+    print(
+        f"{stats['completed']} rendered, {stats['skipped']} skipped, {stats['failed']} failed, "
+        f"{stats['audio_seconds']:.1f}s of audio in {stats['elapsed']:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
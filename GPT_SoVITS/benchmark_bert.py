@@ -0,0 +1,107 @@
+"""
+Parity check and throughput of the batched bert feature extraction of TextPreprocessor.
+
+python GPT_SoVITS/benchmark_bert.py --bert_path GPT_SoVITS/pretrained_models/chinese-roberta-wwm-ext-large \
+    --device cuda --half --bert_batch_size 16 -n 5
+
+The text is split into sentences of different lengths, and the features of every chinese segment are computed
+once per segment with get_bert_feature and once with get_bert_features_batch, which pads each batch to its
+longest segment. The shapes must be equal and the values equal within --atol (1e-4 for fp32, 1e-2 for fp16 by
+default): padded tokens are masked out of the attention, the remaining difference comes from the matmuls
+running on other shapes.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+import torch
+from transformers import AutoModelForMaskedLM, AutoTokenizer
+
+from TTS_infer_pack.TextPreprocessor import TextPreprocessor
+
+DEFAULT_TEXT = (
+    "先帝创业未半而中道崩殂，今天下三分，益州疲弊，此诚危急存亡之秋也。"
+    "然侍卫之臣不懈于内，忠志之士忘身于外者，盖追先帝之殊遇，欲报之于陛下也。"
+    "诚宜开张圣听，以光先帝遗德，恢弘志士之气，不宜妄自菲薄，引喻失义，以塞忠谏之路也。"
+    "宫中府中，俱为一体。陟罚臧否，不宜异同。"
+    "若有作奸犯科及为忠善者，宜付有司论其刑赏，以昭陛下平明之理，不宜偏私，使内外异法也。"
+    "好的。"
+)
+
+
+def get_segments(preprocessor: TextPreprocessor, text: str, language: str, version: str):
+    segments = []
+    for sentence in preprocessor.pre_seg_text(text, language, "cut5"):
+        _, bert_parts, _ = preprocessor.get_phones_and_bert_parts(sentence, language, version)
+        segments.extend(part for part in bert_parts if isinstance(part, tuple))
+    return segments
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bert batch parity check and benchmark")
+    parser.add_argument(
+        "--bert_path", type=str, default="GPT_SoVITS/pretrained_models/chinese-roberta-wwm-ext-large"
+    )
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--half", action="store_true", help="fp16 weights")
+    parser.add_argument("--bert_batch_size", type=int, default=16)
+    parser.add_argument("--text_file", type=str, default=None, help="text to check, the built-in text by default")
+    parser.add_argument("--language", type=str, default="zh")
+    parser.add_argument("--version", type=str, default="v2")
+    parser.add_argument("--atol", type=float, default=None, help="max abs difference of the features")
+    parser.add_argument("-n", type=int, default=3, help="timed iterations")
+    args = parser.parse_args()
+
+    text = DEFAULT_TEXT
+    if args.text_file is not None:
+        with open(args.text_file, "r", encoding="utf-8") as f:
+            text = f.read()
+    atol = args.atol if args.atol is not None else (1e-2 if args.half else 1e-4)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.bert_path)
+    bert_model = AutoModelForMaskedLM.from_pretrained(args.bert_path).to(args.device).eval()
+    if args.half:
+        bert_model = bert_model.half()
+    preprocessor = TextPreprocessor(bert_model, tokenizer, args.device, bert_batch_size=args.bert_batch_size)
+
+    segments = get_segments(preprocessor, text, args.language, args.version)
+    if len(segments) < 2:
+        raise ValueError("the text needs at least two chinese segments to check the padded batches")
+    lengths = sorted(len(norm_text) for norm_text, _ in segments)
+    print(f"{len(segments)} segments, {lengths[0]} to {lengths[-1]} characters")
+
+    expected = [preprocessor.get_bert_feature(norm_text, word2ph) for norm_text, word2ph in segments]
+    result = preprocessor.get_bert_features_batch(segments)
+    max_diff = 0.0
+    for (norm_text, _), a, b in zip(segments, expected, result):
+        assert a.shape == b.shape, f"shape mismatch on {norm_text}: {tuple(a.shape)} vs {tuple(b.shape)}"
+        diff = float((a.float() - b.float()).abs().max())
+        assert diff <= atol, f"feature mismatch on {norm_text}: max abs diff {diff:.2e} > {atol:.0e}"
+        max_diff = max(max_diff, diff)
+    print(f"parity ok, max abs diff {max_diff:.2e} (atol {atol:.0e})")
+
+    num_chars = sum(lengths)
+    for name, fn in [
+        ("per segment", lambda: [preprocessor.get_bert_feature(*segment) for segment in segments]),
+        ("batched", lambda: preprocessor.get_bert_features_batch(segments)),
+    ]:
+        fn()
+        if "cuda" in str(args.device):
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        for _ in range(args.n):
+            fn()
+        if "cuda" in str(args.device):
+            torch.cuda.synchronize()
+        cost = time.perf_counter() - t0
+        print(f"{name}: {cost / args.n * 1000:.1f} ms per text, {args.n * num_chars / cost:.1f} chars/s")
+
+
+if __name__ == "__main__":
+    main()
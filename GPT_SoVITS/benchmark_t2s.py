@@ -0,0 +1,215 @@
+"""
+T2S decoding throughput benchmark, tokens per second of the decode loops on random text and prompt tokens.
+
+python GPT_SoVITS/benchmark_t2s.py --t2s_weights GPT_SoVITS/pretrained_models/s1v3.ckpt --device cuda --half \
+    --batch_size 4 --modes batch,batch_sync_free,batch_packed,naive,naive_sync_free,naive_speculative
+
+Without --t2s_weights the model is randomly initialized with the shape of the pretrained v2 model, which is enough
+to compare the loops: the number of generated tokens is fixed by --steps. The acceptance rate of the speculative
+mode is only meaningful with real weights, speedup is the tokens/s against the naive mode.
+
+--sampler times one sampling step of ``sample`` against ``T2SSampler`` instead (no model), and compares the
+distributions of many draws from the same logits. It also checks that ``sample``, ``T2SSampler`` and the grouped
+sampling of T2SScheduler stop on EOS from the same penalized logits.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+import torch
+
+from AR.models.t2s_model import Text2SemanticDecoder
+from AR.models.utils import T2SSampler, sample, sample_groups
+
+DEFAULT_CONFIG = {
+    "model": {
+        "hidden_dim": 512,
+        "embedding_dim": 512,
+        "head": 16,
+        "n_layer": 24,
+        "vocab_size": 1025,
+        "phoneme_vocab_size": 732,
+        "dropout": 0,
+        "EOS": 1024,
+    }
+}
+
+
+def load_model(weights_path: str, device: str, half: bool) -> Text2SemanticDecoder:
+    if weights_path is None:
+        model = Text2SemanticDecoder(DEFAULT_CONFIG)
+    else:
+        dict_s1 = torch.load(weights_path, map_location="cpu")
+        model = Text2SemanticDecoder(dict_s1["config"])
+        ### 权重保存自Text2SemanticLightningModule，参数名带有"model."前缀
+        model.load_state_dict({k[len("model.") :]: v for k, v in dict_s1["weight"].items() if k.startswith("model.")})
+    model = model.to(device).eval()
+    return model.half() if half else model
+
+
+def make_inputs(
+    model: Text2SemanticDecoder, batch_size: int, text_len: int, prompt_len: int, device, dtype, min_text_len=None
+):
+    if min_text_len is None:
+        lengths = [text_len - i % 4 for i in range(batch_size)]
+    else:
+        ### 长度在[min_text_len, text_len]之间均匀分布，对比padding和打包的prefill
+        step = (text_len - min_text_len) / max(batch_size - 1, 1)
+        lengths = [round(text_len - i * step) for i in range(batch_size)]
+    x = [torch.randint(0, model.phoneme_vocab_size, (length,), device=device) for length in lengths]
+    x_lens = torch.LongTensor([item.shape[0] for item in x]).to(device)
+    bert_feature = [torch.randn((1024, item.shape[0]), device=device, dtype=dtype) for item in x]
+    prompts = torch.randint(0, model.EOS, (batch_size, prompt_len), device=device)
+    return x, x_lens, prompts, bert_feature
+
+
+MODES = {
+    ### name: (方法, 额外参数)
+    "batch": ("infer_panel_batch_infer", {}),
+    "batch_sync_free": ("infer_panel_batch_infer", {"sync_interval": 8}),
+    "batch_packed": ("infer_panel_batch_infer", {"packed_prefill": True}),
+    "naive": ("infer_panel_naive_batched", {}),
+    "naive_sync_free": ("infer_panel_naive_batched", {"sync_interval": 8}),
+    "naive_speculative": ("infer_panel_naive_batched", {"speculative_steps": 4, "draft_layers": 8}),
+}
+
+
+def benchmark_sampler(args):
+    vocab_size = DEFAULT_CONFIG["model"]["vocab_size"]
+    params = {"top_k": 15, "top_p": 0.9, "temperature": 1.0, "repetition_penalty": 1.35}
+    torch.manual_seed(0)
+    prompts = torch.randint(0, vocab_size - 1, (args.batch_size, args.prompt_len), device=args.device)
+    logits_list = [torch.randn((args.batch_size, vocab_size), device=args.device) * 3 for _ in range(args.steps)]
+
+    def run_sample():
+        y = prompts
+        for logits in logits_list:
+            y = torch.concat([y, sample(logits.clone(), y, **params)[0]], dim=1)
+
+    def run_sampler():
+        sampler = T2SSampler(prompts, args.batch_size, vocab_size, args.device, **params)
+        for logits in logits_list:
+            sampler(logits)
+
+    for name, fn in [("sample", run_sample), ("T2SSampler", run_sampler)]:
+        times = []
+        for i in range(args.repeat + 1):
+            t0 = time.perf_counter()
+            fn()
+            if i > 0:
+                times.append(time.perf_counter() - t0)
+        print(f"{name}: {sum(times) / len(times) / args.steps * 1000:.3f} ms per step")
+
+    ### 同一组logits和历史token上多次采样，比较两者的分布(总变差距离)
+    num_draws = 20000
+    logits = logits_list[0][:1].expand(num_draws, -1)
+    history = prompts[:1].expand(num_draws, -1)
+    counts_sample = torch.bincount(sample(logits.clone(), history, **params)[0][:, 0].long(), minlength=vocab_size)
+    sampler = T2SSampler(history, num_draws, vocab_size, args.device, **params)
+    counts_sampler = torch.bincount(sampler(logits)[0][:, 0].long(), minlength=vocab_size)
+    distance = (counts_sample - counts_sampler).abs().sum().item() / 2 / num_draws
+    print(f"total variation distance of {num_draws} draws: {distance:.4f}")
+
+    ### 解码循环在采样后的logits上判断EOS：历史中出现过的token在惩罚前高于EOS，惩罚后低于EOS
+    eos = vocab_size - 1
+    repeated = int(prompts[0, 0])
+    logits = torch.zeros((1, vocab_size), device=args.device)
+    logits[0, repeated] = 5.0
+    logits[0, eos] = 4.0
+    sample_logits = logits.clone()
+    sample(sample_logits, prompts[:1], **params)
+    _, sampler_logits = T2SSampler(prompts[:1], 1, vocab_size, args.device, **params)(logits.clone())
+    eos_sample = int(torch.argmax(sample_logits, dim=-1)[0]) == eos
+    eos_sampler = int(torch.argmax(sampler_logits, dim=-1)[0]) == eos
+    assert eos_sample and eos_sampler, f"EOS stop test differs: sample {eos_sample}, T2SSampler {eos_sampler}"
+    assert torch.equal(sample_logits, sampler_logits), "penalized logits differ"
+    print("EOS stop test on penalized logits: same as sample")
+
+    ### T2SScheduler按采样参数分组采样，第二行不惩罚重复，应当选中重复的token而不是EOS
+    no_penalty = dict(params, repetition_penalty=1.0)
+    groups = {
+        (params["top_k"], params["top_p"], params["temperature"], params["repetition_penalty"]): [0],
+        (no_penalty["top_k"], no_penalty["top_p"], no_penalty["temperature"], no_penalty["repetition_penalty"]): [1],
+    }
+    _, tokens = sample_groups(logits.expand(2, -1).clone(), prompts[:1].expand(2, -1), groups)
+    assert tokens.tolist() == [eos, repeated], f"T2SScheduler EOS stop test: {tokens.tolist()}"
+    print("EOS stop test on penalized logits: same in T2SScheduler")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T2S decoding benchmark")
+    parser.add_argument("--t2s_weights", type=str, default=None, help="T2S checkpoint, random weights by default")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--half", action="store_true", help="fp16 weights")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--text_len", type=int, default=64, help="phonemes per sequence")
+    parser.add_argument("--min_text_len", type=int, default=None, help="spread the text lengths down to this")
+    parser.add_argument("--prompt_len", type=int, default=150, help="prompt semantic tokens")
+    parser.add_argument("--steps", type=int, default=200, help="tokens generated per sequence (early_stop_num)")
+    parser.add_argument("--sync_interval", type=int, default=8, help="sync interval of the *_sync_free modes")
+    parser.add_argument("--speculative_steps", type=int, default=4, help="draft tokens per round, *_speculative")
+    parser.add_argument("--draft_layers", type=int, default=8, help="blocks of the draft, *_speculative")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--modes", type=str, default=",".join(MODES))
+    parser.add_argument("--sampler", action="store_true", help="benchmark the sampling step only")
+    args = parser.parse_args()
+
+    if args.sampler:
+        benchmark_sampler(args)
+        return
+
+    dtype = torch.float16 if args.half else torch.float32
+    model = load_model(args.t2s_weights, args.device, args.half)
+    torch.manual_seed(0)
+    inputs = make_inputs(
+        model, args.batch_size, args.text_len, args.prompt_len, args.device, dtype, args.min_text_len
+    )
+
+    for mode in args.modes.split(","):
+        method, kwargs = MODES[mode]
+        if "sync_interval" in kwargs:
+            kwargs = dict(kwargs, sync_interval=args.sync_interval)
+        if "speculative_steps" in kwargs:
+            kwargs = dict(kwargs, speculative_steps=args.speculative_steps, draft_layers=args.draft_layers)
+        stats_before = model.get_speculative_stats()
+        infer_panel = getattr(model, method)
+        times = []
+        tokens = 0
+        for i in range(args.repeat + 1):
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+            with torch.no_grad():
+                _, idx_list = infer_panel(
+                    *inputs,
+                    top_k=15,
+                    top_p=1,
+                    temperature=1,
+                    early_stop_num=args.steps,
+                    max_len=args.text_len,
+                    **kwargs,
+                )
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            ### 第一次为预热，不计时
+            if i > 0:
+                times.append(time.perf_counter() - t0)
+                tokens += sum(int(idx) for idx in idx_list)
+        print(f"{mode}: {tokens / sum(times):.1f} tokens/s, {sum(times) / len(times) * 1000:.1f} ms per call")
+        if "speculative_steps" in kwargs:
+            stats_after = model.get_speculative_stats()
+            stats = {key: stats_after[key] - stats_before[key] for key in stats_before}
+            print(
+                f"{mode}: acceptance rate {stats['accepted'] / max(stats['proposed'], 1):.3f}, "
+                f"{stats['tokens'] / max(stats['rounds'], 1):.2f} tokens per full forward"
+            )
+
+
+if __name__ == "__main__":
+    main()
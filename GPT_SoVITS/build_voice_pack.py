@@ -0,0 +1,53 @@
+"""
+Build a voice pack (precomputed prompt features of a reference voice) for TTS_infer_pack / api_v2.py.
+
+python GPT_SoVITS/build_voice_pack.py -c GPT_SoVITS/configs/tts_infer.yaml --voice_id jingyuan \
+    --ref_audio archive_jingyuan_1.wav --prompt_lang zh --prompt_text "我是「罗浮」云骑将军景元。"
+
+The pack is saved to <voice_pack_dir>/<voice_id>.pth and used with the "voice_id" parameter of /tts.
+"""
+
+import argparse
+import os
+import sys
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append("%s/GPT_SoVITS" % (now_dir))
+
+from GPT_SoVITS.TTS_infer_pack.TTS import TTS, TTS_Config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPT-SoVITS voice pack builder")
+    parser.add_argument("-c", "--tts_config", type=str, default="GPT_SoVITS/configs/tts_infer.yaml", help="tts_infer路径")
+    parser.add_argument("--ref_audio", required=True, help="Path to the reference audio file")
+    parser.add_argument("--prompt_text", type=str, default="", help="Prompt text of the reference audio")
+    parser.add_argument("--prompt_text_path", type=str, default=None, help="Read the prompt text from a file instead")
+    parser.add_argument("--prompt_lang", type=str, default="zh", help="Language of the prompt text")
+    parser.add_argument(
+        "--aux_ref_audio", type=str, nargs="*", default=[], help="Auxiliary reference audios for tone fusion"
+    )
+    parser.add_argument("--voice_id", type=str, default=None, help="Id of the voice, defaults to the content hash")
+    parser.add_argument("--output", type=str, default=None, help="Output path, defaults to <voice_pack_dir>/<voice_id>.pth")
+    args = parser.parse_args()
+
+    prompt_text = args.prompt_text
+    if args.prompt_text_path is not None:
+        with open(args.prompt_text_path, "r", encoding="utf-8") as f:
+            prompt_text = f.read()
+
+    tts_pipeline = TTS(TTS_Config(args.tts_config))
+    pack = tts_pipeline.build_voice_pack(
+        args.ref_audio,
+        prompt_text,
+        args.prompt_lang.lower(),
+        aux_ref_audio_paths=args.aux_ref_audio,
+        voice_id=args.voice_id,
+    )
+    path = tts_pipeline.save_voice_pack(pack, args.output)
+    print(f"Voice pack {pack['voice_id']} saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -126,6 +126,8 @@ from text import cleaned_text_to_sequence
 from text.cleaner import clean_text
 
 from tools.i18n.i18n import I18nAuto, scan_language_list
+from tools.ref_audio import RefAudio, load_ref_audio
+from tools.ref_audio import resample as ref_audio_resample
 
 language = os.environ.get("language", "Auto")
 language = sys.argv[-1] if sys.argv[-1] in scan_language_list() else language
@@ -219,14 +221,8 @@ if is_half == True:
 else:
     ssl_model = ssl_model.to(device)
 
-resample_transform_dict = {}
-
-
 def resample(audio_tensor, sr0):
-    global resample_transform_dict
-    if sr0 not in resample_transform_dict:
-        resample_transform_dict[sr0] = torchaudio.transforms.Resample(sr0, 24000).to(device)
-    return resample_transform_dict[sr0](audio_tensor)
+    return ref_audio_resample(audio_tensor.to(device), sr0, 24000)
 
 
 ###todo:put them to process_ckpt and modify my_save func (save sovits weights), gpt save weights use my_save in process_ckpt
@@ -416,8 +412,8 @@ else:
 
 def get_spepc(hps, filename):
     # audio = load_audio(filename, int(hps.data.sampling_rate))
-    audio, sampling_rate = librosa.load(filename, sr=int(hps.data.sampling_rate))
-    audio = torch.FloatTensor(audio)
+    ref_audio = filename if isinstance(filename, RefAudio) else load_ref_audio(filename)
+    audio = ref_audio.get(int(hps.data.sampling_rate)).clone()
     maxx = audio.abs().max()
     if maxx > 1:
         audio /= min(2, maxx)
@@ -673,13 +669,14 @@ def get_tts_wav(
         zero_wav_torch = zero_wav_torch.half().to(device)
     else:
         zero_wav_torch = zero_wav_torch.to(device)
+    ### 参考音频只解码一次
+    ref_wav = load_ref_audio(ref_wav_path)
     if not ref_free:
         with torch.no_grad():
-            wav16k, sr = librosa.load(ref_wav_path, sr=16000)
+            wav16k = ref_wav.get(16000)
             if wav16k.shape[0] > 160000 or wav16k.shape[0] < 48000:
                 gr.Warning(i18n("参考音频在3~10秒范围外，请更换！"))
                 raise OSError(i18n("参考音频在3~10秒范围外，请更换！"))
-            wav16k = torch.from_numpy(wav16k)
             if is_half == True:
                 wav16k = wav16k.half().to(device)
             else:
@@ -765,22 +762,17 @@ def get_tts_wav(
                     except:
                         traceback.print_exc()
             if len(refers) == 0:
-                refers = [get_spepc(hps, ref_wav_path).to(dtype).to(device)]
+                refers = [get_spepc(hps, ref_wav).to(dtype).to(device)]
             audio = vq_model.decode(
                 pred_semantic, torch.LongTensor(phones2).to(device).unsqueeze(0), refers, speed=speed
             )[0][0]  # .cpu().detach().numpy()
         else:
-            refer = get_spepc(hps, ref_wav_path).to(device).to(dtype)
+            refer = get_spepc(hps, ref_wav).to(device).to(dtype)
             phoneme_ids0 = torch.LongTensor(phones1).to(device).unsqueeze(0)
             phoneme_ids1 = torch.LongTensor(phones2).to(device).unsqueeze(0)
             # print(11111111, phoneme_ids0, phoneme_ids1)
             fea_ref, ge = vq_model.decode_encp(prompt.unsqueeze(0), phoneme_ids0, refer)
-            ref_audio, sr = torchaudio.load(ref_wav_path)
-            ref_audio = ref_audio.to(device).float()
-            if ref_audio.shape[0] == 2:
-                ref_audio = ref_audio.mean(0).unsqueeze(0)
-            if sr != 24000:
-                ref_audio = resample(ref_audio, sr)
+            ref_audio = ref_wav.get(24000).unsqueeze(0).to(device)
             # print("ref_audio",ref_audio.abs().mean())
             mel2 = mel_fn(ref_audio)
             mel2 = norm_spec(mel2)
@@ -940,8 +940,13 @@ class SynthesizerTrn(nn.Module):
         return o, y_mask, (z, z_p, m_p, logs_p)
 
     @torch.no_grad()
-    def decode(self, codes, text, refer, noise_scale=0.5, speed=1):
-        def get_ge(refer):
+    def get_ge(self, refer):
+        """
+        Reference embedding of one spectrogram, or the mean embedding of a list of spectrograms.
+        The result can be passed to ``decode`` as ``ge`` to skip ref_enc.
+        """
+
+        def _get_ge(refer):
             ge = None
             if refer is not None:
                 refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
@@ -955,11 +960,17 @@ class SynthesizerTrn(nn.Module):
         if type(refer) == list:
             ges = []
             for _refer in refer:
-                ge = get_ge(_refer)
+                ge = _get_ge(_refer)
                 ges.append(ge)
             ge = torch.stack(ges, 0).mean(0)
         else:
-            ge = get_ge(refer)
+            ge = _get_ge(refer)
+        return ge
+
+    @torch.no_grad()
+    def decode(self, codes, text, refer, noise_scale=0.5, speed=1, ge=None):
+        if ge is None:
+            ge = self.get_ge(refer)
 
         y_lengths = torch.LongTensor([codes.size(2) * 2]).to(codes.device)
         text_lengths = torch.LongTensor([text.size(-1)]).to(text.device)
@@ -993,8 +1004,8 @@ class CFM(torch.nn.Module):
         self.criterion = torch.nn.MSELoss()
 
     @torch.inference_mode()
-    def inference(self, mu, x_lens, prompt, n_timesteps, temperature=1.0, inference_cfg_rate=0):
-        """Forward diffusion"""
+    def inference(self, mu, x_lens, prompt, n_timesteps, temperature=1.0, inference_cfg_rate=0, cancel_check=None):
+        """Forward diffusion, ``cancel_check`` is called before every step and may raise to abort."""
         B, T = mu.size(0), mu.size(1)
         x = torch.randn([B, self.in_channels, T], device=mu.device, dtype=mu.dtype) * temperature
         prompt_len = prompt.size(-1)
@@ -1005,6 +1016,8 @@ class CFM(torch.nn.Module):
         t = 0
         d = 1 / n_timesteps
         for j in range(n_timesteps):
+            if cancel_check is not None:
+                cancel_check()
             t_tensor = torch.ones(x.shape[0], device=x.device, dtype=mu.dtype) * t
             d_tensor = torch.ones(x.shape[0], device=x.device, dtype=mu.dtype) * d
             # v_pred = model(x, t_tensor, d_tensor, **extra_args)
@@ -1186,14 +1199,18 @@ class SynthesizerTrnV3(nn.Module):
         cfm_loss = self.cfm(mel, mel_lengths, prompt_len, fea, use_grad_ckpt)
         return cfm_loss
 
+    @torch.no_grad()
+    def get_ge(self, refer):
+        refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
+        refer_mask = torch.unsqueeze(commons.sequence_mask(refer_lengths, refer.size(2)), 1).to(refer.dtype)
+        return self.ref_enc(refer[:, :704] * refer_mask, refer_mask)
+
     @torch.no_grad()
     def decode_encp(self, codes, text, refer, ge=None, speed=1):
         # print(2333333,refer.shape)
         # ge=None
         if ge == None:
-            refer_lengths = torch.LongTensor([refer.size(2)]).to(refer.device)
-            refer_mask = torch.unsqueeze(commons.sequence_mask(refer_lengths, refer.size(2)), 1).to(refer.dtype)
-            ge = self.ref_enc(refer[:, :704] * refer_mask, refer_mask)
+            ge = self.get_ge(refer)
         y_lengths = torch.LongTensor([int(codes.size(2) * 2)]).to(codes.device)
         if speed == 1:
             sizee = int(codes.size(2) * 2.5 * 1.5)
@@ -48,26 +48,33 @@ def prepare_onnx_input(
     phoneme_masks = []
     char_ids = []
     position_ids = []
+    text_ids = []
+    ### 同一句子的多个多音字只分词一次，text_ids记录每行对应的(截断后)句子编号
+    tokenized = {}
+    encoded = {}
 
     for idx in range(len(texts)):
         text = (truncated_texts if window_size else texts)[idx].lower()
         query_id = (truncated_query_ids if window_size else query_ids)[idx]
 
-        try:
-            tokens, text2token, token2text = tokenize_and_map(tokenizer=tokenizer, text=text)
-        except Exception:
-            print(f'warning: text "{text}" is invalid')
-            return {}
+        if text not in tokenized:
+            try:
+                tokenized[text] = tokenize_and_map(tokenizer=tokenizer, text=text)
+            except Exception:
+                print(f'warning: text "{text}" is invalid')
+                return {}
+        tokens, text2token, token2text = tokenized[text]
 
         text, query_id, tokens, text2token, token2text = _truncate(
             max_len=max_len, text=text, query_id=query_id, tokens=tokens, text2token=text2token, token2text=token2text
         )
 
-        processed_tokens = ["[CLS]"] + tokens + ["[SEP]"]
-
-        input_id = list(np.array(tokenizer.convert_tokens_to_ids(processed_tokens)))
-        token_type_id = list(np.zeros((len(processed_tokens),), dtype=int))
-        attention_mask = list(np.ones((len(processed_tokens),), dtype=int))
+        if text not in encoded:
+            processed_tokens = ["[CLS]"] + tokens + ["[SEP]"]
+            encoded[text] = (len(encoded), list(np.array(tokenizer.convert_tokens_to_ids(processed_tokens))))
+        text_id, input_id = encoded[text]
+        token_type_id = list(np.zeros((len(input_id),), dtype=int))
+        attention_mask = list(np.ones((len(input_id),), dtype=int))
 
         query_char = text[query_id]
         phoneme_mask = (
@@ -82,6 +89,13 @@ def prepare_onnx_input(
         phoneme_masks.append(phoneme_mask)
         char_ids.append(char_id)
         position_ids.append(position_id)
+        text_ids.append(text_id)
+
+    ### 不同句子长度不同，补零到同一长度(attention_mask为0)
+    seq_len = max([len(input_id) for input_id in input_ids], default=0)
+    input_ids = [input_id + [0] * (seq_len - len(input_id)) for input_id in input_ids]
+    token_type_ids = [token_type_id + [0] * (seq_len - len(token_type_id)) for token_type_id in token_type_ids]
+    attention_masks = [attention_mask + [0] * (seq_len - len(attention_mask)) for attention_mask in attention_masks]
 
     outputs = {
         "input_ids": np.array(input_ids).astype(np.int64),
@@ -90,6 +104,7 @@ def prepare_onnx_input(
         "phoneme_masks": np.array(phoneme_masks).astype(np.float32),
         "char_ids": np.array(char_ids).astype(np.int64),
         "position_ids": np.array(position_ids).astype(np.int64),
+        "text_ids": np.array(text_ids).astype(np.int64),
     }
     return outputs
 
@@ -24,10 +24,12 @@ from .utils import load_config
 
 model_version = "1.1"
 
+### g2pW.onnx拆分出的编码器(BERT)和分类头，见split_onnx.py
+ENCODER_ONNX = "g2pW_encoder.onnx"
+HEAD_ONNX = "g2pW_head.onnx"
+
 
 def predict(session, onnx_input: Dict[str, Any], labels: List[str]) -> Tuple[List[str], List[float]]:
-    all_preds = []
-    all_confidences = []
     probs = session.run(
         [],
         {
@@ -39,7 +41,46 @@ def predict(session, onnx_input: Dict[str, Any], labels: List[str]) -> Tuple[Lis
             "position_ids": onnx_input["position_ids"],
         },
     )[0]
+    return decode_probs(probs, labels)
+
+
+def predict_shared(
+    session_encoder, session_head, onnx_input: Dict[str, Any], labels: List[str]
+) -> Tuple[List[str], List[float]]:
+    """
+    Runs the encoder once per sentence and the classification head once per polyphonic character,
+    on the hidden states of the sentence it belongs to.
+    """
+    probs = run_shared(session_encoder, session_head, onnx_input)
+    return decode_probs(probs, labels)
+
+
+def run_shared(session_encoder, session_head, onnx_input: Dict[str, Any]) -> np.ndarray:
+    text_ids = onnx_input["text_ids"]
+    ### 每个句子取第一次出现的行作为编码器输入
+    _, rows = np.unique(text_ids, return_index=True)
+    feeds = {
+        "input_ids": onnx_input["input_ids"],
+        "token_type_ids": onnx_input["token_type_ids"],
+        "attention_mask": onnx_input["attention_masks"],
+    }
+    hidden = session_encoder.run([], {name: value[rows] for name, value in feeds.items()})[0]
+    feeds.update(
+        {
+            session_encoder.get_outputs()[0].name: hidden[text_ids],
+            "phoneme_mask": onnx_input["phoneme_masks"],
+            "char_ids": onnx_input["char_ids"],
+            "position_ids": onnx_input["position_ids"],
+        }
+    )
+    ### 分类头可能只用到部分输入
+    head_inputs = [node.name for node in session_head.get_inputs()]
+    return session_head.run([], {name: feeds[name] for name in head_inputs})[0]
 
+
+def decode_probs(probs: np.ndarray, labels: List[str]) -> Tuple[List[str], List[float]]:
+    all_preds = []
+    all_confidences = []
     preds = np.argmax(probs, axis=1).tolist()
     max_probs = []
     for index, arr in zip(preds, probs.tolist()):
@@ -74,6 +115,25 @@ def download_and_decompress(model_dir: str = "G2PWModel/"):
     return model_dir
 
 
+def load_session(path: str):
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    sess_options.intra_op_num_threads = 2
+    try:
+        return onnxruntime.InferenceSession(
+            path,
+            sess_options=sess_options,
+            providers=["CUDAExecutionProvider", "CPUExecutionProvider"],
+        )
+    except:
+        return onnxruntime.InferenceSession(
+            path,
+            sess_options=sess_options,
+            providers=["CPUExecutionProvider"],
+        )
+
+
 class G2PWOnnxConverter:
     def __init__(
         self,
@@ -81,25 +141,19 @@ class G2PWOnnxConverter:
         style: str = "bopomofo",
         model_source: str = None,
         enable_non_tradional_chinese: bool = False,
+        shared_encoder: bool = True,
     ):
         uncompress_path = download_and_decompress(model_dir)
 
-        sess_options = onnxruntime.SessionOptions()
-        sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-        sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
-        sess_options.intra_op_num_threads = 2
-        try:
-            self.session_g2pW = onnxruntime.InferenceSession(
-                os.path.join(uncompress_path, "g2pW.onnx"),
-                sess_options=sess_options,
-                providers=["CUDAExecutionProvider", "CPUExecutionProvider"],
-            )
-        except:
-            self.session_g2pW = onnxruntime.InferenceSession(
-                os.path.join(uncompress_path, "g2pW.onnx"),
-                sess_options=sess_options,
-                providers=["CPUExecutionProvider"],
-            )
+        self.session_g2pW = load_session(os.path.join(uncompress_path, "g2pW.onnx"))
+        ### 有拆分好的编码器和分类头时，每个句子只跑一次BERT
+        self.session_encoder = None
+        self.session_head = None
+        encoder_path = os.path.join(uncompress_path, ENCODER_ONNX)
+        head_path = os.path.join(uncompress_path, HEAD_ONNX)
+        if shared_encoder and os.path.exists(encoder_path) and os.path.exists(head_path):
+            self.session_encoder = load_session(encoder_path)
+            self.session_head = load_session(head_path)
         self.config = load_config(config_path=os.path.join(uncompress_path, "config.py"), use_default=True)
 
         self.model_source = model_source if model_source else self.config.model_source
@@ -208,7 +262,15 @@ class G2PWOnnxConverter:
             window_size=None,
         )
 
-        preds, confidences = predict(session=self.session_g2pW, onnx_input=onnx_input, labels=self.labels)
+        if self.session_encoder is not None:
+            preds, confidences = predict_shared(
+                session_encoder=self.session_encoder,
+                session_head=self.session_head,
+                onnx_input=onnx_input,
+                labels=self.labels,
+            )
+        else:
+            preds, confidences = predict(session=self.session_g2pW, onnx_input=onnx_input, labels=self.labels)
         if self.config.use_char_phoneme:
             preds = [pred.split(" ")[1] for pred in preds]
 
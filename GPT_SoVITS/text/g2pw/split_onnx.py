@@ -0,0 +1,166 @@
+"""
+Split g2pW.onnx into the BERT encoder (g2pW_encoder.onnx) and the classification head (g2pW_head.onnx),
+so that G2PWOnnxConverter encodes each sentence once and classifies all its polyphonic characters
+from the shared hidden states, instead of running the whole model once per polyphonic character.
+
+cd GPT_SoVITS
+python -m text.g2pw.split_onnx --model_dir text/G2PWModel
+python -m text.g2pw.split_onnx --model_dir text/G2PWModel --bench -n 20
+
+--bench checks that the split model gives the same predictions as g2pW.onnx and compares the throughput.
+Requires the onnx package.
+"""
+
+import argparse
+import os
+import time
+from typing import List
+
+import numpy as np
+
+ENCODER_INPUTS = ["input_ids", "token_type_ids", "attention_mask"]
+HEAD_INPUTS = ["phoneme_mask", "char_ids", "position_ids"]
+
+BENCH_SENTENCES = [
+    "银行行长在行业会议上说，这一行的人都很行。",
+    "他长得很高，是家里的长子，长大以后当了校长。",
+    "重庆的重要会议重新安排在了重阳节。",
+    "我们要了解他为什么了却心愿以后还是不快乐。",
+    "这个单于姓单，他还得把这本书还给图书馆。",
+    "音乐让他快乐，他把乐谱放在了教室的角落里。",
+    "调查组调动了人员，重新调整了音调。",
+    "他觉得这一觉睡得很好，于是便宜地买了便当。",
+]
+
+
+def find_hidden_state(model) -> str:
+    """
+    The encoder output is the rank 3 tensor computed only from the encoder inputs and consumed
+    together with a tensor computed from the head inputs (the gather at the query position).
+    """
+    import onnx
+
+    model = onnx.shape_inference.infer_shapes(model)
+    graph = model.graph
+    ranks = {}
+    for value in list(graph.value_info) + list(graph.output) + list(graph.input):
+        if value.type.tensor_type.HasField("shape"):
+            ranks[value.name] = len(value.type.tensor_type.shape.dim)
+    deps = {value.name: {value.name} for value in graph.input}
+    for initializer in graph.initializer:
+        deps.setdefault(initializer.name, set())
+    candidates = []
+    for node in graph.node:
+        node_deps = set()
+        for name in node.input:
+            node_deps |= deps.get(name, set())
+        for name in node.output:
+            deps[name] = node_deps
+        if not node_deps & set(HEAD_INPUTS):
+            continue
+        for name in node.input:
+            if name in deps and deps[name] and deps[name] <= set(ENCODER_INPUTS) and ranks.get(name, None) == 3:
+                if name not in candidates:
+                    candidates.append(name)
+    if len(candidates) != 1:
+        raise ValueError(f"cannot find the encoder output of g2pW (candidates: {candidates}), please set --hidden_name")
+    return candidates[0]
+
+
+def split_g2pw_onnx(model_dir: str, hidden_name: str = None):
+    import onnx
+    from onnx.utils import extract_model
+
+    from .onnx_api import ENCODER_ONNX, HEAD_ONNX
+
+    model_path = os.path.join(model_dir, "g2pW.onnx")
+    model = onnx.load(model_path)
+    if hidden_name is None:
+        hidden_name = find_hidden_state(model)
+    output_name = model.graph.output[0].name
+    del model
+    extract_model(model_path, os.path.join(model_dir, ENCODER_ONNX), ENCODER_INPUTS, [hidden_name])
+    ### 分类头保留encoder的输入，导出图中batch维可能是从input_ids的shape算出来的
+    extract_model(
+        model_path, os.path.join(model_dir, HEAD_ONNX), [hidden_name] + ENCODER_INPUTS + HEAD_INPUTS, [output_name]
+    )
+    print(f"g2pW split at {hidden_name}: {ENCODER_ONNX}, {HEAD_ONNX} saved to {model_dir}")
+
+
+def bench(model_dir: str, model_source: str, sentences: List[str], n: int):
+    from .onnx_api import G2PWOnnxConverter, predict, run_shared
+    from .dataset import prepare_onnx_input
+
+    baseline = G2PWOnnxConverter(model_dir=model_dir, style="pinyin", model_source=model_source, shared_encoder=False)
+    shared = G2PWOnnxConverter(model_dir=model_dir, style="pinyin", model_source=model_source, shared_encoder=True)
+    if shared.session_encoder is None:
+        raise ValueError(f"split model not found in {model_dir}, run without --bench first")
+
+    max_diff = 0.0
+    for sentence in sentences:
+        texts, query_ids, _, _ = baseline._prepare_data([sentence])
+        if len(texts) == 0:
+            continue
+        onnx_input = prepare_onnx_input(
+            tokenizer=baseline.tokenizer,
+            labels=baseline.labels,
+            char2phonemes=baseline.char2phonemes,
+            chars=baseline.chars,
+            texts=texts,
+            query_ids=query_ids,
+            use_mask=baseline.config.use_mask,
+        )
+        probs = baseline.session_g2pW.run(
+            [],
+            {
+                "input_ids": onnx_input["input_ids"],
+                "token_type_ids": onnx_input["token_type_ids"],
+                "attention_mask": onnx_input["attention_masks"],
+                "phoneme_mask": onnx_input["phoneme_masks"],
+                "char_ids": onnx_input["char_ids"],
+                "position_ids": onnx_input["position_ids"],
+            },
+        )[0]
+        shared_probs = run_shared(shared.session_encoder, shared.session_head, onnx_input)
+        max_diff = max(max_diff, float(np.abs(probs - shared_probs).max()))
+        expected = baseline(sentence)
+        result = shared(sentence)
+        if expected != result:
+            raise AssertionError(f"prediction mismatch on {sentence}:\n{expected}\n{result}")
+    print(f"parity ok on {len(sentences)} sentences, max prob diff {max_diff:.2e}")
+
+    num_queries = sum(len(baseline._prepare_data([sentence])[0]) for sentence in sentences)
+    for name, converter in [("per character", baseline), ("shared encoder", shared)]:
+        for sentence in sentences:
+            converter(sentence)
+        t0 = time.perf_counter()
+        for _ in range(n):
+            for sentence in sentences:
+                converter(sentence)
+        cost = time.perf_counter() - t0
+        print(
+            f"{name}: {cost / (n * len(sentences)) * 1000:.2f} ms per sentence, "
+            f"{n * num_queries / cost:.1f} polyphonic chars/s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="split g2pW.onnx into encoder and classification head")
+    parser.add_argument("--model_dir", type=str, default="text/G2PWModel", help="g2pW model directory")
+    parser.add_argument("--hidden_name", type=str, default=None, help="name of the encoder output tensor")
+    parser.add_argument("--bench", action="store_true", help="check parity and compare the throughput")
+    parser.add_argument(
+        "--model_source", type=str, default="pretrained_models/chinese-roberta-wwm-ext-large", help="tokenizer path"
+    )
+    parser.add_argument("--text_file", type=str, default=None, help="sentences used by --bench, one per line")
+    parser.add_argument("-n", type=int, default=10, help="number of iterations of --bench")
+    args = parser.parse_args()
+
+    if args.bench:
+        sentences = BENCH_SENTENCES
+        if args.text_file is not None:
+            with open(args.text_file, "r", encoding="utf-8") as f:
+                sentences = [line.strip() for line in f if line.strip()]
+        bench(args.model_dir, args.model_source, sentences, args.n)
+    else:
+        split_g2pw_onnx(args.model_dir, args.hidden_name)
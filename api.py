@@ -138,6 +138,17 @@ POST:
 
 RESP: 无
 
+
+### 监控指标
+
+endpoint: `/metrics`
+
+GET:
+    `http://127.0.0.1:9880/metrics`
+
+RESP:
+成功: Prometheus 文本格式的监控指标(各阶段耗时、实时率、语义token数、合成的音频秒数), http code 200
+
 """
 
 import argparse
@@ -157,7 +168,7 @@ import torchaudio
 import librosa
 import soundfile as sf
 from fastapi import FastAPI, Request, Query
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 import uvicorn
 from transformers import AutoModelForMaskedLM, AutoTokenizer
 import numpy as np
@@ -170,8 +181,11 @@ from text import cleaned_text_to_sequence
 from text.cleaner import clean_text
 from module.mel_processing import spectrogram_torch
 import config as global_config
+from tools.ref_audio import RefAudio, load_ref_audio
+from tools.ref_audio import resample as ref_audio_resample
 import logging
-import subprocess
+from tools.audio_encoder import STREAM_MEDIA_TYPES, create_stream_encoder, encode_audio
+from tools import metrics
 
 
 class DefaultRefer:
@@ -215,14 +229,8 @@ def init_bigvgan():
         bigvgan_model = bigvgan_model.to(device)
 
 
-resample_transform_dict = {}
-
-
 def resample(audio_tensor, sr0):
-    global resample_transform_dict
-    if sr0 not in resample_transform_dict:
-        resample_transform_dict[sr0] = torchaudio.transforms.Resample(sr0, 24000).to(device)
-    return resample_transform_dict[sr0](audio_tensor)
+    return ref_audio_resample(audio_tensor.to(device), sr0, 24000)
 
 
 from module.mel_processing import mel_spectrogram_torch
@@ -534,8 +542,8 @@ class DictToAttrRecursive(dict):
 
 
 def get_spepc(hps, filename):
-    audio, _ = librosa.load(filename, int(hps.data.sampling_rate))
-    audio = torch.FloatTensor(audio)
+    ref_audio = filename if isinstance(filename, RefAudio) else load_ref_audio(filename)
+    audio = ref_audio.get(int(hps.data.sampling_rate)).clone()
     maxx = audio.abs().max()
     if maxx > 1:
         audio /= min(2, maxx)
@@ -630,37 +638,13 @@ def pack_wav(audio_bytes, rate):
 
 def pack_aac(audio_bytes, data, rate):
     if is_int32:
-        pcm = "s32le"
+        pcm = "s32"
         bit_rate = "256k"
     else:
-        pcm = "s16le"
+        pcm = "s16"
         bit_rate = "128k"
-    process = subprocess.Popen(
-        [
-            "ffmpeg",
-            "-f",
-            pcm,  # 输入16位有符号小端整数PCM
-            "-ar",
-            str(rate),  # 设置采样率
-            "-ac",
-            "1",  # 单声道
-            "-i",
-            "pipe:0",  # 从管道读取输入
-            "-c:a",
-            "aac",  # 音频编码器为AAC
-            "-b:a",
-            bit_rate,  # 比特率
-            "-vn",  # 不包含视频
-            "-f",
-            "adts",  # 输出AAC数据流格式
-            "pipe:1",  # 将输出写入管道
-        ],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    out, _ = process.communicate(input=data.tobytes())
-    audio_bytes.write(out)
+    ### 有PyAV时在进程内编码，不再为每段音频启动ffmpeg
+    audio_bytes.write(encode_audio(data, rate, "aac", pcm, bit_rate))
 
     return audio_bytes
 
@@ -744,8 +728,9 @@ def get_tts_wav(
     dtype = torch.float16 if is_half == True else torch.float32
     zero_wav = np.zeros(int(hps.data.sampling_rate * 0.3), dtype=np.float16 if is_half == True else np.float32)
     with torch.no_grad():
-        wav16k, sr = librosa.load(ref_wav_path, sr=16000)
-        wav16k = torch.from_numpy(wav16k)
+        ### 参考音频只解码一次
+        ref_wav = load_ref_audio(ref_wav_path)
+        wav16k = ref_wav.get(16000)
         zero_wav_torch = torch.from_numpy(zero_wav)
         if is_half == True:
             wav16k = wav16k.half().to(device)
@@ -769,22 +754,28 @@ def get_tts_wav(
                     except Exception as e:
                         logger.error(e)
             if len(refers) == 0:
-                refers = [get_spepc(hps, ref_wav_path).to(dtype).to(device)]
+                refers = [get_spepc(hps, ref_wav).to(dtype).to(device)]
         else:
-            refer = get_spepc(hps, ref_wav_path).to(device).to(dtype)
+            refer = get_spepc(hps, ref_wav).to(device).to(dtype)
 
     t1 = ttime()
     # os.environ['version'] = version
     prompt_language = dict_language[prompt_language.lower()]
     text_language = dict_language[text_language.lower()]
     phones1, bert1, norm_text1 = get_phones_and_bert(prompt_text, prompt_language, version)
+    metric_labels = metrics.mode_labels(version, False, stream_mode == "normal", 1)
+    stage_times = {"ref_setup": t1 - t0, "text_preprocess": ttime() - t1, "t2s": 0.0, "vits": 0.0}
+    audio_seconds = 0.0
     texts = text.split("\n")
     audio_bytes = BytesIO()
+    ### 流式返回aac/ogg时整个响应共用一个编码器，输出一条连续的码流
+    stream_encoder = None
 
     for text in texts:
         # 简单防止纯符号引发参考音频泄露
         if only_punc(text):
             continue
+        t_text = ttime()
 
         audio_opt = []
         if text[-1] not in splits:
@@ -810,6 +801,7 @@ def get_tts_wav(
             )
             pred_semantic = pred_semantic[:, -idx:].unsqueeze(0)
         t3 = ttime()
+        metrics.SEMANTIC_TOKENS.inc(int(idx), version=version)
 
         if version != "v3":
             audio = (
@@ -823,12 +815,7 @@ def get_tts_wav(
             phoneme_ids1 = torch.LongTensor(phones2).to(device).unsqueeze(0)
             # print(11111111, phoneme_ids0, phoneme_ids1)
             fea_ref, ge = vq_model.decode_encp(prompt.unsqueeze(0), phoneme_ids0, refer)
-            ref_audio, sr = torchaudio.load(ref_wav_path)
-            ref_audio = ref_audio.to(device).float()
-            if ref_audio.shape[0] == 2:
-                ref_audio = ref_audio.mean(0).unsqueeze(0)
-            if sr != 24000:
-                ref_audio = resample(ref_audio, sr)
+            ref_audio = ref_wav.get(24000).unsqueeze(0).to(device)
             # print("ref_audio",ref_audio.abs().mean())
             mel2 = mel_fn(ref_audio)
             mel2 = norm_spec(mel2)
@@ -888,16 +875,32 @@ def get_tts_wav(
             if max_audio > 1:
                 audio_opt /= max_audio
             sr = 48000
+        stage_times["text_preprocess"] += t2 - t_text
+        stage_times["t2s"] += t3 - t2
+        stage_times["vits"] += ttime() - t3
+        audio_seconds += len(audio_opt) / sr
 
         if is_int32:
-            audio_bytes = pack_audio(audio_bytes, (audio_opt * 2147483647).astype(np.int32), sr)
+            pcm = (audio_opt * 2147483647).astype(np.int32)
+        else:
+            pcm = (audio_opt * 32768).astype(np.int16)
+        if stream_mode == "normal" and media_type in STREAM_MEDIA_TYPES:
+            if stream_encoder is None:
+                stream_encoder = create_stream_encoder(
+                    media_type, sr, "s32" if is_int32 else "s16", "256k" if is_int32 else "128k"
+                )
+            audio_bytes.write(stream_encoder.encode(pcm))
         else:
-            audio_bytes = pack_audio(audio_bytes, (audio_opt * 32768).astype(np.int16), sr)
+            audio_bytes = pack_audio(audio_bytes, pcm, sr)
         # logger.info("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t3 - t2, t4 - t3))
         if stream_mode == "normal":
             audio_bytes, audio_chunk = read_clean_buffer(audio_bytes)
             yield audio_chunk
 
+    metrics.observe_synthesis(metric_labels, stage_times, ttime() - t0, audio_seconds)
+    if stream_encoder is not None:
+        yield stream_encoder.close()
+
     if not stream_mode == "normal":
         if media_type == "wav":
             sr = 48000 if if_sr else 24000
@@ -1232,5 +1235,10 @@ async def tts_endpoint(
     )
 
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host=host, port=port, workers=1)
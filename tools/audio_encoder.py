@@ -0,0 +1,203 @@
+"""
+Streaming audio encoder sessions for chunked responses.
+
+One session lives as long as the response: PCM chunks are pushed with ``encode`` and the encoded bytes
+produced so far are returned, so the client receives a single continuous AAC (ADTS) / Ogg Vorbis /
+Ogg Opus stream instead of one independent stream (and one ffmpeg process) per chunk.
+Encoding happens in-process with PyAV when it is installed, otherwise in one long-lived ffmpeg process.
+"""
+
+import subprocess
+import threading
+from fractions import Fraction
+from typing import List, Optional
+
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+STREAM_MEDIA_TYPES = ["aac", "ogg", "opus"]
+
+### media_type: (容器格式, 编码器, 默认码率, 编码采样率)
+_CODECS = {
+    "aac": ("adts", "aac", "192k", None),
+    "ogg": ("ogg", "libvorbis", "128k", None),
+    ### opus只支持48k/24k/16k/12k/8k
+    "opus": ("ogg", "libopus", "32k", 48000),
+}
+
+
+def _parse_bit_rate(bit_rate: str) -> int:
+    bit_rate = str(bit_rate).lower()
+    if bit_rate.endswith("k"):
+        return int(float(bit_rate[:-1]) * 1000)
+    return int(bit_rate)
+
+
+class _ByteSink:
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class PyAVStreamEncoder:
+    def __init__(self, media_type: str, sample_rate: int, sample_format: str = "s16", bit_rate: str = None):
+        container_format, codec, default_bit_rate, codec_rate = _CODECS[media_type]
+        self.sample_rate = sample_rate
+        self.sample_format = sample_format
+        self.sink = _ByteSink()
+        ### 每个packet写出后立即flush，ogg每20ms一页，降低首包延迟
+        self.container = av.open(
+            self.sink,
+            mode="w",
+            format=container_format,
+            container_options={"flush_packets": "1", "page_duration": "20000"}
+            if container_format == "ogg"
+            else {"flush_packets": "1"},
+        )
+        self.stream = self.container.add_stream(codec, rate=codec_rate or sample_rate)
+        self.stream.codec_context.layout = "mono"
+        self.stream.codec_context.bit_rate = _parse_bit_rate(bit_rate or default_bit_rate)
+        self.pts = 0
+        self.closed = False
+
+    def _mux(self, frame: Optional["av.AudioFrame"]) -> bytes:
+        for packet in self.stream.encode(frame):
+            self.container.mux(packet)
+        return self.sink.take()
+
+    def encode(self, pcm: np.ndarray) -> bytes:
+        if len(pcm) == 0:
+            return b""
+        frame = av.AudioFrame.from_ndarray(pcm.reshape(1, -1), format=self.sample_format, layout="mono")
+        frame.sample_rate = self.sample_rate
+        frame.pts = self.pts
+        frame.time_base = Fraction(1, self.sample_rate)
+        self.pts += len(pcm)
+        ### 编码器会自动重采样到编码格式并按帧长缓存
+        return self._mux(frame)
+
+    def close(self) -> bytes:
+        if self.closed:
+            return b""
+        self.closed = True
+        data = self._mux(None)
+        self.container.close()
+        return data + self.sink.take()
+
+
+class FFmpegStreamEncoder:
+    def __init__(self, media_type: str, sample_rate: int, sample_format: str = "s16", bit_rate: str = None):
+        container_format, codec, default_bit_rate, codec_rate = _CODECS[media_type]
+        codec_args = ["-c:a", codec]
+        if codec_rate is not None:
+            codec_args += ["-ar", str(codec_rate)]
+        format_args = ["-page_duration", "20000"] if container_format == "ogg" else []
+        self.process = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-loglevel",
+                "error",
+                "-f",
+                sample_format + "le",  # 输入有符号小端整数PCM
+                "-ar",
+                str(sample_rate),
+                "-ac",
+                "1",
+                "-i",
+                "pipe:0",
+                *codec_args,
+                "-b:a",
+                bit_rate or default_bit_rate,
+                "-vn",
+                "-flush_packets",
+                "1",
+                *format_args,
+                "-f",
+                container_format,
+                "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.chunks: List[bytes] = []
+        self.lock = threading.Lock()
+        ### 后台读取stdout，避免管道写满后阻塞
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+        self.closed = False
+
+    def _read(self):
+        while True:
+            data = self.process.stdout.read1(65536)
+            if not data:
+                break
+            with self.lock:
+                self.chunks.append(data)
+
+    def _take(self) -> bytes:
+        with self.lock:
+            data = b"".join(self.chunks)
+            self.chunks = []
+        return data
+
+    def encode(self, pcm: np.ndarray) -> bytes:
+        if len(pcm) > 0:
+            self.process.stdin.write(pcm.tobytes())
+            self.process.stdin.flush()
+        return self._take()
+
+    def close(self) -> bytes:
+        if self.closed:
+            return b""
+        self.closed = True
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.reader.join()
+        self.process.wait()
+        return self._take()
+
+
+def create_stream_encoder(media_type: str, sample_rate: int, sample_format: str = "s16", bit_rate: str = None):
+    """
+    Args:
+        media_type: "aac", "ogg" (vorbis) or "opus" (ogg/opus).
+        sample_rate: sampling rate of the pushed PCM.
+        sample_format: "s16" (int16 PCM) or "s32" (int32 PCM).
+        bit_rate: e.g. "128k", defaults to 192k for aac, 128k for vorbis and 32k for opus.
+    """
+    if media_type not in _CODECS:
+        raise ValueError(f"media_type {media_type} can not be encoded as a stream")
+    if av is not None:
+        try:
+            return PyAVStreamEncoder(media_type, sample_rate, sample_format, bit_rate)
+        except Exception as e:
+            print(f"PyAV encoder unavailable for {media_type}, fallback to ffmpeg: {e}")
+    return FFmpegStreamEncoder(media_type, sample_rate, sample_format, bit_rate)
+
+
+def encode_audio(
+    data: np.ndarray, sample_rate: int, media_type: str, sample_format: str = "s16", bit_rate: str = None
+) -> bytes:
+    """
+    Encode a whole audio at once, in-process when PyAV is available.
+    """
+    encoder = create_stream_encoder(media_type, sample_rate, sample_format, bit_rate)
+    return encoder.encode(data) + encoder.close()
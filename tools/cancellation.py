@@ -0,0 +1,62 @@
+"""
+Per-request cancellation for TTS.run.
+
+A CancelToken is passed in the inputs of TTS.run ("cancel_token"). Its ``check`` is called at every T2S decode
+step, every CFM step of the v3 synthesizer and between the batches of a request, and raises InferenceCancelled
+once the token is cancelled (e.g. the client disconnected) or its deadline has passed. The exception unwinds the
+generator like any other, but TTS.run does not treat it as a failure: the models are not reloaded.
+"""
+
+import threading
+import time
+from typing import Optional
+
+
+class InferenceCancelled(Exception):
+    def __init__(self, reason: str = "cancelled"):
+        super().__init__("inference cancelled" if reason == "cancelled" else "inference deadline exceeded")
+        ### "cancelled" 或 "deadline"
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    Args:
+        event: event shared with the owner of the request, e.g. InferenceJob.cancelled, a new one by default.
+        deadline: ``time.monotonic()`` value after which the request is abandoned, None for no deadline.
+    """
+
+    def __init__(self, event: threading.Event = None, deadline: Optional[float] = None):
+        self.event = event if event is not None else threading.Event()
+        self.deadline = deadline
+
+    @classmethod
+    def from_timeout(cls, timeout: Optional[float]) -> "CancelToken":
+        """
+        A token expiring ``timeout`` seconds from now, no deadline when timeout is None or <= 0.
+        """
+        if timeout is None or timeout <= 0:
+            return cls()
+        return cls(deadline=time.monotonic() + timeout)
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set() or self.expired
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        if self.event.is_set():
+            raise InferenceCancelled("cancelled")
+        if self.expired:
+            raise InferenceCancelled("deadline")
@@ -0,0 +1,239 @@
+"""
+Minimal Prometheus metrics (counters, gauges and histograms with labels) rendered in the text exposition format,
+so that /metrics does not need prometheus_client.
+
+The metrics of the synthesis pipeline are defined at the bottom of this file and recorded by TTS.run / run_batch
+and api.py. Values kept elsewhere (cache hits, queue depth) are copied into the metrics when /metrics is scraped.
+"""
+
+import math
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List["_Metric"] = []
+        ### 多进程模式下每个进程加上 worker 标签
+        self.const_labels: Dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: "_Metric"):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def clear(self):
+        """
+        Drops the samples recorded so far, e.g. by the warmup requests.
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            with metric.lock:
+                metric.values.clear()
+
+    def render(self) -> str:
+        const_labels = list(self.const_labels.items())
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(const_labels + labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: dict = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> List[Tuple[str, str]]:
+        return list(zip(self.labelnames, key))
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """
+        Mirrors a cumulative count kept elsewhere, e.g. the hits of a cache.
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        registry: Registry = REGISTRY,
+    ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                ### [每个桶的计数, 总和, 次数]
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self.values.items())
+        for key, (counts, total, count) in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket", labels + [("le", _format_value(bound))], cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+def merge_metrics(texts: List[str]) -> str:
+    """
+    Merges the /metrics output of several processes (with distinct const labels) into one exposition.
+    """
+    families: Dict[str, List[str]] = {}
+    headers: Dict[str, List[str]] = {}
+    for text in texts:
+        current = None
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                current = line.split(" ")[2]
+                families.setdefault(current, [])
+                headers.setdefault(current, [])
+                if len(headers[current]) < 2 and line not in headers[current]:
+                    headers[current].append(line)
+            elif line.strip() != "" and current is not None:
+                families[current].append(line)
+    lines = []
+    for name, samples in families.items():
+        lines.extend(headers[name])
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+MODE_LABELS = ("version", "parallel_infer", "return_fragment", "batch_size")
+
+STAGE_SECONDS = Histogram(
+    "tts_stage_seconds",
+    "Time spent in each stage of a synthesis: ref_setup, text_preprocess, t2s and vits "
+    "(t2s_vits when the two stages are interleaved or shared by a batch of requests).",
+    ("stage",) + MODE_LABELS,
+)
+REQUEST_SECONDS = Histogram("tts_request_seconds", "Total time of a synthesis.", MODE_LABELS)
+REAL_TIME_FACTOR = Histogram(
+    "tts_real_time_factor", "Synthesis time divided by the duration of the produced audio.", MODE_LABELS, RTF_BUCKETS
+)
+REQUESTS = Counter("tts_requests_total", "Synthesis requests by outcome.", ("version", "status"))
+SEMANTIC_TOKENS = Counter("tts_semantic_tokens_total", "Semantic tokens generated by the T2S model.", ("version",))
+AUDIO_SECONDS = Counter("tts_audio_seconds_total", "Seconds of audio produced.", ("version",))
+CACHE_HITS = Counter("tts_cache_hits_total", "Cache hits.", ("cache",))
+CACHE_MISSES = Counter("tts_cache_misses_total", "Cache misses.", ("cache",))
+QUEUE_DEPTH = Gauge("tts_queue_depth", "Requests waiting in the inference queue.")
+RUNNING_REQUESTS = Gauge("tts_running_requests", "Requests being synthesized.")
+REJECTED_REQUESTS = Counter("tts_rejected_requests_total", "Requests rejected because the queue was full.")
+
+
+def mode_labels(version: str, parallel_infer: bool, return_fragment: bool, batch_size: int) -> dict:
+    return {
+        "version": version,
+        "parallel_infer": str(bool(parallel_infer)).lower(),
+        "return_fragment": str(bool(return_fragment)).lower(),
+        "batch_size": str(batch_size),
+    }
+
+
+def observe_synthesis(labels: dict, stages: Dict[str, float], total: float, audio_seconds: float, requests: int = 1):
+    """
+    Records the stage times, the latency and the real time factor of one finished synthesis,
+    which served ``requests`` requests.
+    """
+    for stage, seconds in stages.items():
+        STAGE_SECONDS.observe(seconds, stage=stage, **labels)
+    REQUEST_SECONDS.observe(total, **labels)
+    if audio_seconds > 0:
+        REAL_TIME_FACTOR.observe(total / audio_seconds, **labels)
+        AUDIO_SECONDS.inc(audio_seconds, version=labels["version"])
+    REQUESTS.inc(requests, version=labels["version"], status="ok")
+
+
+def set_cache_stats(cache: str, stats: dict):
+    CACHE_HITS.set(stats.get("hits", 0), cache=cache)
+    CACHE_MISSES.set(stats.get("misses", 0), cache=cache)
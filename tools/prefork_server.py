@@ -0,0 +1,327 @@
+"""
+Pre-fork serving of api_v2.py on multi-core CPU machines.
+
+The supervisor loads the models once and forks the worker processes, which share the weights copy-on-write:
+nothing writes to the weight tensors during inference, and the python objects are moved out of the gc
+generations with ``gc.freeze`` before forking so that garbage collection does not touch (and copy) their pages.
+Each worker is pinned to its own slice of cores and serves the app on a unix socket. The supervisor accepts the
+tcp connections and forwards each one to the worker with the fewest in-flight requests. The router sets the
+X-Forwarded-For header of the request to the client address and has the worker close the connection after the
+response, so every request of a client goes through the router (keep-alive is not supported).
+
+Linux only (fork, sched_setaffinity and unix sockets). Crashed workers are not restarted, the router skips them.
+"""
+
+import asyncio
+import gc
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import traceback
+from typing import Callable, List, Optional
+
+from tools.metrics import CONTENT_TYPE, merge_metrics
+
+_CLIENT_IP_HEADER = b"X-Forwarded-For"
+
+
+def split_cores(num_processes: int, cores: List[int] = None) -> List[List[int]]:
+    """
+    Splits the usable cores into ``num_processes`` contiguous slices, the first slices get the remainder.
+    """
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0))
+    if num_processes >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(num_processes)]
+    size, remainder = divmod(len(cores), num_processes)
+    slices = []
+    start = 0
+    for i in range(num_processes):
+        end = start + size + (1 if i < remainder else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+
+class InflightCounter:
+    """
+    ASGI middleware counting the in-flight http and websocket requests of a worker in the shared ``loads`` array.
+    A streaming response is counted until its last chunk is sent.
+    """
+
+    def __init__(self, app, loads, index: int):
+        self.app = app
+        self.loads = loads
+        self.index = index
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ["http", "websocket"]:
+            return await self.app(scope, receive, send)
+        self.loads[self.index] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.loads[self.index] -= 1
+
+
+async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+    """
+    Copies until the reader is at EOF (returns True) or the writer is closed (returns False).
+    """
+    while True:
+        try:
+            data = await reader.read(65536)
+        except ConnectionError:
+            return True
+        if not data:
+            return True
+        try:
+            writer.write(data)
+            await writer.drain()
+        except ConnectionError:
+            return False
+
+
+async def _read_headers(reader: asyncio.StreamReader, peer) -> bytes:
+    """
+    Reads the headers of a request and returns them with the client supplied X-Forwarded-For replaced by the peer
+    address. Except for upgrades (websocket), ``Connection: close`` is added so that the worker closes the
+    connection after the response and the next request of the client is read here again.
+    """
+    headers = []
+    upgrade = False
+    while True:
+        line = await reader.readline()
+        if not line.endswith(b"\n"):
+            raise ConnectionError("connection closed in the request headers")
+        if line.strip() == b"":
+            break
+        name = line.split(b":", 1)[0].strip().lower()
+        if name == _CLIENT_IP_HEADER.lower():
+            continue
+        if name == b"upgrade":
+            upgrade = True
+        headers.append(line)
+    if peer is not None:
+        headers.append(_CLIENT_IP_HEADER + b": " + str(peer[0]).encode() + b"\r\n")
+    if not upgrade:
+        headers.append(b"Connection: close\r\n")
+    return b"".join(headers) + b"\r\n"
+
+
+class PreforkServer:
+    """
+    Args:
+        serve_fn: ``serve_fn(index, uds_path, cores)`` runs the app of one worker on the unix socket ``uds_path``,
+            called in the forked process after it has been pinned to ``cores``.
+        num_processes: number of worker processes.
+        host, port: address the router listens on.
+        cores_per_process: defaults to the usable cores divided by ``num_processes``.
+        metrics_path: when the first request of a connection is a GET of this path, the router answers it with
+            the merged metrics of all the workers (see tools.metrics.merge_metrics).
+    """
+
+    def __init__(
+        self,
+        serve_fn: Callable[[int, str, List[int]], None],
+        num_processes: int,
+        host: Optional[str],
+        port: int,
+        cores_per_process: int = None,
+        metrics_path: str = None,
+    ):
+        self.serve_fn = serve_fn
+        self.num_processes = num_processes
+        self.host = host
+        self.port = port
+        self.metrics_path = metrics_path
+        cores = sorted(os.sched_getaffinity(0))
+        if cores_per_process is not None and cores_per_process > 0:
+            cores = cores[: cores_per_process * num_processes]
+        self.cores = split_cores(num_processes, cores)
+        self.socket_dir = tempfile.mkdtemp(prefix="gpt_sovits_")
+        self.socket_paths = [os.path.join(self.socket_dir, f"worker_{i}.sock") for i in range(num_processes)]
+        ### 在fork前创建，子进程写自己的位置，路由进程读取
+        self.loads = multiprocessing.RawArray("i", num_processes)
+        self.connections = [0] * num_processes
+        self.pids: List[Optional[int]] = [None] * num_processes
+        self.alive = [False] * num_processes
+        self.next_index = 0
+
+    def count_inflight(self, app, index: int):
+        return InflightCounter(app, self.loads, index)
+
+    def _fork(self, index: int):
+        pid = os.fork()
+        if pid != 0:
+            self.pids[index] = pid
+            self.alive[index] = True
+            return
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.sched_setaffinity(0, self.cores[index])
+            self.serve_fn(index, self.socket_paths[index], self.cores[index])
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _reap(self):
+        for i, pid in enumerate(self.pids):
+            if not self.alive[i]:
+                continue
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done, status = pid, 0
+            if done != 0:
+                self.alive[i] = False
+                print(f"worker {i} (pid {pid}) exited with status {status}, no longer routed to")
+
+    def _pick(self) -> Optional[int]:
+        ### 优先选在途请求最少的worker，其次是连接数，相同时轮转
+        candidates = [
+            i for i in range(self.num_processes) if self.alive[i] and os.path.exists(self.socket_paths[i])
+        ]
+        if len(candidates) == 0:
+            return None
+        index = min(
+            candidates,
+            key=lambda i: (self.loads[i], self.connections[i], (i - self.next_index) % self.num_processes),
+        )
+        self.next_index = (index + 1) % self.num_processes
+        return index
+
+    async def _fetch(self, index: int, request_path: bytes) -> str:
+        reader, writer = await asyncio.open_unix_connection(self.socket_paths[index])
+        try:
+            writer.write(b"GET " + request_path + b" HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            data = await reader.read()
+        finally:
+            writer.close()
+        head, _, body = data.partition(b"\r\n\r\n")
+        return body.decode("utf-8") if head.split(b" ")[1:2] == [b"200"] else ""
+
+    async def _serve_metrics(self, request_path: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while (await reader.readline()).strip() != b"":
+            pass
+        texts = []
+        for i in range(self.num_processes):
+            if self.alive[i] and os.path.exists(self.socket_paths[i]):
+                try:
+                    texts.append(await self._fetch(i, request_path))
+                except (OSError, IndexError):
+                    traceback.print_exc()
+        body = merge_metrics(texts).encode("utf-8")
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: "
+            + CONTENT_TYPE.encode()
+            + b"\r\nContent-Length: "
+            + str(len(body)).encode()
+            + b"\r\nConnection: close\r\n\r\n"
+            + body
+        )
+        await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+        except (ConnectionError, ValueError):
+            writer.close()
+            return
+        request = request_line.split(b" ")
+        if self.metrics_path is not None and len(request) == 3 and request[0] == b"GET":
+            if request[1].split(b"?")[0] == self.metrics_path.encode():
+                ### 汇总所有worker的指标
+                try:
+                    await self._serve_metrics(request[1], reader, writer)
+                except ConnectionError:
+                    pass
+                finally:
+                    writer.close()
+                return
+        if request_line.rstrip().split(b" ")[-1].startswith(b"HTTP/"):
+            ### worker通过unix socket收不到对端地址，由这里设置客户端IP
+            try:
+                request_line += await _read_headers(reader, writer.get_extra_info("peername"))
+            except (ConnectionError, ValueError):
+                writer.close()
+                return
+        index = self._pick()
+        if index is None:
+            writer.close()
+            return
+        self.connections[index] += 1
+        upstream_writer = None
+        try:
+            try:
+                upstream_reader, upstream_writer = await asyncio.open_unix_connection(self.socket_paths[index])
+            except OSError:
+                self._reap()
+                return
+            upstream_writer.write(request_line)
+            upload = asyncio.create_task(_pipe(reader, upstream_writer))
+            download = asyncio.create_task(_pipe(upstream_reader, writer))
+            await asyncio.wait([upload, download], return_when=asyncio.FIRST_COMPLETED)
+            if upload.done() and not upload.result():
+                ### worker先关闭了连接，把已经返回的数据转发完
+                await download
+            ### 客户端断开时立即关闭到worker的连接，worker才能感知并停止合成
+            upload.cancel()
+            download.cancel()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections[index] -= 1
+            for w in [writer, upstream_writer]:
+                if w is not None:
+                    w.close()
+
+    async def _route(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(sig, stop.set)
+        server = await asyncio.start_server(self._handle, self.host, self.port, limit=1024 * 1024)
+        print(f"routing {self.host}:{self.port} to {self.num_processes} workers, cores: {self.cores}")
+        async with server:
+            while not stop.is_set() and any(self.alive):
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    self._reap()
+
+    def stop(self):
+        for i, pid in enumerate(self.pids):
+            if self.alive[i]:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        for i, pid in enumerate(self.pids):
+            if self.alive[i]:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+                self.alive[i] = False
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    def run(self):
+        """
+        Forks the workers and routes the connections until SIGINT/SIGTERM or until all the workers exited.
+        """
+        ### 冻结已有对象，子进程中的gc不再扫描它们，共享的内存页不会因此被复制
+        gc.collect()
+        gc.freeze()
+        try:
+            for i in range(self.num_processes):
+                self._fork(i)
+            asyncio.run(self._route())
+        finally:
+            self.stop()
@@ -0,0 +1,105 @@
+"""
+Reference audio loading: the file is decoded once in-process, and the 16k (CNHuBERT), model-rate
+(spectrogram) and 24k (v3 mel) variants are derived from it with cached resampling kernels,
+instead of decoding the same file with torchaudio, an ffmpeg subprocess and librosa.
+
+Micro-benchmark:
+    python -m tools.ref_audio <ref.wav> [--sr 32000] [-n 20]
+"""
+
+import threading
+from typing import Dict, Tuple, Union
+
+import librosa
+import numpy as np
+import torch
+import torchaudio
+
+_resampler_dict: Dict[Tuple[int, int, str], torchaudio.transforms.Resample] = {}
+_resampler_lock = threading.Lock()
+
+
+def get_resampler(orig_sr: int, new_sr: int, device: Union[str, torch.device] = "cpu"):
+    key = (int(orig_sr), int(new_sr), str(device))
+    with _resampler_lock:
+        if key not in _resampler_dict:
+            _resampler_dict[key] = torchaudio.transforms.Resample(int(orig_sr), int(new_sr)).to(device)
+        return _resampler_dict[key]
+
+
+def resample(audio: torch.Tensor, orig_sr: int, new_sr: int) -> torch.Tensor:
+    if orig_sr == new_sr:
+        return audio
+    return get_resampler(orig_sr, new_sr, audio.device)(audio.float())
+
+
+class RefAudio:
+    """
+    A decoded reference audio. ``get(sr)`` returns the mono waveform at ``sr`` and caches it,
+    the returned tensor is shared and must not be modified in place.
+    """
+
+    def __init__(self, waveform: torch.Tensor, sr: int, path: str = None):
+        self.waveform = waveform  # [channels, T], float32, cpu
+        self.sr = sr
+        self.path = path
+        self._cache: Dict[int, torch.Tensor] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self) -> float:
+        return self.waveform.shape[-1] / self.sr
+
+    def get(self, sr: int) -> torch.Tensor:
+        sr = int(sr)
+        with self._lock:
+            if sr not in self._cache:
+                mono = self.waveform.mean(0, keepdim=True) if self.waveform.shape[0] > 1 else self.waveform
+                self._cache[sr] = resample(mono, self.sr, sr)[0]
+            return self._cache[sr]
+
+
+def load_ref_audio(path: str) -> RefAudio:
+    try:
+        waveform, sr = torchaudio.load(path)
+    except Exception:
+        ### torchaudio没有可用的解码后端时用librosa解码
+        audio, sr = librosa.load(path, sr=None, mono=False)
+        waveform = torch.from_numpy(np.atleast_2d(audio))
+    return RefAudio(waveform.float(), sr, path)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from tools.my_utils import load_audio
+
+    parser = argparse.ArgumentParser(description="reference audio loading micro-benchmark")
+    parser.add_argument("path", type=str, help="reference audio path")
+    parser.add_argument("--sr", type=int, default=32000, help="sampling rate of the SoVITS model")
+    parser.add_argument("-n", type=int, default=20, help="number of iterations")
+    args = parser.parse_args()
+
+    def legacy():
+        ### 原来的加载方式: torchaudio + ffmpeg子进程 + librosa各解码一次
+        raw_audio, raw_sr = torchaudio.load(args.path)
+        audio = load_audio(args.path, args.sr)
+        wav16k, _ = librosa.load(args.path, sr=16000)
+        if raw_sr != 24000:
+            torchaudio.transforms.Resample(raw_sr, 24000)(raw_audio)
+        return audio, wav16k
+
+    def single_decode():
+        ref_audio = load_ref_audio(args.path)
+        audio = ref_audio.get(args.sr)
+        wav16k = ref_audio.get(16000)
+        ref_audio.get(24000)
+        return audio, wav16k
+
+    for name, fn in [("legacy", legacy), ("single decode", single_decode)]:
+        fn()  # warmup, also builds the cached resampling kernels
+        t0 = time.perf_counter()
+        for _ in range(args.n):
+            fn()
+        print(f"{name}: {(time.perf_counter() - t0) / args.n * 1000:.2f} ms per reference")